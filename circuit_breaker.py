@@ -0,0 +1,250 @@
+import math
+import time
+import contextvars
+import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpen(Exception):
+    """Backend đang bị ngắt mạch: fail nhanh thay vì chờ hết timeout."""
+
+    def __init__(self, url: str, retry_after: float):
+        super().__init__(f"ComfyUI backend {url} is temporarily unavailable (circuit open, "
+                         f"retry in {math.ceil(retry_after)}s)")
+        self.url = url
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Ngắt mạch theo từng backend ComfyUI, dựa trên tỉ lệ lỗi và tỉ lệ call chậm.
+
+    Mỗi request HTTP/WS tới backend ghi kết quả vào cửa sổ CIRCUIT_WINDOW_SECONDS. Đủ
+    CIRCUIT_MIN_CALLS call mà tỉ lệ lỗi ≥ CIRCUIT_FAILURE_RATE hoặc tỉ lệ call chậm hơn
+    CIRCUIT_SLOW_CALL_SECONDS ≥ CIRCUIT_SLOW_CALL_RATE → mở mạch: mọi call fail nhanh
+    (CircuitOpen) trong CIRCUIT_OPEN_SECONDS. Sau đó half-open: đúng một call thử (giữ probe
+    token, thường là health probe của health_prober.py) được đi qua, thành công thì đóng lại,
+    lỗi thì mở tiếp. Router chỉ gửi job mới tới backend có mạch đóng.
+
+    Cũng giữ latency gần đây của từng loại read (view, history) để tính mốc hedge.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trips = 0
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()
+        # Token của call thử đang chạy ở trạng thái half-open (None = chưa có)
+        self._probe_token: Optional[object] = None
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    # ---------- trước mỗi call ----------
+    def _retry_after(self, now: float) -> float:
+        return max(0.0, self.opened_at + config.CIRCUIT_OPEN_SECONDS - now)
+
+    def _claim_probe(self, now: float) -> Optional[object]:
+        # Gọi khi đang giữ _lock: OPEN hết thời gian chờ → HALF_OPEN và giữ lượt thử (nguyên tử)
+        if self.state == OPEN and self._retry_after(now) <= 0:
+            self.state = HALF_OPEN
+            logger.info(f"Circuit for {self.url} half-open, letting a probe call through")
+        if self.state == HALF_OPEN and self._probe_token is None:
+            self._probe_token = object()
+            return self._probe_token
+        return None
+
+    def try_probe(self) -> Optional[object]:
+        """Probe token nếu đã tới lượt call thử và chưa ai giữ; None nếu không (health probe dùng)."""
+        if not config.CIRCUIT_BREAKER_ENABLED:
+            return None
+        with self._lock:
+            return self._claim_probe(time.monotonic())
+
+    def before_call(self) -> Optional[object]:
+        """Raise CircuitOpen nếu mạch không cho call đi qua. Trả về probe token nếu call này là
+        call thử của trạng thái half-open (truyền lại cho record()), None nếu là call thường."""
+        if not config.CIRCUIT_BREAKER_ENABLED:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            if self.state == CLOSED:
+                return None
+            token = self._claim_probe(now)
+            if token is not None:
+                return token
+            retry_after = self._retry_after(now)
+        raise CircuitOpen(self.url, retry_after or 1.0)
+
+    def check(self) -> None:
+        """Raise CircuitOpen nếu mạch không đóng (không chiếm lượt thử): dùng trước khi nhận job
+        (chờ slot, queue) để job fail nhanh hoặc được chuyển sang backend khác."""
+        if not self.available():
+            raise CircuitOpen(self.url, self._retry_after(time.monotonic()) or 1.0)
+
+    def available(self) -> bool:
+        """Router có nên gửi job mới tới backend không: chỉ khi mạch đóng. Mạch mở/half-open
+        được đóng lại bởi call thử (health probe), không phải bởi job được route tới."""
+        if not config.CIRCUIT_BREAKER_ENABLED:
+            return True
+        with self._lock:
+            return self.state == CLOSED
+
+    # ---------- sau mỗi call ----------
+    def record(self, ok: bool, latency: float, op: Optional[str] = None, slow_call: bool = True,
+               token: Optional[object] = None) -> None:
+        """Ghi kết quả một call. `slow_call=False` cho call mà thời gian phụ thuộc kích thước (upload).
+
+        `token`: giá trị before_call()/try_probe() trả về. Ở trạng thái half-open chỉ call giữ
+        probe token quyết định đóng/mở lại mạch; call bắt đầu trước khi mạch mở hay request
+        hedge dự phòng kết thúc lúc này bị bỏ qua.
+        """
+        now = time.monotonic()
+        slow = slow_call and latency > config.CIRCUIT_SLOW_CALL_SECONDS
+        with self._lock:
+            if ok and op is not None:
+                self._latencies.setdefault(op, deque(maxlen=config.HEDGE_SAMPLES)).append(latency)
+            if token is not None:
+                if token is not self._probe_token:
+                    return
+                self._probe_token = None
+                if ok and not slow:
+                    self._close(now)
+                else:
+                    self._open(now, "probe call failed" if not ok else "probe call was slow")
+                return
+            if self.state != CLOSED:
+                return
+            self._calls.append((now, ok, slow))
+            while self._calls and now - self._calls[0][0] > config.CIRCUIT_WINDOW_SECONDS:
+                self._calls.popleft()
+            total = len(self._calls)
+            if total < config.CIRCUIT_MIN_CALLS:
+                return
+            failures = sum(1 for _, success, _ in self._calls if not success)
+            slows = sum(1 for _, _, was_slow in self._calls if was_slow)
+            if failures / total >= config.CIRCUIT_FAILURE_RATE:
+                self._open(now, f"{failures}/{total} calls failed")
+            elif slows / total >= config.CIRCUIT_SLOW_CALL_RATE:
+                self._open(now, f"{slows}/{total} calls slower than {config.CIRCUIT_SLOW_CALL_SECONDS}s")
+
+    def _open(self, now: float, reason: str) -> None:
+        self.state = OPEN
+        self.opened_at = now
+        self.trips += 1
+        self._calls.clear()
+        logger.warning(f"Circuit for {self.url} opened: {reason}; failing fast for {config.CIRCUIT_OPEN_SECONDS}s")
+
+    def _close(self, now: float) -> None:
+        self.state = CLOSED
+        self._calls.clear()
+        logger.info(f"Circuit for {self.url} closed after {now - self.opened_at:.0f}s")
+
+    # ---------- hedging ----------
+    def hedge_delay(self, op: str) -> Optional[float]:
+        """Chờ bao lâu trước khi gửi request dự phòng cho read `op` (None = không hedge).
+
+        Lấy percentile HEDGE_PERCENTILE của latency gần đây, kẹp trong
+        [HEDGE_MIN_DELAY, HEDGE_MAX_DELAY]; chưa đủ mẫu thì dùng HEDGE_MAX_DELAY.
+        Không hedge khi mạch không đóng (không nhân đôi tải lên backend đang có vấn đề).
+        """
+        if not config.HEDGE_ENABLED:
+            return None
+        with self._lock:
+            if self.state != CLOSED:
+                return None
+            samples = sorted(self._latencies.get(op, ()))
+        if len(samples) < config.HEDGE_MIN_SAMPLES:
+            return config.HEDGE_MAX_DELAY
+        index = min(len(samples) - 1, int(len(samples) * config.HEDGE_PERCENTILE / 100))
+        return min(config.HEDGE_MAX_DELAY, max(config.HEDGE_MIN_DELAY, samples[index]))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = len(self._calls)
+            return {
+                "state": self.state,
+                "trips": self.trips,
+                "window_calls": total,
+                "window_failures": sum(1 for _, ok, _ in self._calls if not ok),
+                "retry_after": round(self._retry_after(time.monotonic()), 1) if self.state != CLOSED else 0,
+            }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(server_url: str) -> CircuitBreaker:
+    """Circuit breaker dùng chung cho mỗi backend ComfyUI trong process."""
+    key = server_url.rstrip("/")
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker(key)
+        return breaker
+
+
+def circuit_stats() -> Dict[str, Any]:
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {url: b.stats() for url, b in breakers.items()}
+
+
+_hedge_pool: Optional[ThreadPoolExecutor] = None
+
+
+def _get_hedge_pool() -> ThreadPoolExecutor:
+    global _hedge_pool
+    with _breakers_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(max_workers=config.HEDGE_WORKERS, thread_name_prefix="hedge")
+        return _hedge_pool
+
+
+def _discard(future) -> None:
+    """Kết quả của request thua cuộc: đóng response (stream /view) nếu có."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    close = getattr(future.result(), "close", None)
+    if close is not None:
+        close()
+
+
+def hedged_call(breaker: CircuitBreaker, op: str, fn: Callable[[], Any]) -> Any:
+    """Chạy read idempotent `fn` (I/O đồng bộ); chậm hơn mốc hedge_delay(op) thì gửi thêm một
+    request nữa và lấy kết quả về trước. Request còn lại bị bỏ (response được đóng khi xong).
+
+    Chỉ dùng cho read không có side effect (/view, /history).
+    """
+    delay = breaker.hedge_delay(op)
+    if delay is None:
+        return fn()
+    pool = _get_hedge_pool()
+    futures = [pool.submit(contextvars.copy_context().run, fn)]
+    done, _ = wait(futures, timeout=delay)
+    if not done:
+        logger.debug("Hedging %s on %s after %.2fs", op, breaker.url, delay)
+        futures.append(pool.submit(contextvars.copy_context().run, fn))
+    error: Optional[BaseException] = None
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for other in pending:
+                    if not other.cancel():
+                        other.add_done_callback(_discard)
+                for other in done - {future}:
+                    _discard(other)
+                return future.result()
+            error = error or future.exception()
+    raise error
@@ -6,6 +6,17 @@ import uuid
 import logging
 from typing import Dict, Any, Optional
 from config import config
+from circuit_breaker import CircuitOpen, get_circuit_breaker, hedged_call
+from completion_tracker import get_completion_tracker
+from job_registry import Job, JobCancelled
+from deadline import DeadlineExceeded
+from dispatcher import get_dispatcher
+from log_setup import HOT_PATH, bind_log_context
+from preview_relay import PreviewRelay
+from warmup import get_warmup_manager
+from workflow_templates import (
+    build_restore_workflow, build_inpainting_workflow, pick_result_filename, resolve_parameters,
+)
 
 # websocket-client may not be installed in all environments; import safely
 try:
@@ -15,6 +26,12 @@ except Exception:
 
 logger = logging.getLogger(__name__)
 
+
+def _is_urgent(job: Optional[Job]) -> bool:
+    """Job interactive được queue với `front=True` để không đứng sau prompt bulk trên ComfyUI."""
+    return job is not None and job.priority == "interactive"
+
+
 class ComfyUIClient:
     def __init__(self, server_url: str = None):
         self.server_url = server_url or config.COMFYUI_SERVER_URL
@@ -25,7 +42,7 @@ class ComfyUIClient:
         except Exception:
             self.timeout = 15
 
-    def health_check(self) -> bool:
+    def health_check(self, timeout: Optional[float] = None) -> bool:
         """Kiểm tra khả năng kết nối tới ComfyUI server.
 
         Trả về True nếu kết nối được, False nếu không.
@@ -33,10 +50,48 @@ class ComfyUIClient:
         try:
             # Dùng endpoint nhẹ để kiểm tra (history/0)
             url = f"{self.server_url}/history/0"
-            response = requests.get(url, timeout=self.timeout)
+            response = requests.get(url, timeout=timeout or self.timeout)
             return response.status_code == 200
         except requests.exceptions.RequestException:
             return False
+
+    def _request(self, method: str, path: str, op: Optional[str] = None, slow_call: bool = True,
+                 **kwargs) -> requests.Response:
+        """Gọi HTTP tới backend qua circuit breaker: raise CircuitOpen ngay nếu mạch đang mở,
+        lỗi kết nối/timeout/5xx và call chậm được tính vào tỉ lệ lỗi của backend."""
+        breaker = get_circuit_breaker(self.server_url)
+        token = breaker.before_call()
+        started = time.monotonic()
+        ok = False
+        try:
+            response = requests.request(method, f"{self.server_url.rstrip('/')}{path}", **kwargs)
+            ok = response.status_code < 500
+            return response
+        finally:
+            breaker.record(ok, time.monotonic() - started, op, slow_call, token=token)
+
+    def _read(self, op: str, path: str, **kwargs) -> requests.Response:
+        """GET idempotent (/view, /history) có hedging: chậm hơn percentile latency gần đây thì
+        gửi thêm một request và lấy response về trước (xem circuit_breaker.hedged_call).
+
+        /view phải mở với stream=True: chỉ hedge thời gian tới header/byte đầu, body ảnh full-res
+        (chậm vì kích thước) được tải một lần sau khi đã chọn response.
+        """
+        return hedged_call(get_circuit_breaker(self.server_url), op,
+                           lambda: self._request("GET", path, op=op, **kwargs))
+
+    def _connect_ws(self, ws_url: str):
+        """Mở WebSocket tới backend qua circuit breaker (connect lỗi được tính là lỗi của backend)."""
+        breaker = get_circuit_breaker(self.server_url)
+        token = breaker.before_call()
+        started = time.monotonic()
+        ok = False
+        try:
+            ws = websocket.create_connection(ws_url, timeout=5)
+            ok = True
+            return ws
+        finally:
+            breaker.record(ok, time.monotonic() - started, token=token)
         
     def clear_cache(self) -> bool:
         """Xóa cache và giải phóng VRAM trên ComfyUI server.
@@ -85,31 +140,36 @@ class ComfyUIClient:
             pass
         
         if success:
+            # Model đã bị unload khỏi VRAM → job tiếp theo sẽ cold start
+            get_warmup_manager().mark_cold(self.server_url)
             logger.info("Cache clearing completed successfully")
         else:
             logger.warning("Cache clearing attempted but no endpoints responded successfully")
         
         return success
         
-    def queue_prompt(self, prompt: Dict[str, Any]) -> str:
-        """Gửi prompt đến ComfyUI và nhận về prompt_id"""
+    def queue_prompt(self, prompt: Dict[str, Any], timeout: Optional[float] = None, front: bool = False) -> str:
+        """Gửi prompt đến ComfyUI và nhận về prompt_id (`front=True` để chen lên đầu queue)"""
         try:
             p = {"prompt": prompt, "client_id": self.client_id}
+            if front:
+                p["front"] = True
             
-            response = requests.post(
-                f"{self.server_url}/prompt",
+            response = self._request(
+                "POST", "/prompt",
                 json=p,
                 headers={'Content-Type': 'application/json'},
-                timeout=self.timeout
+                timeout=timeout or self.timeout
             )
             
-            logger.info(f"API Response Status: {response.status_code}")
-            logger.info(f"API Response Headers: {response.headers}")
-            logger.info(f"API Response Text: {response.text}")
-            
+            # Header/body chỉ để debug: format lười ở thread ghi log, không tốn gì khi tắt DEBUG
+            logger.debug("API response %s, headers=%s, body=%s", response.status_code, response.headers,
+                         response.text)
+
             if response.status_code == 200:
                 result = response.json()
                 prompt_id = result['prompt_id']
+                bind_log_context(prompt_id=prompt_id, stage="wait")
                 logger.info(f"Prompt queued successfully with ID: {prompt_id}")
                 return prompt_id
             else:
@@ -125,6 +185,69 @@ class ComfyUIClient:
             raise
     
 
+    def _admit(self, job: Optional[Job], expected_key: str) -> None:
+        """Kiểm tra trước khi queue: job chưa bị hủy và deadline còn đủ cho thời lượng
+        dự kiến của workflow. Job không kịp bị loại ở đây, trước khi tốn GPU."""
+        if job is None:
+            return
+        job.check_cancelled()
+        # Backend đang bị ngắt mạch → fail nhanh, không giữ slot/thread chờ hết timeout
+        get_circuit_breaker(self.server_url).check()
+        needed = get_completion_tracker(self.server_url).expected_duration(expected_key) or 0.0
+        job.check_deadline("queue", needed)
+
+    def _queue_for_job(self, prompt: Dict[str, Any], job: Optional[Job], expected_key: str = "default") -> str:
+        bind_log_context(stage="queue")
+        self._admit(job, expected_key)
+        prompt_id = self.queue_prompt(
+            prompt,
+            timeout=job.timeout_for(self.timeout, "queue") if job else None,
+            front=_is_urgent(job),
+        )
+        if job is not None:
+            job.attach_prompt(self.server_url, prompt_id, workflow=expected_key)
+        return prompt_id
+
+    def cancel_prompt(self, prompt_id: str) -> str:
+        """Hủy prompt trên ComfyUI để giải phóng GPU.
+
+        - Prompt đang chờ trong queue → xóa khỏi queue (POST /queue {"delete": [...]})
+        - Prompt đang chạy → POST /interrupt
+        Trả về 'pending', 'running' hoặc 'not_found'.
+        """
+        queue = self.get_queue_status()
+        running = {item[1] for item in queue.get('queue_running', []) if len(item) > 1}
+        pending = {item[1] for item in queue.get('queue_pending', []) if len(item) > 1}
+
+        if prompt_id in pending:
+            resp = requests.post(f"{self.server_url}/queue", json={"delete": [prompt_id]}, timeout=self.timeout)
+            resp.raise_for_status()
+            logger.info(f"Removed pending prompt {prompt_id} from ComfyUI queue")
+            return "pending"
+        if prompt_id in running:
+            # ComfyUI mới hỗ trợ interrupt theo prompt_id; bản cũ bỏ qua body và ngắt prompt đang chạy
+            resp = requests.post(f"{self.server_url}/interrupt", json={"prompt_id": prompt_id}, timeout=self.timeout)
+            resp.raise_for_status()
+            logger.info(f"Interrupted running prompt {prompt_id} on ComfyUI")
+            return "running"
+        return "not_found"
+
+    def upload_image_bytes(self, image_bytes: bytes, filename: str, timeout: Optional[float] = None) -> str:
+        """Upload ảnh (bytes trong bộ nhớ) lên ComfyUI và trả về tên file duy nhất trên server.
+
+        `timeout` thường là thời gian còn lại của deadline job; None = không giới hạn.
+        """
+        timestamp = int(time.time())
+        uid = uuid.uuid4().hex[:8]
+        base, ext = os.path.splitext(os.path.basename(filename))
+        unique_name = f"{base}_{timestamp}_{uid}{ext}"
+        files = {"image": (unique_name, image_bytes, "application/octet-stream")}
+        # Thời gian upload phụ thuộc kích thước ảnh → không tính là call chậm
+        resp = self._request("POST", "/upload/image", slow_call=False, files=files, timeout=timeout)
+        resp.raise_for_status()
+        logger.info(f"Uploaded image to ComfyUI: {unique_name} ({len(image_bytes)} bytes)")
+        return unique_name
+
     def get_image(self, filename: str, subfolder: str = "", folder_type: str = None) -> bytes:
         """Lấy ảnh từ ComfyUI server"""
         try:
@@ -133,13 +256,14 @@ class ComfyUIClient:
             
             for ft in folder_types:
                 data = {"filename": filename, "subfolder": subfolder, "type": ft}
-                url = f"{self.server_url}/view"
-                
-                response = requests.get(url, params=data, timeout=self.timeout)
-                
-                if response.status_code == 200:
-                    logger.info(f"Found image in {ft} folder: {filename}")
-                    return response.content
+                # stream=True: hedge chỉ tính tới header, body tải một lần từ response được chọn
+                response = self._read("view", "/view", params=data, timeout=self.timeout, stream=True)
+                try:
+                    if response.status_code == 200:
+                        logger.info(f"Found image in {ft} folder: {filename}")
+                        return response.content
+                finally:
+                    response.close()
             
             raise Exception(f"Failed to get image from any folder: {filename}")
                 
@@ -147,10 +271,27 @@ class ComfyUIClient:
             logger.error(f"Error getting image: {str(e)}")
             raise
     
+    def open_image(self, filename: str, subfolder: str = "", folder_type: str = None,
+                   timeout: Optional[float] = None) -> requests.Response:
+        """Mở response /view dạng stream (chưa tải body) — dùng với result_stream.stream_result.
+
+        Như get_image: không chỉ định folder_type thì thử temp (PreviewImage) rồi output (SaveImage).
+        Caller phải close() response.
+        """
+        folder_types = ["temp", "output"] if folder_type is None else [folder_type]
+        for ft in folder_types:
+            params = {"filename": filename, "subfolder": subfolder, "type": ft}
+            response = self._read("view", "/view", params=params, timeout=timeout or self.timeout, stream=True)
+            if response.status_code == 200:
+                logger.info(f"Streaming image from {ft} folder: {filename}")
+                return response
+            response.close()
+        raise Exception(f"Failed to get image from any folder: {filename}")
+
     def get_history(self, prompt_id: str) -> Dict[str, Any]:
         """Lấy lịch sử xử lý của prompt"""
         try:
-            response = requests.get(f"{self.server_url}/history/{prompt_id}", timeout=self.timeout)
+            response = self._read("history", f"/history/{prompt_id}", timeout=self.timeout)
             
             if response.status_code == 200:
                 return response.json()
@@ -161,10 +302,16 @@ class ComfyUIClient:
             logger.error(f"Error getting history: {str(e)}")
             raise
     
+    def get_object_info(self, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Lấy định nghĩa mọi node class mà backend hỗ trợ (GET /object_info)."""
+        response = requests.get(f"{self.server_url}/object_info", timeout=timeout or self.timeout)
+        response.raise_for_status()
+        return response.json()
+
     def get_queue_status(self) -> Dict[str, Any]:
         """Lấy thông tin queue hiện tại của ComfyUI"""
         try:
-            response = requests.get(f"{self.server_url}/queue", timeout=self.timeout)
+            response = self._request("GET", "/queue", timeout=self.timeout)
             
             if response.status_code == 200:
                 return response.json()
@@ -178,85 +325,76 @@ class ComfyUIClient:
     def get_progress(self) -> Dict[str, Any]:
         """Lấy thông tin progress hiện tại của ComfyUI"""
         try:
-            response = requests.get(f"{self.server_url}/progress", timeout=self.timeout)
+            response = self._request("GET", "/progress", timeout=self.timeout)
 
             if response.status_code == 200:
                 try:
                     return response.json()
                 except Exception as e:
-                    logger.warning(f"Progress endpoint returned non-JSON body: {e}; raw={response.text}")
+                    logger.warning("Progress endpoint returned non-JSON body: %s; raw=%s", e, response.text, extra=HOT_PATH)
                     return {}
             else:
                 # Do not raise here; return empty dict and log details so callers can retry gracefully
-                logger.warning(f"Failed to get progress: HTTP {response.status_code}; body={response.text}")
+                logger.warning("Failed to get progress: HTTP %s; body=%s", response.status_code, response.text,
+                               extra=HOT_PATH)
                 return {}
 
         except requests.exceptions.RequestException as e:
             # Network level errors (timeout, connection error) should be logged and returned as empty progress
-            logger.warning(f"Network error getting progress from {self.server_url}/progress: {e}")
+            logger.warning("Network error getting progress from %s/progress: %s", self.server_url, e, extra=HOT_PATH)
             return {}
     
-    def wait_for_completion(self, prompt_id: str, timeout: int = 600) -> Dict[str, Any]:
-        """Đợi cho đến khi xử lý hoàn tất"""
-        start_time = time.time()
-        
-        while time.time() - start_time < timeout:
-            try:
-                history = self.get_history(prompt_id)
-                
-                if prompt_id in history:
-                    prompt_data = history[prompt_id]
-                    
-                    if 'status' in prompt_data:
-                        status = prompt_data['status']
-                        
-                        if status.get('status_str') == 'success':
-                            return prompt_data
-                        elif status.get('status_str') == 'error':
-                            error_message = status.get('messages', ['Unknown error'])
-                            raise Exception(f"ComfyUI processing failed: {error_message}")
-                
-                time.sleep(2)  # Đợi 2 giây trước khi kiểm tra lại
-                
-            except Exception as e:
-                logger.error(f"Error waiting for completion: {str(e)}")
-                raise
-        
-        raise Exception(f"Timeout waiting for ComfyUI completion after {timeout} seconds")
+    def wait_for_completion(self, prompt_id: str, timeout: int = 600, expected_key: str = "default",
+                            job: Optional[Job] = None) -> Dict[str, Any]:
+        """Đợi cho đến khi xử lý hoàn tất.
+
+        Dùng CompletionTracker dùng chung của backend: một request /queue (+ /history)
+        mỗi chu kỳ cho mọi job đang chờ, chu kỳ thích ứng theo thời lượng dự kiến
+        của `expected_key` (tên workflow).
+        """
+        try:
+            if job is not None:
+                timeout = job.timeout_for(timeout, "wait")
+            return get_completion_tracker(self.server_url).wait(
+                prompt_id, timeout=timeout, expected_key=expected_key,
+                cancel_event=job.cancel_event if job else None,
+            )
+        except (JobCancelled, DeadlineExceeded):
+            raise
+        except Exception as e:
+            logger.error(f"Error waiting for completion: {str(e)}")
+            raise
     
-    def wait_for_completion_with_progress(self, prompt_id: str, progress_callback=None, timeout: int = 600) -> Dict[str, Any]:
-        """Đợi cho đến khi xử lý hoàn tất với callback để hiển thị progress"""
+    def _preview_relay(self, job: Optional[Job], preview_callback=None,
+                       prompt_id: Optional[str] = None) -> Optional[PreviewRelay]:
+        """Relay latent preview tới job (GET /jobs/{job_id}/preview) và preview_callback; None nếu không ai nhận."""
+        if job is None and preview_callback is None:
+            return None
+
+        def _on_frame(frame: Dict[str, Any]) -> None:
+            if job is not None:
+                job.set_preview(frame)
+            if preview_callback is not None:
+                preview_callback(frame)
+
+        return PreviewRelay(_on_frame, prompt_id=prompt_id)
+
+    def wait_for_completion_with_progress(self, prompt_id: str, progress_callback=None, timeout: int = 600,
+                                          expected_key: str = "default", job: Optional[Job] = None,
+                                          preview_callback=None) -> Dict[str, Any]:
+        """Đợi cho đến khi xử lý hoàn tất với callback để hiển thị progress (và latent preview qua preview_callback)"""
         # First, try to use WebSocket to receive live progress messages from ComfyUI.
         # If websocket-client is not available or WS connection fails, fall back to HTTP polling.
         start_time = time.time()
 
         def _http_polling():
-            # Fallback polling: /progress may not exist on ComfyUI; only poll /history for completion.
-            while time.time() - start_time < timeout:
-                try:
-                    # Check history - tolerate failures here too (log and continue)
-                    try:
-                        history = self.get_history(prompt_id)
-                    except Exception as hist_e:
-                        logger.warning(f"Failed to fetch history during polling: {hist_e}")
-                        history = {}
-
-                    if prompt_id in history:
-                        prompt_data = history[prompt_id]
-                        if 'status' in prompt_data:
-                            status = prompt_data['status']
-                            if status.get('status_str') == 'success':
-                                return prompt_data
-                            elif status.get('status_str') == 'error':
-                                error_message = status.get('messages', ['Unknown error'])
-                                raise Exception(f"ComfyUI processing failed: {error_message}")
-
-                    time.sleep(2)
-                except Exception as e:
-                    logger.error(f"Error waiting for completion (HTTP fallback): {str(e)}")
-                    raise
+            # Fallback polling: /progress may not exist on ComfyUI; wait on the shared
+            # completion tracker (batched /queue + /history) for the remaining time.
+            remaining = max(0.0, timeout - (time.time() - start_time))
+            return self.wait_for_completion(prompt_id, timeout=remaining, expected_key=expected_key, job=job)
 
-            raise Exception(f"Timeout waiting for ComfyUI completion after {timeout} seconds")
+        if job is not None:
+            timeout = job.timeout_for(timeout, "wait")
 
         # If websocket-client is available, try using it to listen to /ws
         if websocket is None:
@@ -276,7 +414,7 @@ class ComfyUIClient:
 
         try:
             # create a blocking WebSocket connection with a small recv timeout
-            ws = websocket.create_connection(ws_url, timeout=5)
+            ws = self._connect_ws(ws_url)
         except Exception as e:
             logger.warning(f"Could not open WebSocket to ComfyUI ({ws_url}): {e}; falling back to HTTP polling")
             return _http_polling()
@@ -286,21 +424,30 @@ class ComfyUIClient:
             ws.settimeout(2)
         except Exception:
             pass
+        relay = self._preview_relay(job, preview_callback, prompt_id)
 
         try:
             while time.time() - start_time < timeout:
+                if job is not None:
+                    job.check_cancelled()
                 try:
                     raw = ws.recv()
                 except websocket.WebSocketTimeoutException:
                     # no message in this interval; continue and check time
                     continue
                 except Exception as e:
-                    logger.warning(f"WebSocket recv error: {e}")
+                    logger.warning("WebSocket recv error: %s", e, extra=HOT_PATH)
                     break
 
                 if not raw:
                     continue
 
+                if isinstance(raw, (bytes, bytearray)):
+                    # Binary frame = latent preview của KSampler, không phải JSON
+                    if relay is not None:
+                        relay.feed(raw)
+                    continue
+
                 try:
                     msg = json.loads(raw)
                 except Exception:
@@ -312,11 +459,13 @@ class ComfyUIClient:
                 # progress messages: {type: 'progress', data: {value, max}}
                 if mtype == 'progress':
                     data = msg.get('data', {})
+                    if job is not None:
+                        job.set_progress(data)
                     if progress_callback:
                         try:
                             progress_callback(data)
                         except Exception as cb_e:
-                            logger.warning(f"progress_callback raised: {cb_e}")
+                            logger.warning("progress_callback raised: %s", cb_e, extra=HOT_PATH)
 
                 # executing messages indicate when nodes/prompt start/finish
                 elif mtype == 'executing':
@@ -329,7 +478,7 @@ class ComfyUIClient:
                             if prompt_id in history:
                                 return history[prompt_id]
                         except Exception as e:
-                            logger.warning(f"Failed to fetch history after WS executing message: {e}")
+                            logger.warning("Failed to fetch history after WS executing message: %s", e, extra=HOT_PATH)
                         # if history fetch failed, still return a success marker
                         return {"status": {"status_str": "success"}}
 
@@ -348,28 +497,53 @@ class ComfyUIClient:
                 pass
 
 
-    def queue_prompt_with_progress(self, prompt: Dict[str, Any], progress_callback=None, timeout: int = 600) -> Dict[str, Any]:
+    def queue_prompt_with_progress(self, prompt: Dict[str, Any], progress_callback=None, timeout: int = 600,
+                                   expected_key: str = "default", job: Optional[Job] = None,
+                                   preview_callback=None) -> Dict[str, Any]:
         """Queue a prompt and listen for progress via WebSocket (preferred).
 
         If WebSocket isn't available or fails, falls back to queue + HTTP polling.
-        Returns the final prompt history dict on success.
+        Returns the final prompt history dict on success. The prompt is only queued
+        once the local dispatcher grants this job a slot (see dispatcher.py).
+        Latent preview frames are throttled and passed to `preview_callback`
+        (and stored on `job`), see preview_relay.py.
         """
+        with get_dispatcher(self.server_url).slot(job):
+            result = self._queue_and_listen(prompt, progress_callback, timeout, expected_key, job, preview_callback)
+        get_warmup_manager().mark_used(self.server_url, expected_key)
+        if job is not None:
+            job.record("completed")
+        return result
+
+    def _queue_and_listen(self, prompt: Dict[str, Any], progress_callback, timeout: float,
+                          expected_key: str, job: Optional[Job], preview_callback=None) -> Dict[str, Any]:
         start_time = time.time()
+        if job is not None:
+            timeout = job.timeout_for(timeout, "wait")
 
         # If websocket-client not available, fall back
         if websocket is None:
             logger.info("websocket-client not installed; falling back to queue + polling")
-            prompt_id = self.queue_prompt(prompt)
-            return self.wait_for_completion_with_progress(prompt_id, progress_callback=progress_callback, timeout=timeout)
+            prompt_id = self._queue_for_job(prompt, job, expected_key)
+            return self.wait_for_completion_with_progress(prompt_id, progress_callback=progress_callback, timeout=timeout,
+                                                          expected_key=expected_key, job=job,
+                                                          preview_callback=preview_callback)
 
-        ws_url = f"{self.server_url.rstrip('/')}/ws?clientId={self.client_id}"
+        # clientId riêng cho mỗi lần chạy: ComfyUI gửi preview/progress theo clientId, dùng
+        # chung một id thì các job chạy song song nhận lẫn preview của nhau
+        client_id = f"{self.client_id}-{uuid.uuid4().hex[:8]}"
+        ws_url = f"{self.server_url.rstrip('/')}/ws?clientId={client_id}"
 
         try:
-            ws = websocket.create_connection(ws_url, timeout=5)
+            ws = self._connect_ws(ws_url)
+        except CircuitOpen:
+            raise
         except Exception as e:
             logger.warning(f"Failed to open WebSocket ({ws_url}): {e}; falling back to queue + polling")
-            prompt_id = self.queue_prompt(prompt)
-            return self.wait_for_completion_with_progress(prompt_id, progress_callback=progress_callback, timeout=timeout)
+            prompt_id = self._queue_for_job(prompt, job, expected_key)
+            return self.wait_for_completion_with_progress(prompt_id, progress_callback=progress_callback, timeout=timeout,
+                                                          expected_key=expected_key, job=job,
+                                                          preview_callback=preview_callback)
 
         try:
             # Ensure quick recv timeout for the listen loop
@@ -379,9 +553,14 @@ class ComfyUIClient:
                 pass
 
             # Now send the prompt to the server
-            p = {"prompt": prompt, "client_id": self.client_id}
+            bind_log_context(stage="queue")
+            self._admit(job, expected_key)
+            p = {"prompt": prompt, "client_id": client_id}
+            if _is_urgent(job):
+                p["front"] = True
             try:
-                resp = requests.post(f"{self.server_url}/prompt", json=p, timeout=self.timeout)
+                resp = self._request("POST", "/prompt", json=p,
+                                     timeout=job.timeout_for(self.timeout, "queue") if job else self.timeout)
                 resp.raise_for_status()
             except Exception as e:
                 logger.error(f"Failed to queue prompt via HTTP after WS opened: {e}")
@@ -394,21 +573,33 @@ class ComfyUIClient:
                 logger.error(f"Failed to parse prompt response: {e}; text={resp.text}")
                 raise
 
+            bind_log_context(prompt_id=prompt_id, stage="wait")
             logger.info(f"Queued prompt {prompt_id}, listening for progress via WebSocket")
+            if job is not None:
+                job.attach_prompt(self.server_url, prompt_id, workflow=expected_key)
+            relay = self._preview_relay(job, preview_callback, prompt_id)
 
             # Listen for messages until completion or timeout
             while time.time() - start_time < timeout:
+                if job is not None:
+                    job.check_cancelled()
                 try:
                     raw = ws.recv()
                 except websocket.WebSocketTimeoutException:
                     continue
                 except Exception as e:
-                    logger.warning(f"WebSocket recv error: {e}")
+                    logger.warning("WebSocket recv error: %s", e, extra=HOT_PATH)
                     break
 
                 if not raw:
                     continue
 
+                if isinstance(raw, (bytes, bytearray)):
+                    # Binary frame = latent preview của KSampler, không phải JSON
+                    if relay is not None:
+                        relay.feed(raw)
+                    continue
+
                 try:
                     msg = json.loads(raw)
                 except Exception:
@@ -418,11 +609,13 @@ class ComfyUIClient:
 
                 if mtype == 'progress':
                     data = msg.get('data', {})
+                    if job is not None:
+                        job.set_progress(data)
                     if progress_callback:
                         try:
                             progress_callback(data)
                         except Exception as cb_e:
-                            logger.warning(f"progress_callback raised: {cb_e}")
+                            logger.warning("progress_callback raised: %s", cb_e, extra=HOT_PATH)
 
                 elif mtype == 'executing':
                     data = msg.get('data', {})
@@ -433,7 +626,7 @@ class ComfyUIClient:
                             if prompt_id in history:
                                 return history[prompt_id]
                         except Exception as e:
-                            logger.warning(f"Failed to fetch history after executing WS msg: {e}")
+                            logger.warning("Failed to fetch history after executing WS msg: %s", e, extra=HOT_PATH)
                         return {"status": {"status_str": "success"}}
 
                 else:
@@ -448,164 +641,131 @@ class ComfyUIClient:
                 pass
     
 
-    def process_image_recovery(self, input_image_path: str, prompt: str, 
-                             strength: float = 0.8, steps: int = 20, 
-                             guidance_scale: float = 7.5, seed: Optional[int] = None,
-                             progress_callback=None) -> str:
-        """Xử lý phục hồi ảnh với ComfyUI sử dụng Restore.json gốc.
-        
-        Chỉ thay đổi:
+    def upload_image_file(self, local_path: str, timeout: Optional[float] = None) -> str:
+        """Upload ảnh từ file local lên ComfyUI, trả về tên file duy nhất trên server."""
+        with open(local_path, "rb") as f:
+            return self.upload_image_bytes(f.read(), local_path, timeout=timeout)
+
+    def run_workflow(self, workflow: Dict[str, Any], progress_callback=None, timeout: int = 600,
+                     workflow_name: str = "default", job: Optional[Job] = None,
+                     preview_callback=None) -> Dict[str, Any]:
+        """Gửi workflow và đợi kết quả (progress qua WebSocket nếu có, fallback queue + polling).
+
+        Nếu có `job`, prompt_id được gắn vào job để có thể hủy, và khi WS lỗi sau
+        khi đã queue thì chỉ chờ tiếp prompt đó thay vì submit lại lên GPU.
+        """
+        with get_dispatcher(self.server_url).slot(job):
+            try:
+                result = self.queue_prompt_with_progress(workflow, progress_callback=progress_callback, timeout=timeout,
+                                                         expected_key=workflow_name, job=job,
+                                                         preview_callback=preview_callback)
+                logger.info("Workflow completed successfully (via WS)")
+            except (JobCancelled, DeadlineExceeded):
+                raise
+            except Exception as e:
+                logger.warning(f"WS progress flow failed: {e}; falling back to queue + polling")
+                if job is not None and job.prompt_id:
+                    prompt_id = job.prompt_id
+                else:
+                    prompt_id = self._queue_for_job(workflow, job, workflow_name)
+                logger.info(f"Waiting for prompt {prompt_id} via polling...")
+                result = self.wait_for_completion(prompt_id, timeout=timeout, expected_key=workflow_name, job=job)
+                get_warmup_manager().mark_used(self.server_url, workflow_name)
+                if job is not None:
+                    job.record("completed")
+        return result
+
+    def run_restore(self, image_filename: str, prompt: str, progress_callback=None,
+                    job: Optional[Job] = None, preset: Optional[str] = None,
+                    params: Optional[Dict[str, Any]] = None, preview_callback=None) -> str:
+        """Chạy Restore.json với ảnh đã upload sẵn lên ComfyUI. Trả về tên file kết quả."""
+        workflow = build_restore_workflow(image_filename, prompt, preset=preset, params=params)
+        result = self.run_workflow(workflow, progress_callback=progress_callback, workflow_name="restore", job=job,
+                                   preview_callback=preview_callback)
+        return pick_result_filename("restore", result)
+
+    def run_inpainting(self, image1_filename: str, prompt: str,
+                       image2_filename: Optional[str] = None,
+                       image3_filename: Optional[str] = None,
+                       progress_callback=None, job: Optional[Job] = None,
+                       preset: Optional[str] = None,
+                       params: Optional[Dict[str, Any]] = None,
+                       preview_callback=None) -> str:
+        """Chạy Inpainting.json với các ảnh đã upload sẵn lên ComfyUI. Trả về tên file kết quả."""
+        workflow = build_inpainting_workflow(image1_filename, prompt, image2_filename, image3_filename,
+                                             preset=preset, params=params)
+        result = self.run_workflow(workflow, progress_callback=progress_callback, workflow_name="inpaint", job=job,
+                                   preview_callback=preview_callback)
+        return pick_result_filename("inpaint", result)
+
+    def process_image_recovery(self, input_image_path: str, prompt: str,
+                             strength: Optional[float] = None, steps: Optional[int] = None,
+                             guidance_scale: Optional[float] = None, seed: Optional[int] = None,
+                             progress_callback=None, job: Optional[Job] = None,
+                             preset: Optional[str] = None, preview_callback=None) -> str:
+        """Xử lý phục hồi ảnh với ComfyUI sử dụng Restore.json.
+
+        Thay đổi:
         - Node 75 (LoadImage): filename ảnh input
         - Node 60 (StringFunction|pysssss): text_b prompt
-        
+        - Preset và các tham số được truyền (None = giữ giá trị của preset/template),
+          ánh xạ vào node theo PARAM_BINDINGS["restore"]
+
         Args:
             input_image_path: Đường dẫn ảnh input
             prompt: Prompt từ user
-            strength: Không sử dụng (giữ nguyên workflow gốc)
-            steps: Không sử dụng (giữ nguyên workflow gốc)
-            guidance_scale: Không sử dụng (giữ nguyên workflow gốc)
-            seed: Không sử dụng (giữ nguyên workflow gốc)
-            
+            strength: LIKELINESS (strength ControlNet, node 61)
+            steps: Số bước của cả 2 KSampler
+            guidance_scale: FluxGuidance (node 80)
+            seed: Seed của cả 2 KSampler
+            job: Job tương ứng (tùy chọn) để có thể hủy prompt
+            preset: Tên preset ("draft", "full"; mặc định "full")
+            preview_callback: Callback đồng bộ nhận frame preview (xem PreviewRelay)
+
+        Raises:
+            ValueError: preset/tham số không hợp lệ (kiểm tra trước khi upload ảnh)
+
         Returns:
             Tên file ảnh kết quả trên ComfyUI server
         """
         try:
-            logger.info(f"=== PROCESSING IMAGE RECOVERY ===")
-            logger.info(f"Input image path: {input_image_path}")
-            logger.info(f"User prompt: '{prompt}'")
-            logger.info("Using original Restore.json parameters (no changes to seed, steps, cfg, guidance)")
+            bind_log_context(stage="upload")
+            logger.info(f"Processing image recovery (preset={preset}): {input_image_path}")
+            params = {"strength": strength, "steps": steps, "guidance_scale": guidance_scale, "seed": seed}
+            # Kiểm tra preset/tham số trước khi upload ảnh (ValueError)
+            resolved = resolve_parameters('restore', preset, params)
+            logger.debug("User prompt: %r, workflow parameters: %s", prompt, resolved)
 
             # 1) Upload ảnh lên ComfyUI server với unique filename
             if not input_image_path:
                 raise Exception("input_image_path is required")
             
-            # Tạo unique filename để tránh conflict
-            import time
-            import uuid
-            timestamp = int(time.time())
-            unique_id = str(uuid.uuid4())[:8]
-            original_filename = os.path.basename(input_image_path)
-            name, ext = os.path.splitext(original_filename)
-            unique_filename = f"{name}_{timestamp}_{unique_id}{ext}"
-            
-            # Upload lên ComfyUI server
-            url = f"{self.server_url.rstrip('/')}/upload/image"
             with open(input_image_path, "rb") as f:
-                files = {"image": (unique_filename, f, "application/octet-stream")}
-                response = requests.post(url, files=files)
-                response.raise_for_status()
-            
-            # Kiểm tra response để đảm bảo upload thành công
-            logger.info(f"Upload response status: {response.status_code}")
-            logger.info(f"Upload response text: {response.text}")
+                image_bytes = f.read()
+            image_filename = self.upload_image_bytes(
+                image_bytes, input_image_path, timeout=job.timeout_for(None, "upload") if job else None)
             
-            image_filename = unique_filename
-            logger.info(f"Uploaded image with unique name: {image_filename}")
-            
-            # Kiểm tra xem file có tồn tại trên ComfyUI không
-            try:
-                check_url = f"{self.server_url}/view"
-                check_params = {"filename": image_filename, "type": "input"}
-                check_response = requests.get(check_url, params=check_params, timeout=5)
-                if check_response.status_code == 200:
-                    logger.info(f"✅ File {image_filename} exists on ComfyUI server")
-                else:
-                    logger.warning(f"⚠️ File {image_filename} not found on ComfyUI server")
-            except Exception as e:
-                logger.warning(f"Could not verify file existence: {e}")
+            # Kiểm tra xem file có tồn tại trên ComfyUI không (chỉ để debug: thêm một round trip /view)
+            if logger.isEnabledFor(logging.DEBUG):
+                try:
+                    check_url = f"{self.server_url}/view"
+                    check_params = {"filename": image_filename, "type": "input"}
+                    check_response = requests.get(check_url, params=check_params, timeout=5)
+                    if check_response.status_code == 200:
+                        logger.debug("File %s exists on ComfyUI server", image_filename)
+                    else:
+                        logger.warning(f"⚠️ File {image_filename} not found on ComfyUI server")
+                except Exception as e:
+                    logger.warning(f"Could not verify file existence: {e}")
             
             # 2) Upload backup lên Firebase Storage để lưu trữ
-            try:
-                with open(input_image_path, "rb") as f:
-                    image_bytes = f.read()
-                
-                from storage_service import get_storage_service
-                storage = get_storage_service()
-                
-                # Upload backup với path: input/{unique_filename}
-                firebase_path = f"input/{unique_filename}"
-                import asyncio
-                image_url = asyncio.run(storage.upload_image(
-                    image_bytes, 
-                    firebase_path, 
-                    content_type="image/jpeg"
-                ))
-                
-                logger.info(f"Backup uploaded to Firebase: {firebase_path}")
-                logger.info(f"Firebase URL: {image_url}")
-            except Exception as e:
-                logger.warning(f"Failed to upload backup to Firebase: {e}")
+            self.backup_input_image(image_bytes, image_filename)
 
-            # 3) Đọc workflow gốc từ Restore.json (tạo bản copy mới mỗi lần)
-            with open("workflows/Restore.json", "r", encoding="utf-8") as f:
-                workflow = json.loads(f.read())  # Đảm bảo tạo object mới
-            
-            # 4) Chỉ thay đổi 2 thứ: ảnh input và prompt
-            # Lưu filename cũ để debug
-            old_filename = workflow["75"]["inputs"]["image"]
-            workflow["75"]["inputs"]["image"] = image_filename  # Sử dụng ComfyUI filename
-            workflow["60"]["inputs"]["text_b"] = prompt
-            
-            logger.info(f"Updated LoadImage node 75: '{old_filename}' -> '{image_filename}'")
-            logger.info(f"Updated StringFunction node 60 with prompt: {prompt}")
-            logger.info(f"Workflow contains {len(workflow)} nodes")
-            
-            # Debug: Kiểm tra node 75 có đúng không
-            logger.info(f"Node 75 inputs: {workflow['75']['inputs']}")
-
-            # 5) Gửi workflow và đợi kết quả (kèm progress qua WebSocket nếu có)
-            try:
-                result = self.queue_prompt_with_progress(workflow, progress_callback=progress_callback, timeout=600)
-                logger.info("Workflow completed successfully (via WS)")
-            except Exception as e:
-                # Fallback: queue + polling
-                logger.warning(f"WS progress flow failed: {e}; falling back to queue + polling")
-                prompt_id = self.queue_prompt(workflow)
-                logger.info(f"Queued prompt {prompt_id}, waiting for completion via polling...")
-                result = self.wait_for_completion(prompt_id, timeout=600)
-
-            # 6) Lấy ảnh kết quả
-            outputs = result.get("outputs", {}) or {}
-            preferred = None
-            fallback = None
-            any_image = None
-            
-            for node_id, out in outputs.items():
-                if not isinstance(out, dict):
-                    continue
-                images = out.get("images") or []
-                if not images:
-                    continue
-                filename = images[0].get("filename")
-                if not filename:
-                    continue
-                
-                # Lưu ảnh đầu tiên làm fallback
-                if any_image is None:
-                    any_image = (node_id, filename)
-                
-                # Ưu tiên node 18 (RESULT)
-                if str(node_id) == "18":
-                    preferred = (node_id, filename)
-                
-                # Fallback không phải node 19 (ORIGINAL)
-                if str(node_id) != "19" and fallback is None:
-                    fallback = (node_id, filename)
-
-            result_filename = None
-            if preferred:
-                logger.info(f"Using RESULT from node {preferred[0]}: {preferred[1]}")
-                result_filename = preferred[1]
-            elif fallback:
-                logger.info(f"Using non-ORIGINAL image from node {fallback[0]}: {fallback[1]}")
-                result_filename = fallback[1]
-            elif any_image:
-                logger.info(f"Using first available image from node {any_image[0]}: {any_image[1]}")
-                result_filename = any_image[1]
-            else:
-                raise Exception("Không tìm thấy ảnh output trong kết quả.")
+            # 3) Gửi workflow (chỉ thay ảnh input và prompt) và lấy ảnh kết quả
+            result_filename = self.run_restore(image_filename, prompt, progress_callback=progress_callback, job=job,
+                                               preset=preset, params=params, preview_callback=preview_callback)
             
-            # 7) Clear cache để giải phóng VRAM cho lần xử lý tiếp theo
+            # 4) Clear cache để giải phóng VRAM cho lần xử lý tiếp theo
             try:
                 logger.info("Clearing cache to free VRAM...")
                 self.clear_cache()
@@ -618,10 +778,28 @@ class ComfyUIClient:
             logger.error(f"Error processing image recovery: {str(e)}")
             raise
 
+    def backup_input_image(self, image_bytes: bytes, image_filename: str) -> None:
+        """Upload backup ảnh input lên storage (path: input/{image_filename}). Lỗi chỉ log warning."""
+        try:
+            from storage_service import get_shared_storage_service
+            storage = get_shared_storage_service()
+            
+            firebase_path = f"input/{image_filename}"
+            # Chạy trong thread worker: upload đồng bộ thay vì dựng event loop riêng bằng asyncio.run
+            image_url = storage.upload_image_sync(image_bytes, firebase_path, content_type="image/jpeg")
+            
+            logger.info(f"Backup uploaded to Firebase: {firebase_path}")
+            logger.info(f"Firebase URL: {image_url}")
+        except Exception as e:
+            logger.warning(f"Failed to upload backup to Firebase: {e}")
+
     def process_inpainting(self, input_image_path: str, prompt: str,
                            ref_image2_path: Optional[str] = None,
                            ref_image3_path: Optional[str] = None,
-                           progress_callback=None) -> str:
+                           progress_callback=None, job: Optional[Job] = None,
+                           preset: Optional[str] = None,
+                           params: Optional[Dict[str, Any]] = None,
+                           preview_callback=None) -> str:
         """Xử lý inpainting với ComfyUI sử dụng workflows/Inpainting.json.
 
         Thay đổi tối thiểu:
@@ -635,110 +813,41 @@ class ComfyUIClient:
             ref_image2_path: Ảnh tham chiếu 2 (tùy chọn)
             ref_image3_path: Ảnh tham chiếu 3 (tùy chọn)
             progress_callback: Callback đồng bộ nhận dict tiến độ
+            job: Job tương ứng (tùy chọn) để có thể hủy prompt
+            preset: Tên preset ("draft", "full"; mặc định "full")
+            params: Tham số ghi đè theo PARAM_BINDINGS["inpaint"] (steps, guidance_scale, megapixels, seed)
+            preview_callback: Callback đồng bộ nhận frame preview (xem PreviewRelay)
 
         Returns:
             Tên file ảnh kết quả trên ComfyUI server
         """
         try:
-            logger.info("=== PROCESSING INPAINTING WORKFLOW ===")
-            logger.info(f"Input image path: {input_image_path}")
-            logger.info(f"User prompt: '{prompt}'")
+            bind_log_context(stage="upload")
+            logger.info(f"Processing inpainting (preset={preset}): {input_image_path}")
+            # Kiểm tra preset/tham số trước khi upload ảnh (ValueError)
+            resolved = resolve_parameters('inpaint', preset, params)
+            logger.debug("User prompt: %r, workflow parameters: %s", prompt, resolved)
 
             if not input_image_path:
                 raise Exception("input_image_path is required")
 
-            # Helper: upload a local image to ComfyUI and return unique filename
-            def _upload_image(local_path: str) -> str:
-                timestamp = int(time.time())
-                uid = uuid.uuid4().hex[:8]
-                base, ext = os.path.splitext(os.path.basename(local_path))
-                unique_name = f"{base}_{timestamp}_{uid}{ext}"
-                url = f"{self.server_url.rstrip('/')}/upload/image"
-                with open(local_path, "rb") as f:
-                    files = {"image": (unique_name, f, "application/octet-stream")}
-                    resp = requests.post(url, files=files)
-                    resp.raise_for_status()
-                return unique_name
-
             # 1) Upload ảnh chính và các ảnh tham chiếu (nếu có)
-            image1_filename = _upload_image(input_image_path)
-            image2_filename = _upload_image(ref_image2_path) if ref_image2_path else None
-            image3_filename = _upload_image(ref_image3_path) if ref_image3_path else None
-
-            logger.info(f"Uploaded image1: {image1_filename}")
-            if image2_filename:
-                logger.info(f"Uploaded image2: {image2_filename}")
-            if image3_filename:
-                logger.info(f"Uploaded image3: {image3_filename}")
-
-            # 2) Đọc workflow Inpainting.json
-            with open("workflows/Inpainting.json", "r", encoding="utf-8") as f:
-                workflow = json.loads(f.read())
-
-            # 3) Gán ảnh vào các node tương ứng
-            # Node 78: ảnh chính (LoadImage)
-            if "78" in workflow and "inputs" in workflow["78"]:
-                workflow["78"]["inputs"]["image"] = image1_filename
-            else:
-                logger.warning("Workflow Inpainting.json không có node '78' như kỳ vọng")
-
-            # Node 106 và 108: ảnh tham chiếu (nếu cung cấp)
-            if image2_filename and "106" in workflow and "inputs" in workflow["106"]:
-                workflow["106"]["inputs"]["image"] = image2_filename
-            if image3_filename and "108" in workflow and "inputs" in workflow["108"]:
-                workflow["108"]["inputs"]["image"] = image3_filename
-
-            # 4) Cập nhật prompt cho node 111 (positive prompt)
-            if "111" in workflow and "inputs" in workflow["111"]:
-                workflow["111"]["inputs"]["prompt"] = prompt
-            else:
-                logger.warning("Workflow Inpainting.json không có node '111' như kỳ vọng để set prompt")
-
-            logger.info(f"Prepared Inpainting workflow with {len(workflow)} nodes")
-
-            # 5) Gửi workflow và theo dõi tiến độ
-            try:
-                result = self.queue_prompt_with_progress(workflow, progress_callback=progress_callback, timeout=600)
-                logger.info("Inpainting completed successfully (via WS)")
-            except Exception as e:
-                logger.warning(f"WS progress flow failed: {e}; falling back to queue + polling")
-                prompt_id = self.queue_prompt(workflow)
-                result = self.wait_for_completion(prompt_id, timeout=600)
-
-            # 6) Trích ảnh kết quả
-            outputs = result.get("outputs", {}) or {}
-            preferred = None
-            fallback = None
-            any_image = None
-
-            for node_id, out in outputs.items():
-                if not isinstance(out, dict):
-                    continue
-                images = out.get("images") or []
-                if not images:
-                    continue
-                filename = images[0].get("filename")
-                if not filename:
-                    continue
-
-                # ưu tiên node 8 (VAEDecode) nếu có, kế đến Preview 116
-                if str(node_id) == "8" and preferred is None:
-                    preferred = (node_id, filename)
-                if str(node_id) == "116" and not preferred:
-                    preferred = (node_id, filename)
-                if fallback is None:
-                    fallback = (node_id, filename)
-                if any_image is None:
-                    any_image = (node_id, filename)
-
-            if preferred:
-                return preferred[1]
-            if fallback:
-                return fallback[1]
-            if any_image:
-                return any_image[1]
-
-            raise Exception("Không tìm thấy ảnh output trong kết quả Inpainting.")
+            upload_timeout = job.timeout_for(None, "upload") if job else None
+            image1_filename = self.upload_image_file(input_image_path, timeout=upload_timeout)
+            image2_filename = self.upload_image_file(ref_image2_path, timeout=upload_timeout) if ref_image2_path else None
+            image3_filename = self.upload_image_file(ref_image3_path, timeout=upload_timeout) if ref_image3_path else None
+
+            # 2) Gửi workflow và trích ảnh kết quả
+            result_filename = self.run_inpainting(
+                image1_filename, prompt, image2_filename, image3_filename,
+                progress_callback=progress_callback,
+                job=job,
+                preset=preset,
+                params=params,
+                preview_callback=preview_callback,
+            )
+            logger.info("Inpainting completed successfully")
+            return result_filename
 
         except Exception as e:
             logger.error(f"Error processing inpainting: {str(e)}")
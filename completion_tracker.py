@@ -0,0 +1,170 @@
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from config import config
+from job_registry import JobCancelled
+
+logger = logging.getLogger(__name__)
+
+
+class _Waiter:
+    def __init__(self, prompt_id: str, expected_key: str, expected_duration: float):
+        self.prompt_id = prompt_id
+        self.expected_key = expected_key
+        self.registered_at = time.monotonic()
+        self.expected_done_at = self.registered_at + expected_duration
+        self.event = threading.Event()
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[Exception] = None
+
+
+class CompletionTracker:
+    """Theo dõi hoàn tất của nhiều prompt trên một backend ComfyUI bằng polling gộp.
+
+    Thay vì mỗi job tự poll `/history/{prompt_id}` mỗi 2 giây, một thread nền
+    gọi `/queue` một lần cho tất cả prompt đang chờ; prompt nào không còn trong
+    queue thì lấy kết quả qua một lần `/history?max_items=N`. Chu kỳ poll thích
+    ứng theo thời gian còn lại dự kiến của job gần xong nhất (EWMA thời lượng
+    theo từng loại workflow), và job được đánh thức ngay khi có kết quả.
+    Nhiều nơi có thể chờ cùng một prompt (vd. job_recovery và request đang chạy):
+    tất cả đều được đánh thức.
+    """
+
+    def __init__(self, server_url: str, min_interval: float = None, max_interval: float = None):
+        self.server_url = server_url.rstrip("/")
+        self.min_interval = min_interval if min_interval is not None else config.POLL_MIN_INTERVAL
+        self.max_interval = max_interval if max_interval is not None else config.POLL_MAX_INTERVAL
+        self.timeout = config.HEALTH_PROBE_TIMEOUT * 2
+        self._waiters: Dict[str, List[_Waiter]] = {}
+        self._durations: Dict[str, float] = {}
+        self._cond = threading.Condition()
+        self._session = requests.Session()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---------- API cho job ----------
+    def wait(self, prompt_id: str, timeout: float = 600, expected_key: str = "default",
+             cancel_event: Optional[threading.Event] = None) -> Dict[str, Any]:
+        """Block tới khi prompt hoàn tất; trả về history của prompt hoặc raise lỗi/timeout.
+
+        Nếu `cancel_event` được set trong lúc chờ thì raise JobCancelled.
+        """
+        waiter = _Waiter(prompt_id, expected_key, self._durations.get(expected_key, self.max_interval * 5))
+        with self._cond:
+            self._waiters.setdefault(prompt_id, []).append(waiter)
+            self._ensure_thread()
+            self._cond.notify()
+        deadline = time.monotonic() + timeout
+        try:
+            while not waiter.event.wait(min(0.5, max(0.0, deadline - time.monotonic()))):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise JobCancelled(f"Waiting for prompt {prompt_id} was cancelled")
+                if time.monotonic() >= deadline:
+                    raise Exception(f"Timeout waiting for ComfyUI completion after {timeout} seconds")
+        finally:
+            with self._cond:
+                waiters = self._waiters.get(prompt_id, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if not waiters:
+                    self._waiters.pop(prompt_id, None)
+        if waiter.error is not None:
+            raise waiter.error
+        return waiter.result
+
+    def expected_duration(self, expected_key: str) -> Optional[float]:
+        """Thời lượng (queue + chạy) EWMA của workflow, None nếu chưa đo được."""
+        return self._durations.get(expected_key)
+
+    def pending_count(self) -> int:
+        with self._cond:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+    # ---------- vòng poll nền ----------
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=f"completion-tracker:{self.server_url}", daemon=True)
+            self._thread.start()
+
+    def _next_interval(self) -> float:
+        now = time.monotonic()
+        soonest = min((w.expected_done_at - now for waiters in self._waiters.values() for w in waiters),
+                      default=self.max_interval)
+        return max(self.min_interval, min(self.max_interval, soonest / 2))
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._waiters:
+                    self._cond.wait()
+                pending = {pid: list(waiters) for pid, waiters in self._waiters.items()}
+            try:
+                self._poll_once(pending)
+            except Exception as e:
+                logger.warning(f"Completion poll against {self.server_url} failed: {e}")
+            with self._cond:
+                if self._waiters:
+                    self._cond.wait(self._next_interval())
+
+    def _poll_once(self, pending: Dict[str, List[_Waiter]]) -> None:
+        resp = self._session.get(f"{self.server_url}/queue", timeout=self.timeout)
+        resp.raise_for_status()
+        queue = resp.json() or {}
+        in_queue = {item[1] for key in ("queue_running", "queue_pending") for item in queue.get(key, []) if len(item) > 1}
+        finished = [pid for pid in pending if pid not in in_queue]
+        if not finished:
+            return
+
+        resp = self._session.get(
+            f"{self.server_url}/history",
+            params={"max_items": max(64, len(finished) * 4)},
+            timeout=self.timeout,
+        )
+        resp.raise_for_status()
+        history = resp.json() or {}
+        for pid in finished:
+            data = history.get(pid)
+            if data is None:
+                # Prompt cũ hơn cửa sổ max_items → hỏi riêng
+                r = self._session.get(f"{self.server_url}/history/{pid}", timeout=self.timeout)
+                if r.status_code == 200:
+                    data = (r.json() or {}).get(pid)
+            if data is not None:
+                self._resolve(pending[pid], data)
+
+    def _resolve(self, waiters: List[_Waiter], prompt_data: Dict[str, Any]) -> None:
+        status = prompt_data.get("status") or {}
+        status_str = status.get("status_str")
+        error = None
+        if status_str == "error":
+            error = Exception(f"ComfyUI processing failed: {status.get('messages', ['Unknown error'])}")
+        elif status_str != "success" and not status.get("completed", False):
+            # Có history nhưng chưa xong (hiếm) → đợi vòng sau
+            return
+        else:
+            # Thời lượng đo từ waiter đăng ký sớm nhất (gần lúc queue prompt nhất), mỗi prompt một lần
+            first = min(waiters, key=lambda w: w.registered_at)
+            elapsed = time.monotonic() - first.registered_at
+            prev = self._durations.get(first.expected_key)
+            self._durations[first.expected_key] = elapsed if prev is None else 0.7 * prev + 0.3 * elapsed
+        for waiter in waiters:
+            waiter.error = error
+            waiter.result = prompt_data if error is None else None
+            waiter.event.set()
+
+
+_trackers: Dict[str, CompletionTracker] = {}
+_trackers_lock = threading.Lock()
+
+
+def get_completion_tracker(server_url: str) -> CompletionTracker:
+    """Tracker dùng chung cho mỗi backend ComfyUI trong process."""
+    key = server_url.rstrip("/")
+    with _trackers_lock:
+        tracker = _trackers.get(key)
+        if tracker is None:
+            tracker = _trackers[key] = CompletionTracker(key)
+        return tracker
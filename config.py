@@ -1,13 +1,26 @@
 import os
 from dotenv import load_dotenv
-from typing import List
+from typing import Dict, List
 
 load_dotenv()
 
+
+def _parse_mapping(value: str) -> Dict[str, str]:
+    """Đọc biến môi trường dạng "a:x,b:y" thành dict {"a": "x", "b": "y"}."""
+    mapping = {}
+    for item in value.split(","):
+        key, sep, val = item.strip().rpartition(":")
+        if sep and key:
+            mapping[key.strip()] = val.strip()
+    return mapping
+
+
 class Config:
     # ComfyUI Configuration
     COMFYUI_SERVER_URL = os.getenv("COMFYUI_SERVER_URL", "http://localhost:8188")
     COMFYUI_CLIENT_ID = os.getenv("COMFYUI_CLIENT_ID", "comfyui_client")
+    # Danh sách backend ComfyUI (phân tách bằng dấu phẩy); mặc định chỉ dùng COMFYUI_SERVER_URL
+    COMFYUI_SERVER_URLS = [u.strip() for u in os.getenv("COMFYUI_SERVER_URLS", COMFYUI_SERVER_URL).split(",") if u.strip()]
     
     # Firebase Configuration
     FIREBASE_CREDENTIALS_PATH = os.getenv("FIREBASE_CREDENTIALS_PATH")
@@ -18,9 +31,60 @@ class Config:
     API_PORT = int(os.getenv("API_PORT", "8000"))
     MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", "10"))
     ALLOWED_EXTENSIONS = os.getenv("ALLOWED_EXTENSIONS", "jpg,jpeg,png,webp").split(",")
+    # run_api.py: số worker process và thời gian tối đa chờ job đang chạy khi tắt server
+    API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+    API_SHUTDOWN_GRACE = float(os.getenv("API_SHUTDOWN_GRACE", "120"))
+    
+    # Upload lên storage: số worker, ngưỡng dùng resumable upload, cách public ảnh
+    STORAGE_UPLOAD_WORKERS = int(os.getenv("STORAGE_UPLOAD_WORKERS", "4"))
+    STORAGE_RESUMABLE_THRESHOLD = int(os.getenv("STORAGE_RESUMABLE_THRESHOLD", str(5 * 1024 * 1024)))
+    # Phải là bội số của 256 KB
+    STORAGE_CHUNK_SIZE = int(os.getenv("STORAGE_CHUNK_SIZE", str(4 * 1024 * 1024)))
+    # Stream ảnh kết quả từ /view tới file tạm + storage (+ HTTP): kích thước chunk và số chunk đệm mỗi sink
+    RESULT_STREAM_CHUNK_SIZE = int(os.getenv("RESULT_STREAM_CHUNK_SIZE", str(256 * 1024)))
+    RESULT_STREAM_QUEUE = int(os.getenv("RESULT_STREAM_QUEUE", "8"))
+    RESULT_STREAM_STALL_TIMEOUT = float(os.getenv("RESULT_STREAM_STALL_TIMEOUT", "60"))
+    # Chế độ return=image: vẫn upload ảnh lên storage (song song, không nằm trên đường trả kết quả)
+    DIRECT_RESPONSE_STORE = os.getenv("DIRECT_RESPONSE_STORE", "true").lower() in ("1", "true", "yes")
+    # "object": gắn ACL publicRead lúc upload; "bucket": bucket đã public (uniform access)
+    STORAGE_PUBLIC_ACCESS = os.getenv("STORAGE_PUBLIC_ACCESS", "object")
+    
+    # Local storage (khi không có Firebase): thư mục kho và URL public của API phục vụ /files
+    LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "output_images")
+    LOCAL_STORAGE_PUBLIC_URL = os.getenv("LOCAL_STORAGE_PUBLIC_URL", f"http://localhost:{API_PORT}")
+    
+    # Ảnh preview gửi trước khi có ảnh full-res
+    PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", "1280"))
+    PREVIEW_FORMAT = os.getenv("PREVIEW_FORMAT", "JPEG")
+    PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "80"))
+
+    # Định dạng ảnh kết quả (png/webp/jpeg/avif): client chọn bằng tham số output_format hoặc header Accept.
+    # Ảnh PNG gốc luôn được lưu; biến thể được transcode trong process pool và cache theo dung lượng
+    OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "png")
+    OUTPUT_QUALITY = int(os.getenv("OUTPUT_QUALITY", "90"))
+    TELEGRAM_OUTPUT_FORMAT = os.getenv("TELEGRAM_OUTPUT_FORMAT", "jpeg")
+    TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "2"))
+    TRANSCODE_CACHE_MB = int(os.getenv("TRANSCODE_CACHE_MB", "128"))
+    
+    # Giữ các node PreviewImage không dùng tới trong workflow (debug / xem ảnh so sánh)
+    KEEP_PREVIEW_NODES = os.getenv("KEEP_PREVIEW_NODES", "false").lower() in ("1", "true", "yes")
+    
+    # Latent preview trong lúc sampling (binary frame trên /ws, cần chạy ComfyUI với --preview-method)
+    # Tối đa 1 frame mỗi PREVIEW_FRAME_INTERVAL giây; 0 = chuyển tiếp mọi frame
+    PREVIEW_FRAME_INTERVAL = float(os.getenv("PREVIEW_FRAME_INTERVAL", "1.0"))
+    # Bot: hiển thị preview bằng một tin nhắn ảnh được edit liên tục (Telegram giới hạn tần suất edit)
+    TELEGRAM_LIVE_PREVIEW = os.getenv("TELEGRAM_LIVE_PREVIEW", "true").lower() in ("1", "true", "yes")
+    TELEGRAM_PREVIEW_INTERVAL = float(os.getenv("TELEGRAM_PREVIEW_INTERVAL", "3.0"))
     
     # Logging
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    # Log đi qua hàng đợi tới một thread riêng; hàng đợi đầy thì bỏ dòng log thay vì chặn request
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+    # Call site tần suất cao (progress/preview, extra=HOT_PATH) ghi tối đa LOG_RATE_LIMIT dòng mỗi
+    # LOG_RATE_WINDOW giây; 0 = không giới hạn
+    LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "20"))
+    LOG_RATE_WINDOW = float(os.getenv("LOG_RATE_WINDOW", "10"))
+    LOG_JSON = os.getenv("LOG_JSON", "false").lower() in ("1", "true", "yes")
     
     # Storage backend - chỉ sử dụng Firebase
     STORAGE_BACKEND = "firebase"
@@ -28,5 +92,93 @@ class Config:
     # Telegram Bot Configuration
     TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
     API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000")
+    TELEGRAM_DOWNLOAD_RETRIES = int(os.getenv("TELEGRAM_DOWNLOAD_RETRIES", "3"))
+    TELEGRAM_DOWNLOAD_BACKOFF = float(os.getenv("TELEGRAM_DOWNLOAD_BACKOFF", "1.0"))
+
+    # Phân loại workflow (Ollama local + heuristic)
+    OLLAMA_MODEL = os.getenv("OLLAMA_MODEL")
+    OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+    OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "10"))
+    CLASSIFIER_CACHE_SIZE = int(os.getenv("CLASSIFIER_CACHE_SIZE", "1024"))
+    CLASSIFIER_CACHE_TTL = float(os.getenv("CLASSIFIER_CACHE_TTL", "3600"))
+
+    # Health prober chạy nền
+    HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "15"))
+    HEALTH_PROBE_JITTER = float(os.getenv("HEALTH_PROBE_JITTER", "3"))
+    HEALTH_PROBE_TIMEOUT = float(os.getenv("HEALTH_PROBE_TIMEOUT", "3"))
+
+    # Circuit breaker cho từng backend ComfyUI: mở mạch khi trong CIRCUIT_WINDOW_SECONDS có ít nhất
+    # CIRCUIT_MIN_CALLS call và tỉ lệ lỗi (hoặc tỉ lệ call chậm hơn CIRCUIT_SLOW_CALL_SECONDS) vượt ngưỡng;
+    # mạch mở CIRCUIT_OPEN_SECONDS giây rồi half-open cho một call thử
+    CIRCUIT_BREAKER_ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "true").lower() in ("1", "true", "yes")
+    CIRCUIT_WINDOW_SECONDS = float(os.getenv("CIRCUIT_WINDOW_SECONDS", "30"))
+    CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+    CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+    CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "5"))
+    CIRCUIT_SLOW_CALL_RATE = float(os.getenv("CIRCUIT_SLOW_CALL_RATE", "0.8"))
+    CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "20"))
+    # Hedged read (/view, /history): chậm hơn percentile HEDGE_PERCENTILE của latency gần đây
+    # (kẹp trong [HEDGE_MIN_DELAY, HEDGE_MAX_DELAY]) thì gửi thêm một request, lấy kết quả về trước
+    HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() in ("1", "true", "yes")
+    HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+    HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.2"))
+    HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", "3"))
+    HEDGE_SAMPLES = int(os.getenv("HEDGE_SAMPLES", "200"))
+    HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+    HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", "16"))
+
+    # Kiểm tra template với /object_info của từng backend
+    WORKFLOW_VALIDATION_INTERVAL = float(os.getenv("WORKFLOW_VALIDATION_INTERVAL", "600"))
+    WORKFLOW_VALIDATION_TIMEOUT = float(os.getenv("WORKFLOW_VALIDATION_TIMEOUT", "30"))
+
+    # Polling gộp /queue + /history khi không dùng được WebSocket
+    POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "0.25"))
+    POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "2.0"))
+
+    # Deadline mặc định (giây) cho mỗi job theo workflow, khi client không gửi
+    JOB_DEADLINES = {
+        "default": float(os.getenv("JOB_DEADLINE_DEFAULT", "600")),
+        "restore": float(os.getenv("JOB_DEADLINE_RESTORE", "600")),
+        "inpaint": float(os.getenv("JOB_DEADLINE_INPAINT", "600")),
+    }
+    JOB_DEADLINE_MAX = float(os.getenv("JOB_DEADLINE_MAX", "1800"))
+
+    # Job journal (SQLite) để reattach vào prompt sau khi restart; để rỗng để tắt
+    JOB_JOURNAL_PATH = os.getenv("JOB_JOURNAL_PATH", "jobs.db")
+    JOB_RECOVERY_MAX_AGE = float(os.getenv("JOB_RECOVERY_MAX_AGE", "3600"))
+    JOB_RECOVERY_TIMEOUT = float(os.getenv("JOB_RECOVERY_TIMEOUT", "900"))
+    
+    # Warm-up: prompt tổng hợp nhỏ để nạp sẵn model khi khởi động, khi backend hồi phục và sau khi rảnh lâu
+    WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+    WARMUP_WORKFLOWS = [w.strip() for w in os.getenv("WARMUP_WORKFLOWS", "restore,inpaint").split(",") if w.strip()]
+    WARMUP_IDLE_SECONDS = float(os.getenv("WARMUP_IDLE_SECONDS", "1800"))
+    WARMUP_RETRY_INTERVAL = float(os.getenv("WARMUP_RETRY_INTERVAL", "300"))
+    WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "600"))
+    WARMUP_STEPS = int(os.getenv("WARMUP_STEPS", "1"))
+    WARMUP_IMAGE_SIZE = int(os.getenv("WARMUP_IMAGE_SIZE", "64"))
+    # Chỉ process giữ file lock này chạy warm-up (nhiều worker API, bot cùng máy); rỗng = process nào cũng chạy
+    WARMUP_LOCK_PATH = os.getenv("WARMUP_LOCK_PATH", "warmup.lock")
+    
+    # Khôi phục job dang dở khi API khởi động (run_api.py tắt ở worker khi chạy nhiều worker
+    # và khôi phục một lần ở process cha)
+    RECOVER_JOBS_ON_STARTUP = os.getenv("RECOVER_JOBS_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+
+    # Gộp các request giống hệt nhau (cùng ảnh + workflow + prompt) đang chạy đồng thời vào một prompt
+    SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() in ("1", "true", "yes")
+    
+    # Lớp ưu tiên (interactive/standard/bulk) và dispatcher trước queue ComfyUI
+    DISPATCH_MAX_INFLIGHT = int(os.getenv("DISPATCH_MAX_INFLIGHT", "2"))
+    PRIORITY_AGING_SECONDS = float(os.getenv("PRIORITY_AGING_SECONDS", "30"))
+    BOT_PRIORITY = os.getenv("BOT_PRIORITY", "interactive")
+    API_DEFAULT_PRIORITY = os.getenv("API_DEFAULT_PRIORITY", "standard")
+    # "/process-image:bulk,/recover-image:standard"
+    PRIORITY_BY_ENDPOINT = _parse_mapping(os.getenv("PRIORITY_BY_ENDPOINT", ""))
+    # "<api key>:interactive,<api key>:bulk"
+    PRIORITY_BY_API_KEY = _parse_mapping(os.getenv("PRIORITY_BY_API_KEY", ""))
+
+    # Event loop lag monitor (phát hiện code blocking trong bot)
+    LOOP_LAG_THRESHOLD_MS = int(os.getenv("LOOP_LAG_THRESHOLD_MS", "100"))
+    LOOP_LAG_CHECK_INTERVAL = float(os.getenv("LOOP_LAG_CHECK_INTERVAL", "0.5"))
+    LOOP_LAG_DEBUG = os.getenv("LOOP_LAG_DEBUG", "false").lower() in ("1", "true", "yes")
 
 config = Config()
@@ -0,0 +1,83 @@
+import time
+import logging
+from typing import Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(Exception):
+    """Job không còn đủ thời gian cho stage tiếp theo (download/upload/queue/wait/store)."""
+
+    def __init__(self, stage: str, remaining: float, needed: Optional[float] = None):
+        self.stage = stage
+        self.remaining = remaining
+        self.needed = needed
+        if needed is None:
+            msg = f"Deadline exceeded before stage '{stage}'"
+        else:
+            msg = f"Deadline cannot be met at stage '{stage}': {remaining:.1f}s left, ~{needed:.1f}s needed"
+        super().__init__(msg)
+
+
+class Deadline:
+    """Hạn chót của một job, tính bằng monotonic clock.
+
+    Mỗi stage gọi `check()` trước khi bắt đầu và dùng `timeout()` để giới hạn
+    timeout của request bên dưới theo ngân sách còn lại.
+    """
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def check(self, stage: str, needed: float = 0.0) -> None:
+        """Raise DeadlineExceeded nếu đã hết hạn hoặc không còn đủ `needed` giây cho stage."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(stage, remaining)
+        if needed and remaining < needed:
+            raise DeadlineExceeded(stage, remaining, needed)
+
+    def timeout(self, default: Optional[float], stage: str) -> float:
+        """Timeout cho một lời gọi: min(default, thời gian còn lại). Hết hạn → DeadlineExceeded."""
+        self.check(stage)
+        remaining = self.remaining()
+        return remaining if default is None else min(default, remaining)
+
+
+def parse_budget(value) -> Optional[float]:
+    """Đọc deadline từ header/form: số giây còn lại (vd "30") hoặc unix timestamp tuyệt đối.
+
+    Trả về None nếu không có giá trị hoặc không hợp lệ.
+    """
+    if value is None or value == "":
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        logger.warning(f"Ignoring invalid deadline value: {value!r}")
+        return None
+    # Giá trị lớn hơn ~1 năm coi là timestamp tuyệt đối
+    if number > 365 * 24 * 3600:
+        number -= time.time()
+    return number
+
+
+def deadline_for(workflow: str, requested=None) -> Deadline:
+    """Deadline cho job: ưu tiên giá trị client gửi, nếu không dùng mặc định của workflow.
+
+    Luôn bị chặn trên bởi JOB_DEADLINE_MAX.
+    """
+    budget = parse_budget(requested)
+    if budget is None:
+        budget = config.JOB_DEADLINES.get(workflow, config.JOB_DEADLINES["default"])
+    return Deadline(min(budget, config.JOB_DEADLINE_MAX))
@@ -0,0 +1,157 @@
+import time
+import logging
+import threading
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, FrozenSet, List, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Thứ tự ưu tiên: index càng nhỏ càng được phục vụ trước
+PRIORITY_CLASSES = ("interactive", "standard", "bulk")
+DEFAULT_PRIORITY = "standard"
+
+
+# Dispatcher mà task/thread hiện tại đang giữ slot: slot lồng nhau không có job (run_workflow →
+# queue_prompt_with_progress) không lấy thêm slot, tránh tự chặn mình khi DISPATCH_MAX_INFLIGHT=1
+_held_slots: ContextVar[FrozenSet["PromptDispatcher"]] = ContextVar("dispatcher_held_slots", default=frozenset())
+
+
+def normalize_priority(value: Optional[str]) -> str:
+    return value if value in PRIORITY_CLASSES else DEFAULT_PRIORITY
+
+
+class _Ticket:
+    def __init__(self, seq: int, priority: str):
+        self.seq = seq
+        self.priority = priority
+        self.rank = PRIORITY_CLASSES.index(priority)
+        self.enqueued_at = time.monotonic()
+
+    def effective_rank(self, now: float) -> int:
+        # Chống starvation: cứ mỗi PRIORITY_AGING_SECONDS chờ thì được nâng một bậc
+        aged = int((now - self.enqueued_at) // config.PRIORITY_AGING_SECONDS)
+        return max(0, self.rank - aged)
+
+
+class PromptDispatcher:
+    """Hàng đợi ưu tiên cục bộ trước một backend ComfyUI.
+
+    ComfyUI chỉ có một queue FIFO, nên thay vì đẩy mọi prompt vào ngay, mỗi job
+    phải lấy một slot (`slot(job)`) trước khi queue; chỉ `max_inflight` prompt
+    được nằm trên ComfyUI cùng lúc. Slot trống được trao cho job có lớp ưu tiên
+    cao nhất (interactive > standard > bulk), job chờ lâu được nâng bậc dần để
+    không bị bỏ đói. Job interactive được queue với `front=True`.
+    """
+
+    def __init__(self, server_url: str, max_inflight: int = None):
+        self.server_url = server_url
+        self.max_inflight = max(1, max_inflight or config.DISPATCH_MAX_INFLIGHT)
+        self._cond = threading.Condition()
+        self._waiting: List[_Ticket] = []
+        self._holders: Dict[Any, _Ticket] = {}
+        self._seq = itertools.count()
+        self._admitted = {cls: 0 for cls in PRIORITY_CLASSES}
+        self._wait_ewma_ms: Dict[str, float] = {}
+
+    @contextmanager
+    def slot(self, job=None):
+        """Giữ một slot trong suốt thời gian queue + chờ prompt. Lồng nhau (cùng job, hoặc trong
+        cùng context khi không có job) thì không lấy thêm slot."""
+        held = _held_slots.get()
+        with self._cond:
+            nested = self in held or (job is not None and job.job_id in self._holders)
+        if nested:
+            yield
+            return
+        key = job.job_id if job is not None else object()
+        self._acquire(key, job)
+        token = _held_slots.set(held | {self})
+        try:
+            yield
+        finally:
+            _held_slots.reset(token)
+            self._release(key)
+
+    def _next_ticket(self) -> Optional[_Ticket]:
+        if not self._waiting:
+            return None
+        now = time.monotonic()
+        return min(self._waiting, key=lambda t: (t.effective_rank(now), t.seq))
+
+    def _acquire(self, key, job) -> None:
+        priority = normalize_priority(getattr(job, "priority", None))
+        ticket = _Ticket(next(self._seq), priority)
+        with self._cond:
+            self._waiting.append(ticket)
+            try:
+                while not (len(self._holders) < self.max_inflight and self._next_ticket() is ticket):
+                    # Thức dậy định kỳ để kiểm tra hủy/deadline và tính lại aging
+                    self._cond.wait(0.5)
+                    if job is not None:
+                        job.check_cancelled()
+                        job.check_deadline("queue")
+            except BaseException:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+                raise
+            self._waiting.remove(ticket)
+            self._holders[key] = ticket
+            self._admitted[priority] += 1
+            waited_ms = (time.monotonic() - ticket.enqueued_at) * 1000
+            prev = self._wait_ewma_ms.get(priority)
+            self._wait_ewma_ms[priority] = waited_ms if prev is None else 0.8 * prev + 0.2 * waited_ms
+        if waited_ms > 1000:
+            logger.info(f"Dispatched {priority} job to {self.server_url} after waiting {waited_ms:.0f} ms")
+
+    def _release(self, key) -> None:
+        with self._cond:
+            self._holders.pop(key, None)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        """Độ sâu hàng đợi theo lớp ưu tiên và số prompt đang nằm trên ComfyUI."""
+        with self._cond:
+            depth = {cls: 0 for cls in PRIORITY_CLASSES}
+            inflight = {cls: 0 for cls in PRIORITY_CLASSES}
+            for t in self._waiting:
+                depth[t.priority] += 1
+            for t in self._holders.values():
+                inflight[t.priority] += 1
+            return {
+                "max_inflight": self.max_inflight,
+                "queue_depth": depth,
+                "inflight": inflight,
+                "admitted": dict(self._admitted),
+                "avg_wait_ms": {cls: round(ms, 1) for cls, ms in self._wait_ewma_ms.items()},
+            }
+
+
+_dispatchers: Dict[str, PromptDispatcher] = {}
+_dispatchers_lock = threading.Lock()
+
+
+def get_dispatcher(server_url: str) -> PromptDispatcher:
+    """Dispatcher dùng chung cho mỗi backend ComfyUI trong process."""
+    key = server_url.rstrip("/")
+    with _dispatchers_lock:
+        dispatcher = _dispatchers.get(key)
+        if dispatcher is None:
+            dispatcher = _dispatchers[key] = PromptDispatcher(key)
+        return dispatcher
+
+
+def dispatcher_stats() -> Dict[str, Any]:
+    with _dispatchers_lock:
+        dispatchers = dict(_dispatchers)
+    return {url: d.stats() for url, d in dispatchers.items()}
+
+
+def priority_for_request(path: str, api_key: Optional[str]) -> str:
+    """Lớp ưu tiên cho request API: theo API key nếu được cấu hình, rồi theo endpoint."""
+    if api_key and api_key in config.PRIORITY_BY_API_KEY:
+        return normalize_priority(config.PRIORITY_BY_API_KEY[api_key])
+    return normalize_priority(config.PRIORITY_BY_ENDPOINT.get(path, config.API_DEFAULT_PRIORITY))
@@ -0,0 +1,213 @@
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import requests
+
+from config import config
+from comfyui_client import ComfyUIClient
+from circuit_breaker import get_circuit_breaker
+from storage_service import get_shared_storage_service
+from workflow_validator import WorkflowValidator
+from warmup import get_warmup_manager
+
+logger = logging.getLogger(__name__)
+
+
+class HealthProber:
+    """Kiểm tra sức khỏe ComfyUI (từng backend), storage và Ollama ở nền.
+
+    Kết quả được cache kèm timestamp; `/health`, `/status` và bước kiểm tra
+    trước mỗi job chỉ đọc cache (O(1)) thay vì gọi mạng. Chu kỳ probe có jitter
+    để nhiều process không dồn request cùng lúc.
+
+    Backend khỏe còn được kiểm tra template qua /object_info (khi khởi động, định
+    kỳ và mỗi lần hồi phục); backend không chạy được workflow bị loại khỏi routing.
+    Sau đó các workflow được warm-up (warmup.py) và router ưu tiên backend đã warm.
+    """
+
+    def __init__(self, comfy_urls: Optional[List[str]] = None, interval: float = None,
+                 jitter: float = None, timeout: float = None):
+        self.comfy_urls = comfy_urls or list(config.COMFYUI_SERVER_URLS)
+        self.interval = interval if interval is not None else config.HEALTH_PROBE_INTERVAL
+        self.jitter = jitter if jitter is not None else config.HEALTH_PROBE_JITTER
+        self.timeout = timeout if timeout is not None else config.HEALTH_PROBE_TIMEOUT
+        self._state: Dict[str, Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.validator = WorkflowValidator()
+        self.warmup = get_warmup_manager()
+        self._warmup_tasks: Dict[str, asyncio.Task] = {}
+
+    # ---------- vòng lặp nền ----------
+    def start(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        logger.info(f"Health prober started for {len(self.comfy_urls)} ComfyUI backend(s), interval={self.interval}s")
+
+    async def stop(self) -> None:
+        for task in self._warmup_tasks.values():
+            task.cancel()
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.warning(f"Health probe round failed: {e}")
+            await asyncio.sleep(self.interval + random.uniform(0, self.jitter))
+
+    async def probe_all(self) -> None:
+        await asyncio.gather(
+            *(self._probe_comfyui(url) for url in self.comfy_urls),
+            self._probe_storage(),
+            self._probe_ollama(),
+        )
+
+    # ---------- từng loại probe ----------
+    def _record(self, key: str, ok: bool, status: str, latency: Optional[float] = None) -> None:
+        now = time.time()
+        prev = self._state.get(key)
+        changed = prev is None or prev["ok"] != ok
+        self._state[key] = {
+            "ok": ok,
+            "status": status,
+            "checked_at": now,
+            "since": now if changed else prev["since"],
+            "latency_ms": round(latency * 1000, 1) if latency is not None else None,
+        }
+        if changed and prev is not None:
+            log = logger.info if ok else logger.warning
+            log(f"Health of {key} changed: {prev['status']} -> {status}")
+
+    async def _probe_comfyui(self, url: str) -> None:
+        # Mạch của backend đang mở và đã hết thời gian chờ → lần probe này là call thử half-open
+        breaker = get_circuit_breaker(url)
+        token = breaker.try_probe()
+        started = time.monotonic()
+        ok = False
+        try:
+            ok = await asyncio.to_thread(ComfyUIClient(url).health_check, self.timeout)
+            status = "running" if ok else "unreachable"
+        except Exception as e:
+            status = f"error: {e}"
+        finally:
+            if token is not None:
+                breaker.record(ok, time.monotonic() - started, token=token)
+        prev = self._state.get(f"comfyui:{url}")
+        self._record(f"comfyui:{url}", ok, status, time.monotonic() - started)
+        if not ok:
+            return
+        if prev is not None and not prev["ok"]:
+            # Backend vừa khởi động lại: custom node có thể đã thay đổi, model đã bị unload
+            self.validator.invalidate(url)
+            self.warmup.mark_cold(url, restarted=True)
+        if self.validator.is_stale(url):
+            try:
+                await asyncio.to_thread(self.validator.validate_backend, url)
+            except Exception as e:
+                logger.warning(f"Could not validate workflows on {url}: {e}")
+        if config.WARMUP_ENABLED and self.warmup.is_runner():
+            self._schedule_warmup(url)
+
+    def _schedule_warmup(self, url: str) -> None:
+        """Warm-up nền các workflow đang cold (hoặc rảnh quá lâu) trên backend, lần lượt từng cái."""
+        task = self._warmup_tasks.get(url)
+        if task is not None and not task.done():
+            return
+        names = [name for name in self.warmup.workflows
+                 if self.validator.supports(url, name) and self.warmup.needs_warmup(url, name)
+                 and self.warmup.try_begin(url, name)]
+        if not names:
+            return
+
+        async def _warm_all() -> None:
+            for name in names:
+                await asyncio.to_thread(self.warmup.warm, url, name)
+
+        self._warmup_tasks[url] = asyncio.get_running_loop().create_task(_warm_all())
+
+    async def _probe_storage(self) -> None:
+        try:
+            storage = await asyncio.to_thread(get_shared_storage_service)
+            self._record("storage", True, f"initialized ({type(storage).__name__})")
+        except Exception as e:
+            self._record("storage", False, f"error: {e}")
+
+    async def _probe_ollama(self) -> None:
+        if not config.OLLAMA_MODEL:
+            self._record("ollama", True, "disabled")
+            return
+        started = time.monotonic()
+        try:
+            r = await asyncio.to_thread(requests.get, f"{config.OLLAMA_URL.rstrip('/')}/api/tags", timeout=self.timeout)
+            ok = r.status_code == 200
+            status = "running" if ok else f"error_http_{r.status_code}"
+        except Exception as e:
+            ok, status = False, f"error: {e}"
+        self._record("ollama", ok, status, time.monotonic() - started)
+
+    # ---------- đọc trạng thái (O(1), không gọi mạng) ----------
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._state.get(key)
+
+    def is_comfyui_up(self, url: str) -> bool:
+        """False chỉ khi backend đã được probe và biết chắc đang down (chưa probe → lạc quan)."""
+        entry = self._state.get(f"comfyui:{url}")
+        return entry is None or entry["ok"]
+
+    def healthy_backends(self, workflow: Union[str, Sequence[str], None] = None) -> List[str]:
+        """Backend khỏe, không bị ngắt mạch (circuit_breaker.py) và chạy được `workflow` (một tên
+        hoặc danh sách tên, tất cả đều phải chạy được)."""
+        names = [workflow] if isinstance(workflow, str) else list(workflow or [None])
+        return [url for url in self.comfy_urls
+                if self.is_comfyui_up(url) and get_circuit_breaker(url).available()
+                and all(self.validator.supports(url, name) for name in names)]
+
+    def pick_backend(self, workflow: Union[str, Sequence[str], None] = None) -> Optional[str]:
+        """Chọn backend ComfyUI cho một job: backend khỏe (và chạy được workflow), ưu tiên backend
+        đã warm cho workflow đó, rồi theo thứ tự cấu hình."""
+        healthy = self.healthy_backends(workflow)
+        names = [workflow] if isinstance(workflow, str) else list(workflow or [])
+        if names:
+            healthy.sort(key=lambda url: not self.warmup.is_warm(url, names))
+        return healthy[0] if healthy else None
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {key: dict(value) for key, value in self._state.items()}
+
+    def summary(self) -> Dict[str, str]:
+        """Dạng rút gọn {comfyui, storage, ollama} cho /health và /status."""
+        comfy = [self._state.get(f"comfyui:{url}") for url in self.comfy_urls]
+        if any(e and e["ok"] for e in comfy):
+            comfy_status = "running"
+        elif all(e is None for e in comfy):
+            comfy_status = "unknown"
+        else:
+            comfy_status = next(e["status"] for e in comfy if e)
+        return {
+            "comfyui": comfy_status,
+            "storage": (self._state.get("storage") or {}).get("status", "unknown"),
+            "ollama": (self._state.get("ollama") or {}).get("status", "unknown"),
+        }
+
+
+_prober: Optional[HealthProber] = None
+
+
+def get_health_prober() -> HealthProber:
+    """Prober dùng chung trong một process."""
+    global _prober
+    if _prober is None:
+        _prober = HealthProber()
+    return _prober
@@ -0,0 +1,58 @@
+import os
+import logging
+from io import BytesIO
+from typing import Tuple, Union
+
+from PIL import Image
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+_CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+def open_image_source(source: Union[bytes, str]):
+    """Ảnh kết quả dạng bytes hoặc đường dẫn file (result_stream.ResultFile.path)."""
+    return Image.open(BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+
+
+def source_size(source: Union[bytes, str]) -> int:
+    return len(source) if isinstance(source, (bytes, bytearray)) else os.path.getsize(source)
+
+
+def make_preview(image_bytes: Union[bytes, str], max_side: int = None, fmt: str = None,
+                 quality: int = None) -> Tuple[bytes, str]:
+    """Tạo ảnh preview nhỏ (JPEG/WebP) từ ảnh kết quả để gửi ngay cho người dùng.
+
+    `image_bytes` có thể là đường dẫn file (đọc từ đĩa, không cần giữ cả ảnh gốc trong RAM).
+    Trả về (bytes, content_type). CPU-bound → gọi qua asyncio.to_thread.
+    """
+    max_side = max_side or config.PREVIEW_MAX_SIDE
+    fmt = (fmt or config.PREVIEW_FORMAT).upper()
+    if fmt not in _CONTENT_TYPES:
+        fmt = "JPEG"
+    quality = quality or config.PREVIEW_QUALITY
+
+    with open_image_source(image_bytes) as img:
+        # reduce() (box filter, số nguyên) rất nhanh để về gần kích thước đích trước khi resample
+        factor = max(img.size) // (max_side * 2)
+        if factor > 1:
+            img = img.reduce(factor)
+        img.thumbnail((max_side, max_side), Image.BILINEAR)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        out = BytesIO()
+        if fmt == "JPEG":
+            img.save(out, "JPEG", quality=quality, optimize=False, progressive=True)
+        else:
+            img.save(out, "WEBP", quality=quality, method=2)
+    data = out.getvalue()
+    logger.info(f"Built {fmt} preview: {source_size(image_bytes)} -> {len(data)} bytes")
+    return data, _CONTENT_TYPES[fmt]
+
+
+def preview_filename(filename: str, content_type: str) -> str:
+    base = os.path.splitext(filename)[0]
+    return f"{base}_preview{'.webp' if content_type == 'image/webp' else '.jpg'}"
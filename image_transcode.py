@@ -0,0 +1,254 @@
+import os
+import asyncio
+import hashlib
+import logging
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional, Tuple, Union
+
+from config import config
+from image_preview import open_image_source, source_size
+
+logger = logging.getLogger(__name__)
+
+# format → (tên format của PIL, content type, đuôi file)
+OUTPUT_FORMATS = {
+    "png": ("PNG", "image/png", ".png"),
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+    "webp": ("WEBP", "image/webp", ".webp"),
+    "avif": ("AVIF", "image/avif", ".avif"),
+}
+_ALIASES = {"jpg": "jpeg"}
+_BY_CONTENT_TYPE = {content_type: name for name, (_, content_type, _) in OUTPUT_FORMATS.items()}
+
+
+def normalize_format(name: Optional[str]) -> Optional[str]:
+    """"WEBP", "jpg", "image/webp" → tên format chuẩn; None nếu không hỗ trợ."""
+    if not name:
+        return None
+    name = name.strip().lower()
+    name = _BY_CONTENT_TYPE.get(name, name)
+    name = _ALIASES.get(name, name)
+    return name if name in OUTPUT_FORMATS else None
+
+
+def _load_avif_plugin() -> bool:
+    try:
+        import pillow_avif  # noqa: F401 — đăng ký encoder AVIF cho Pillow < 11.3
+        return True
+    except ImportError:
+        return False
+
+
+_avif_supported: Optional[bool] = None
+
+
+def avif_supported() -> bool:
+    """Pillow có encoder AVIF (bản mới có sẵn, bản cũ cần `pillow-avif-plugin`)."""
+    global _avif_supported
+    if _avif_supported is None:
+        try:
+            from PIL import features
+            _avif_supported = bool(features.check("avif"))
+        except Exception:
+            _avif_supported = False
+        _avif_supported = _avif_supported or _load_avif_plugin()
+    return _avif_supported
+
+
+def _accept_candidates(accept: str):
+    for index, part in enumerate(accept.split(",")):
+        media, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        fmt = _BY_CONTENT_TYPE.get(media.strip().lower())
+        if fmt and q > 0:
+            yield -q, index, fmt
+
+
+def negotiate_format(requested: Optional[str] = None, accept: Optional[str] = None,
+                     default: Optional[str] = None) -> str:
+    """Chọn định dạng ảnh kết quả: tham số `requested` > header Accept (theo q) > `default`.
+
+    Accept chỉ xét các type ảnh cụ thể (image/webp, image/avif, ...); "*/*", "image/*" hay
+    "application/json" → dùng mặc định. Raises ValueError nếu `requested` không hỗ trợ.
+    """
+    if requested:
+        fmt = normalize_format(requested)
+        if fmt is None:
+            raise ValueError(f"Unsupported output format '{requested}' "
+                             f"(supported: {', '.join(OUTPUT_FORMATS)})")
+        if fmt == "avif" and not avif_supported():
+            raise ValueError("AVIF output is not available on this server (install pillow-avif-plugin)")
+        return fmt
+    if accept:
+        candidates = [c for c in _accept_candidates(accept) if c[2] != "avif" or avif_supported()]
+        if candidates:
+            return min(candidates)[2]
+    fmt = normalize_format(default or config.OUTPUT_FORMAT) or "png"
+    return "webp" if fmt == "avif" and not avif_supported() else fmt
+
+
+def resolve_quality(quality: Optional[int]) -> int:
+    """Chất lượng nén 1–100 (mặc định OUTPUT_QUALITY). Raises ValueError nếu ngoài khoảng."""
+    if quality is None:
+        return config.OUTPUT_QUALITY
+    if not 1 <= int(quality) <= 100:
+        raise ValueError(f"quality must be between 1 and 100, got {quality}")
+    return int(quality)
+
+
+def variant_filename(filename: str, fmt: str) -> str:
+    return f"{os.path.splitext(filename)[0]}{OUTPUT_FORMATS[fmt][2]}"
+
+
+def transcode(image_bytes: Union[bytes, str], fmt: str, quality: int) -> Tuple[bytes, str]:
+    """Chuyển ảnh kết quả (PNG, bytes hoặc đường dẫn file) sang `fmt`. Trả về (bytes, content_type).
+
+    CPU-bound và giữ GIL → gọi qua transcode_async (process pool). Truyền đường dẫn thì
+    process con tự đọc file, không phải pickle cả ảnh qua pipe.
+    """
+    pil_format, content_type, _ = OUTPUT_FORMATS[fmt]
+    if fmt == "avif":
+        _load_avif_plugin()
+    with open_image_source(image_bytes) as img:
+        icc_profile = img.info.get("icc_profile")
+        if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        elif img.mode not in ("RGB", "RGBA", "L", "LA"):
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+
+        kwargs = {"icc_profile": icc_profile} if icc_profile else {}
+        out = BytesIO()
+        if fmt == "png":
+            img.save(out, "PNG", compress_level=6, **kwargs)
+        elif fmt == "jpeg":
+            img.save(out, "JPEG", quality=quality, optimize=True, progressive=True,
+                     subsampling=0 if quality >= 90 else 2, **kwargs)
+        elif fmt == "webp":
+            img.save(out, "WEBP", quality=quality, method=4, **kwargs)
+        else:
+            img.save(out, pil_format, quality=quality, speed=6, **kwargs)
+    return out.getvalue(), content_type
+
+
+def _file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class VariantCache:
+    """LRU các biến thể đã transcode, giới hạn theo tổng dung lượng.
+
+    Key là (sha256 ảnh gốc, format, quality) nên request gộp chung hay gửi lại cùng kết
+    quả không phải nén lại.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[Tuple[str, str, int], Tuple[bytes, str]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[str, str, int]) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item
+
+    def put(self, key: Tuple[str, str, int], item: Tuple[bytes, str]) -> None:
+        if len(item[0]) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+            self._items[key] = item
+            self._size += len(item[0])
+            while self._size > self.max_bytes:
+                _, (data, _) = self._items.popitem(last=False)
+                self._size -= len(data)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._items), "bytes": self._size, "hits": self.hits, "misses": self.misses}
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_cache: Optional[VariantCache] = None
+
+
+def get_variant_cache() -> VariantCache:
+    global _cache
+    with _pool_lock:
+        if _cache is None:
+            _cache = VariantCache(config.TRANSCODE_CACHE_MB * 1024 * 1024)
+        return _cache
+
+
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    if config.TRANSCODE_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=config.TRANSCODE_WORKERS)
+        return _pool
+
+
+def shutdown_transcode_pool() -> None:
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def transcode_async(image_bytes: Union[bytes, str], fmt: str, quality: int,
+                          digest: Optional[str] = None) -> Tuple[bytes, str]:
+    """transcode() trong process pool (TRANSCODE_WORKERS; 0 = thread), có cache biến thể.
+
+    Nguồn là đường dẫn file thì nên truyền `digest` (ResultFile.digest) làm key cache.
+    """
+    if digest is None:
+        digest = (hashlib.sha256(image_bytes).hexdigest() if isinstance(image_bytes, (bytes, bytearray))
+                  else await asyncio.to_thread(_file_digest, image_bytes))
+    key = (digest, fmt, quality)
+    cache = get_variant_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    pool = _get_pool()
+    if pool is None:
+        item = await asyncio.to_thread(transcode, image_bytes, fmt, quality)
+    else:
+        try:
+            item = await asyncio.get_running_loop().run_in_executor(pool, transcode, image_bytes, fmt, quality)
+        except BrokenProcessPool:
+            # Worker bị kill (OOM...) → tạo lại pool ở lần sau, lần này nén trong thread
+            logger.warning("Transcode process pool is broken, recreating it")
+            shutdown_transcode_pool()
+            item = await asyncio.to_thread(transcode, image_bytes, fmt, quality)
+    logger.info(f"Transcoded result to {fmt} (q={quality}): {source_size(image_bytes)} -> {len(item[0])} bytes")
+    cache.put(key, item)
+    return item
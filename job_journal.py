@@ -0,0 +1,181 @@
+import time
+import queue
+import atexit
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Trạng thái kết thúc: job ở các trạng thái khác khi process khởi động lại là job mồ côi
+TERMINAL_STATES = ("stored", "delivered", "failed", "cancelled", "lost", "abandoned")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS job_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    source TEXT,
+    kind TEXT,
+    owner TEXT,
+    state TEXT NOT NULL,
+    backend TEXT,
+    prompt_id TEXT,
+    workflow TEXT,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_job_events_job ON job_events(job_id, id);
+"""
+
+_FIELDS = ("job_id", "ts", "source", "kind", "owner", "state", "backend", "prompt_id", "workflow", "result", "error")
+_INSERT = f"INSERT INTO job_events ({', '.join(_FIELDS)}) VALUES ({', '.join('?' * len(_FIELDS))})"
+
+# Số dòng tối đa thread writer gom vào một transaction
+_WRITE_BATCH = 256
+
+
+class JobJournal:
+    """Nhật ký job append-only trong SQLite.
+
+    Mỗi lần job đổi trạng thái (created → queued → completed → stored/delivered,
+    hoặc failed/cancelled) ghi một dòng chứa toàn bộ thông tin hiện tại của job
+    (backend, prompt_id, workflow, kết quả). Dòng mới nhất của mỗi job là trạng
+    thái hiện tại, đủ để reattach vào prompt sau khi process restart.
+
+    append() không chạm vào SQLite: dòng được đẩy vào hàng đợi và một thread writer
+    riêng ghi xuống (gom nhiều dòng vào một transaction), nên Job.record gọi được
+    thẳng trên event loop. Các hàm đọc chờ writer ghi hết dòng đang chờ trước.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        # None trong hàng đợi = dừng writer (close())
+        self._pending: "queue.Queue[Optional[Tuple]]" = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="job-journal", daemon=True)
+        self._writer.start()
+
+    def append(self, job_id: str, state: str, source: Optional[str] = None, kind: Optional[str] = None,
+               owner: Any = None, backend: Optional[str] = None, prompt_id: Optional[str] = None,
+               workflow: Optional[str] = None, result: Optional[str] = None, error: Optional[str] = None) -> None:
+        row = (job_id, time.time(), source, kind, None if owner is None else str(owner), state,
+               backend, prompt_id, workflow, result, error)
+        if self._writer.is_alive():
+            self._pending.put(row)
+        else:
+            # Writer đã dừng (process đang thoát): ghi đồng bộ
+            self._write([row])
+
+    def _write_loop(self) -> None:
+        while True:
+            row = self._pending.get()
+            rows, stop = [], row is None
+            if row is not None:
+                rows.append(row)
+            while not stop and len(rows) < _WRITE_BATCH:
+                try:
+                    row = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                if row is None:
+                    stop = True
+                else:
+                    rows.append(row)
+            if rows:
+                self._write(rows)
+            for _ in range(len(rows) + stop):
+                self._pending.task_done()
+            if stop:
+                return
+
+    def _write(self, rows: List[Tuple]) -> None:
+        try:
+            with self._lock:
+                self._conn.execute("BEGIN")
+                try:
+                    self._conn.executemany(_INSERT, rows)
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            # Journal hỏng không được làm hỏng job đang chạy
+            jobs = ", ".join(f"{row[0]} ({row[5]})" for row in rows)
+            logger.warning(f"Failed to journal job(s) {jobs}: {e}")
+
+    def flush(self) -> None:
+        """Chờ writer ghi hết các dòng đang chờ (I/O đồng bộ → không gọi trên event loop)."""
+        if self._writer.is_alive():
+            self._pending.join()
+
+    def close(self) -> None:
+        """Ghi nốt các dòng còn trong hàng đợi rồi dừng thread writer."""
+        if self._writer.is_alive():
+            self._pending.put(None)
+            self._writer.join()
+
+    def latest(self, job_id: str) -> Optional[Dict[str, Any]]:
+        self.flush()
+        with self._lock:
+            cur = self._conn.execute(
+                f"SELECT {', '.join(_FIELDS)} FROM job_events WHERE job_id = ? ORDER BY id DESC LIMIT 1",
+                (job_id,),
+            )
+            row = cur.fetchone()
+        return dict(zip(_FIELDS, row)) if row else None
+
+    def history(self, job_id: str) -> List[Dict[str, Any]]:
+        self.flush()
+        with self._lock:
+            cur = self._conn.execute(
+                f"SELECT {', '.join(_FIELDS)} FROM job_events WHERE job_id = ? ORDER BY id",
+                (job_id,),
+            )
+            rows = cur.fetchall()
+        return [dict(zip(_FIELDS, row)) for row in rows]
+
+    def unfinished(self, source: str, max_age: float) -> List[Dict[str, Any]]:
+        """Các job của `source` mà trạng thái mới nhất chưa kết thúc, tạo trong `max_age` giây gần đây."""
+        placeholders = ", ".join("?" * len(TERMINAL_STATES))
+        self.flush()
+        with self._lock:
+            cur = self._conn.execute(
+                f"""
+                SELECT {', '.join('e.' + f for f in _FIELDS)} FROM job_events e
+                JOIN (SELECT job_id, MAX(id) AS last_id FROM job_events GROUP BY job_id) l
+                  ON e.id = l.last_id
+                WHERE e.source = ? AND e.state NOT IN ({placeholders}) AND e.ts >= ?
+                ORDER BY e.id
+                """,
+                (source, *TERMINAL_STATES, time.time() - max_age),
+            )
+            rows = cur.fetchall()
+        return [dict(zip(_FIELDS, row)) for row in rows]
+
+
+_journal: Optional[JobJournal] = None
+_journal_lock = threading.Lock()
+
+
+def get_job_journal() -> Optional[JobJournal]:
+    """Journal dùng chung trong process; None nếu tắt (JOB_JOURNAL_PATH rỗng) hoặc không mở được."""
+    global _journal
+    if not config.JOB_JOURNAL_PATH:
+        return None
+    with _journal_lock:
+        if _journal is None:
+            try:
+                _journal = JobJournal(config.JOB_JOURNAL_PATH)
+            except sqlite3.Error as e:
+                logger.error(f"Could not open job journal at {config.JOB_JOURNAL_PATH}: {e}")
+                return None
+            atexit.register(_journal.close)
+        return _journal
@@ -0,0 +1,93 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from config import config
+from comfyui_client import ComfyUIClient
+from completion_tracker import get_completion_tracker
+from job_journal import get_job_journal
+from storage_service import get_shared_storage_service
+from workflow_templates import RESULT_NODES, pick_result_filename
+
+logger = logging.getLogger(__name__)
+
+# deliver(entry, image_bytes, public_url) — gửi kết quả cho người yêu cầu (vd qua Telegram)
+DeliverFn = Callable[[Dict[str, Any], bytes, Optional[str]], None]
+
+
+def recover_unfinished_jobs(source: str, deliver: Optional[DeliverFn] = None) -> int:
+    """Reattach vào các prompt của job chưa kết thúc trước khi process restart.
+
+    Không submit lại prompt: chỉ chờ prompt cũ trên ComfyUI (qua /queue + /history),
+    lưu kết quả lên storage và gọi `deliver` nếu có. Mỗi job chạy trong một thread
+    nền để không chặn startup. Trả về số job được khôi phục.
+    """
+    journal = get_job_journal()
+    if journal is None:
+        return 0
+    entries = journal.unfinished(source, config.JOB_RECOVERY_MAX_AGE)
+    for entry in entries:
+        threading.Thread(
+            target=_recover_one, args=(entry, deliver),
+            name=f"job-recovery:{entry['job_id']}", daemon=True,
+        ).start()
+    if entries:
+        logger.info(f"Recovering {len(entries)} unfinished {source} job(s) from the journal")
+    return len(entries)
+
+
+def _recover_one(entry: Dict[str, Any], deliver: Optional[DeliverFn]) -> None:
+    journal = get_job_journal()
+    job_id = entry["job_id"]
+    fields = {k: entry[k] for k in ("source", "kind", "owner", "backend", "prompt_id", "workflow")}
+
+    def _record(state: str, result: Optional[str] = None, error: Optional[str] = None) -> None:
+        journal.append(job_id, state, result=result, error=error, **fields)
+
+    prompt_id, backend, workflow = entry["prompt_id"], entry["backend"], entry["workflow"]
+    if not prompt_id or not backend or workflow not in RESULT_NODES:
+        _record("abandoned", error="process restarted before the prompt was queued")
+        return
+
+    client = ComfyUIClient(backend)
+    try:
+        history = client.get_history(prompt_id)
+        if prompt_id in history:
+            result = history[prompt_id]
+        else:
+            queue = client.get_queue_status()
+            queued = {item[1] for key in ("queue_running", "queue_pending")
+                      for item in queue.get(key, []) if len(item) > 1}
+            if prompt_id not in queued:
+                _record("lost", error="prompt not found in ComfyUI queue or history")
+                return
+            logger.info(f"Reattaching job {job_id} to prompt {prompt_id} on {backend}")
+            result = get_completion_tracker(backend).wait(
+                prompt_id, timeout=config.JOB_RECOVERY_TIMEOUT, expected_key=workflow)
+
+        filename = pick_result_filename(workflow, result)
+        image_bytes = client.get_image(filename)
+    except Exception as e:
+        logger.warning(f"Could not recover job {job_id} (prompt {prompt_id}): {e}")
+        _record("failed", error=str(e))
+        return
+
+    public_url = None
+    try:
+        public_url = get_shared_storage_service().upload_image_sync(image_bytes, filename, content_type="image/png")
+        _record("stored", result=public_url)
+    except Exception as e:
+        logger.warning(f"Could not store recovered result of job {job_id}: {e}")
+
+    delivered = False
+    if deliver is not None:
+        try:
+            deliver(entry, image_bytes, public_url)
+            delivered = True
+            _record("delivered", result=public_url or filename)
+        except Exception as e:
+            logger.warning(f"Could not deliver recovered result of job {job_id}: {e}")
+    if public_url is None and not delivered:
+        _record("failed", error="result could not be stored or delivered")
+        return
+    logger.info(f"Recovered job {job_id} from prompt {prompt_id}")
@@ -0,0 +1,249 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from deadline import Deadline
+from job_journal import TERMINAL_STATES, get_job_journal
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    """Job đã bị hủy (client ngắt kết nối, gọi API hủy hoặc user dùng /cancel)."""
+
+
+class Job:
+    """Một yêu cầu xử lý ảnh đang chạy và các tài nguyên gắn với nó."""
+
+    def __init__(self, job_id: str, kind: str, owner: Any = None, backend: Optional[str] = None,
+                 deadline: Optional[Deadline] = None, priority: str = "standard", source: str = "api",
+                 journaled: bool = True):
+        self.job_id = job_id
+        self.kind = kind
+        self.owner = owner
+        self.backend = backend
+        self.deadline = deadline
+        self.priority = priority
+        self.source = source
+        self.prompt_id: Optional[str] = None
+        self.workflow: Optional[str] = None
+        self.state = "created"
+        self.result: Optional[str] = None
+        self.created_at = time.time()
+        self.temp_paths: List[str] = []
+        # Kênh tiến độ: step hiện tại và latent preview mới nhất (GET /jobs/{job_id}/preview)
+        self.progress: Dict[str, Any] = {}
+        self.preview: Optional[Tuple[bytes, str]] = None
+        self.preview_seq = 0
+        # job_id của worker single-flight mà request này đang chờ (single_flight.py)
+        self.coalesced_into: Optional[str] = None
+        # Worker single-flight không ghi journal: prompt/trạng thái được ghi dưới job_id của các
+        # request thành viên (followers) — id mà client đang giữ, để khôi phục và GET /jobs/{id}
+        self.journaled = journaled
+        self._followers: List["Job"] = []
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    @property
+    def cancel_event(self) -> threading.Event:
+        return self._cancel_event
+
+    def check_cancelled(self) -> None:
+        if self.cancelled:
+            raise JobCancelled(f"Job {self.job_id} was cancelled")
+
+    def check_deadline(self, stage: str, needed: float = 0.0) -> None:
+        if self.deadline is not None:
+            self.deadline.check(stage, needed)
+
+    def timeout_for(self, default: Optional[float], stage: str) -> Optional[float]:
+        """Timeout cho stage: `default` bị giới hạn bởi thời gian còn lại của deadline (nếu có)."""
+        if self.deadline is None:
+            return default
+        return self.deadline.timeout(default, stage)
+
+    def add_temp_path(self, path: Optional[str]) -> Optional[str]:
+        if path:
+            self.temp_paths.append(path)
+        return path
+
+    def set_progress(self, data: Dict[str, Any]) -> None:
+        self.progress = {"value": data.get("value", 0), "max": data.get("max", 0), "node": data.get("node")}
+
+    def set_preview(self, frame: Dict[str, Any]) -> None:
+        """Lưu frame preview mới nhất (gọi từ thread WS listener qua PreviewRelay)."""
+        self.preview = (frame["image"], frame["content_type"])
+        self.preview_seq += 1
+
+    def record(self, state: str, result: Optional[str] = None, error: Optional[str] = None) -> None:
+        """Chuyển trạng thái và ghi vào job journal (nếu bật) để khôi phục sau khi restart.
+
+        Không chặn: journal chỉ xếp dòng vào hàng đợi của thread writer, gọi được trên event loop.
+        """
+        self.state = state
+        if result is not None:
+            self.result = result
+        journal = get_job_journal() if self.journaled else None
+        if journal is not None:
+            journal.append(
+                self.job_id, state, source=self.source, kind=self.kind, owner=self.owner,
+                backend=self.backend, prompt_id=self.prompt_id, workflow=self.workflow,
+                result=self.result, error=error,
+            )
+        if state not in TERMINAL_STATES:
+            # Trạng thái kết thúc do từng thành viên tự ghi (mỗi request nhận kết quả riêng)
+            for follower in self.followers():
+                follower.follow(self, state)
+
+    # ---------- single-flight: request thành viên theo prompt của worker ----------
+    def add_follower(self, job: "Job") -> None:
+        with self._lock:
+            self._followers.append(job)
+            prompt_id = self.prompt_id
+        if prompt_id is not None:
+            job.follow(self, "queued")
+
+    def remove_follower(self, job: "Job") -> None:
+        with self._lock:
+            if job in self._followers:
+                self._followers.remove(job)
+
+    def followers(self) -> List["Job"]:
+        with self._lock:
+            return list(self._followers)
+
+    def follow(self, worker: "Job", state: str) -> None:
+        """Ghi prompt và trạng thái của `worker` dưới job_id của request này (không hủy prompt
+        chung: các thành viên khác vẫn chờ nó)."""
+        with self._lock:
+            self.backend = worker.backend
+            self.prompt_id = worker.prompt_id
+            self.workflow = worker.workflow
+            if self.state in TERMINAL_STATES:
+                return
+        self.record(state)
+
+    def attach_prompt(self, backend: str, prompt_id: str, workflow: Optional[str] = None) -> None:
+        """Ghi nhận prompt đã được queue. Nếu job đã bị hủy trước đó thì hủy luôn prompt trên ComfyUI."""
+        with self._lock:
+            self.backend = backend
+            self.prompt_id = prompt_id
+            self.workflow = workflow or self.workflow
+            cancelled = self.cancelled
+        self.record("queued")
+        if cancelled:
+            self._cancel_remote()
+            raise JobCancelled(f"Job {self.job_id} was cancelled")
+
+    def cancel(self) -> str:
+        """Hủy job; trả về nơi đã hủy: 'pending'/'running' trên ComfyUI, hoặc 'local'.
+
+        Có gọi HTTP tới ComfyUI → không gọi trực tiếp trên event loop.
+        """
+        with self._lock:
+            self._cancel_event.set()
+            has_prompt = self.prompt_id is not None
+        if not has_prompt or self.coalesced_into is not None:
+            # Thành viên single-flight: prompt chung chỉ bị hủy khi thành viên cuối cùng rời đi
+            return "local"
+        return self._cancel_remote()
+
+    def _cancel_remote(self) -> str:
+        from comfyui_client import ComfyUIClient
+        try:
+            return ComfyUIClient(self.backend).cancel_prompt(self.prompt_id)
+        except Exception as e:
+            logger.warning(f"Failed to cancel prompt {self.prompt_id} on {self.backend}: {e}")
+            return "local"
+
+    def release(self) -> None:
+        """Xóa các file tạm của job."""
+        for path in self.temp_paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"Could not remove temp file {path}: {e}")
+        self.temp_paths.clear()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "state": self.state,
+            "priority": self.priority,
+            "backend": self.backend,
+            "prompt_id": self.prompt_id,
+            "cancelled": self.cancelled,
+            "progress": self.progress or None,
+            "preview_seq": self.preview_seq,
+            "coalesced_into": self.coalesced_into,
+            "deadline_remaining": round(self.deadline.remaining(), 1) if self.deadline else None,
+            "age": round(time.time() - self.created_at, 1),
+        }
+
+
+class JobRegistry:
+    """Danh sách job đang chạy trong process, tra cứu theo job_id hoặc owner."""
+
+    def __init__(self):
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def create(self, kind: str, owner: Any = None, backend: Optional[str] = None,
+               job_id: Optional[str] = None, deadline: Optional[Deadline] = None,
+               priority: str = "standard", source: str = "api", journaled: bool = True) -> Job:
+        job = Job(job_id or uuid.uuid4().hex, kind, owner=owner, backend=backend, deadline=deadline,
+                  priority=priority, source=source, journaled=journaled)
+        with self._lock:
+            if job.job_id in self._jobs:
+                raise ValueError(f"Job {job.job_id} already exists")
+            self._jobs[job.job_id] = job
+        job.record("created")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def find_by_owner(self, owner: Any) -> List[Job]:
+        with self._lock:
+            return [job for job in self._jobs.values() if job.owner == owner]
+
+    def active(self) -> List[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> Optional[str]:
+        job = self.get(job_id)
+        if job is None:
+            return None
+        where = job.cancel()
+        logger.info(f"Cancelled job {job_id} ({where})")
+        return where
+
+    def finish(self, job: Job, interrupted: bool = False) -> None:
+        """Gỡ job khỏi registry và giải phóng tài nguyên local.
+
+        `interrupted`: process đang tắt giữa chừng → không ghi trạng thái kết thúc nếu prompt
+        đã nằm trên ComfyUI, để lần khởi động sau reattach vào prompt (job_recovery.py).
+        """
+        with self._lock:
+            self._jobs.pop(job.job_id, None)
+        if job.state not in TERMINAL_STATES and not (interrupted and job.prompt_id and not job.cancelled):
+            job.record("cancelled" if job.cancelled else "failed")
+        job.release()
+
+
+_registry = JobRegistry()
+
+
+def get_job_registry() -> JobRegistry:
+    return _registry
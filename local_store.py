@@ -0,0 +1,117 @@
+import os
+import re
+import hashlib
+import logging
+import mimetypes
+import tempfile
+import threading
+from typing import Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Tên object: sha256 hex + đuôi file, vd "3f2a...e1.png"
+_KEY_PATTERN = re.compile(r"^([0-9a-f]{64})(\.[a-z0-9]{1,5})$")
+
+
+class ContentAddressedStore:
+    """Kho file local đánh địa chỉ theo nội dung (sha256), chia shard 2 cấp.
+
+    `objects/ab/cd/abcd....png` — cùng nội dung thì cùng key nên tự khử trùng lặp,
+    và file đã ghi không bao giờ thay đổi (an toàn để cache vĩnh viễn). Ghi
+    atomically: ghi vào file tạm cùng thư mục, fsync rồi os.replace.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self.objects_dir = os.path.join(self.root, "objects")
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    @staticmethod
+    def key_for(data: bytes, ext: str) -> str:
+        return f"{hashlib.sha256(data).hexdigest()}{ext.lower()}"
+
+    def path_for(self, key: str) -> Optional[str]:
+        """Đường dẫn file của key, None nếu key không hợp lệ (chặn path traversal)."""
+        match = _KEY_PATTERN.match(key)
+        if not match:
+            return None
+        digest = match.group(1)
+        return os.path.join(self.objects_dir, digest[:2], digest[2:4], key)
+
+    def put(self, data: bytes, ext: str) -> str:
+        """Lưu bytes và trả về key. Nội dung đã có thì không ghi lại. (I/O đồng bộ)"""
+        key = self.key_for(data, ext)
+        path = self.path_for(key)
+        if path is None:
+            raise ValueError(f"Unsupported file extension: {ext!r}")
+        if os.path.exists(path):
+            logger.info(f"Deduplicated local object {key}")
+            return key
+
+        shard = os.path.dirname(path)
+        os.makedirs(shard, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=shard, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return key
+
+    def put_stream(self, reader, ext: str) -> str:
+        """Như put() nhưng đọc từ file-like theo chunk, hash trong lúc ghi (không giữ cả file trong RAM)."""
+        h = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in iter(lambda: reader.read(1024 * 1024), b""):
+                    h.update(chunk)
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            key = f"{h.hexdigest()}{ext.lower()}"
+            path = self.path_for(key)
+            if path is None:
+                raise ValueError(f"Unsupported file extension: {ext!r}")
+            if os.path.exists(path):
+                logger.info(f"Deduplicated local object {key}")
+                os.remove(tmp_path)
+                return key
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return key
+
+
+def extension_for(filename: str, content_type: Optional[str]) -> str:
+    """Đuôi file cho object: theo tên file gốc, nếu không có thì theo content type."""
+    ext = os.path.splitext(filename)[1].lower()
+    if not _KEY_PATTERN.match("0" * 64 + ext):
+        ext = mimetypes.guess_extension(content_type or "") or ".bin"
+    return ext
+
+
+_store: Optional[ContentAddressedStore] = None
+_store_lock = threading.Lock()
+
+
+def get_local_store() -> ContentAddressedStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ContentAddressedStore(config.LOCAL_STORAGE_DIR)
+        return _store
@@ -0,0 +1,196 @@
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional, Tuple
+
+from config import config
+
+# Trường có cấu trúc gắn vào mọi dòng log của job đang chạy trong task/thread hiện tại.
+# asyncio.to_thread và create_task chép context nên thread/task con tự mang theo job_id.
+CONTEXT_FIELDS = ("job_id", "prompt_id", "stage")
+_context: ContextVar[Dict[str, Any]] = ContextVar("log_context", default={})
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(context)s%(message)s"
+
+# `extra` cho call site tần suất cao (vòng progress/preview, lỗi recv WS lặp lại): chỉ các dòng
+# này bị RateLimitFilter giới hạn. Dùng kèm tham số kiểu %-style để dòng bị bỏ không tốn công format.
+HOT_PATH = {"rate_limit": True}
+
+
+def bind_log_context(**fields: Any) -> Token:
+    """Gắn job_id/prompt_id/stage cho các dòng log tiếp theo trong context hiện tại."""
+    return _context.set({**_context.get(), **fields})
+
+
+def reset_log_context(token: Token) -> None:
+    _context.reset(token)
+
+
+@contextmanager
+def log_context(**fields: Any):
+    token = bind_log_context(**fields)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Chép trường có cấu trúc từ contextvars vào record (chạy ở thread gọi log, không format gì)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        fields = _context.get()
+        for name in CONTEXT_FIELDS:
+            if not hasattr(record, name):
+                setattr(record, name, fields.get(name))
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Giới hạn số dòng mỗi call site (file + số dòng) trong một cửa sổ thời gian.
+
+    Chỉ áp dụng cho call site được đánh dấu `extra=HOT_PATH` (progress, preview, lỗi recv WS
+    lặp lại, ...): ghi tối đa `rate` lần mỗi `window` giây; số dòng bị bỏ được báo kèm dòng kế
+    tiếp của call site đó. Có thể lấy mẫu một call site bằng `extra={"sample": 0.01}`. Các dòng
+    khác (log của từng job, cảnh báo vận hành) không bị giới hạn; ERROR trở lên luôn được ghi.
+    """
+
+    def __init__(self, rate: int, window: float, max_level: int = logging.WARNING):
+        super().__init__()
+        self.rate = rate
+        self.window = window
+        self.max_level = max_level
+        self.suppressed = 0
+        self._sites: Dict[Tuple[str, int], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.suppressed = 0
+        if record.levelno > self.max_level:
+            return True
+        sample = getattr(record, "sample", None)
+        if sample is not None and random.random() >= sample:
+            return False
+        if self.rate <= 0 or not getattr(record, "rate_limit", False):
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.window:
+                dropped = site[2] if site is not None else 0
+                self._sites[key] = [now, 1, 0]
+                record.suppressed = dropped
+                return True
+            if site[1] < self.rate:
+                site[1] += 1
+                return True
+            site[2] += 1
+            self.suppressed += 1
+            return False
+
+
+class StructuredFormatter(logging.Formatter):
+    """Format ở thread listener: thêm [job=… prompt=… stage=…] và số dòng bị rate limit."""
+
+    def __init__(self, fmt: str = LOG_FORMAT, as_json: bool = False):
+        super().__init__(fmt)
+        self.as_json = as_json
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {name: getattr(record, name, None) for name in CONTEXT_FIELDS}
+        fields = {name: value for name, value in fields.items() if value is not None}
+        suppressed = getattr(record, "suppressed", 0)
+        if self.as_json:
+            entry = {"time": self.formatTime(record), "logger": record.name, "level": record.levelname,
+                     "message": record.getMessage(), **fields}
+            if suppressed:
+                entry["suppressed"] = suppressed
+            if record.exc_info:
+                entry["exc_info"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        prefix = " ".join(f"{name.split('_')[0]}={value}" for name, value in fields.items())
+        record.context = f"[{prefix}] " if prefix else ""
+        text = super().format(record)
+        if suppressed:
+            text += f" (+{suppressed} similar lines suppressed)"
+        return text
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler không format và không bao giờ chặn thread gọi log.
+
+    Record được đẩy nguyên vào hàng đợi; message, traceback (exc_info) được format ở
+    thread của QueueListener. Hàng đợi đầy → bỏ dòng log và đếm, không làm chậm request.
+    """
+
+    def __init__(self, log_queue: "queue.Queue"):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[QueueListener] = None
+_handler: Optional[NonBlockingQueueHandler] = None
+_rate_limit: Optional[RateLimitFilter] = None
+_lock = threading.Lock()
+
+
+def setup_logging(level: Optional[str] = None) -> None:
+    """Cấu hình root logger: QueueHandler → QueueListener (thread riêng) → stderr.
+
+    Gọi nhiều lần không sao (chỉ cấu hình lần đầu). Thay cho logging.basicConfig.
+    """
+    global _listener, _handler, _rate_limit
+    with _lock:
+        if _listener is not None:
+            return
+        output = logging.StreamHandler()
+        output.setFormatter(StructuredFormatter(as_json=config.LOG_JSON))
+        log_queue: "queue.Queue" = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+        _handler = NonBlockingQueueHandler(log_queue)
+        _rate_limit = RateLimitFilter(config.LOG_RATE_LIMIT, config.LOG_RATE_WINDOW)
+        _handler.addFilter(ContextFilter())
+        _handler.addFilter(_rate_limit)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_handler)
+        root.setLevel((level or config.LOG_LEVEL).upper())
+
+        _listener = QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """Ghi nốt các dòng còn trong hàng đợi rồi dừng thread listener."""
+    global _listener
+    with _lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+
+
+def logging_stats() -> Dict[str, int]:
+    return {
+        "queued": _handler.queue.qsize() if _handler else 0,
+        "dropped": _handler.dropped if _handler else 0,
+        "suppressed": _rate_limit.suppressed if _rate_limit else 0,
+    }
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+from typing import Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopLagMonitor:
+    """Theo dõi độ trễ của event loop để phát hiện code blocking.
+
+    Một task nền ngủ `interval` giây rồi đo thời gian thực tế đã trôi qua.
+    Nếu phần dư vượt quá `threshold_ms` nghĩa là có callback nào đó đã chiếm
+    event loop quá lâu (thường là một lời gọi mạng đồng bộ) → ghi warning.
+
+    Khi bật `debug`, asyncio sẽ tự log tên callback chạy quá `threshold_ms`
+    (dùng `loop.slow_callback_duration`), giúp tìm ra đúng chỗ gây block.
+    """
+
+    def __init__(self, threshold_ms: int = None, interval: float = None, debug: bool = None):
+        self.threshold_ms = threshold_ms if threshold_ms is not None else config.LOOP_LAG_THRESHOLD_MS
+        self.interval = interval if interval is not None else config.LOOP_LAG_CHECK_INTERVAL
+        self.debug = debug if debug is not None else config.LOOP_LAG_DEBUG
+        self.max_lag_ms = 0.0
+        self.slow_ticks = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Bắt đầu theo dõi trên event loop đang chạy."""
+        if self._task is not None and not self._task.done():
+            return
+        loop = asyncio.get_running_loop()
+        if self.debug:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.threshold_ms / 1000.0
+        self._task = loop.create_task(self._run())
+        logger.info(f"Event loop lag monitor started (threshold={self.threshold_ms}ms, interval={self.interval}s)")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag_ms = (loop.time() - started - self.interval) * 1000.0
+            if lag_ms > self.max_lag_ms:
+                self.max_lag_ms = lag_ms
+            if lag_ms > self.threshold_ms:
+                self.slow_ticks += 1
+                logger.warning(f"⚠️ Event loop blocked for ~{lag_ms:.0f}ms (threshold {self.threshold_ms}ms)")
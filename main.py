@@ -4,421 +4,1022 @@ import uuid
 import shutil
 import asyncio
 import logging
-from typing import Optional
+from typing import Optional, Set, Tuple
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from contextlib import asynccontextmanager
+
+import mimetypes
+
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
 
 import requests
 
 from config import config
 from comfyui_client import ComfyUIClient
-from storage_service import get_storage_service
+from storage_service import get_shared_storage_service
+from health_prober import get_health_prober
+from workflow_classifier import classify_workflow
+from job_registry import get_job_registry
+from job_journal import get_job_journal
+from job_recovery import recover_unfinished_jobs
+from local_store import get_local_store
+from image_preview import make_preview, preview_filename
+from result_stream import ResultFile, SinkAbandoned, TeeReader, stream_result
+from image_transcode import (
+    get_variant_cache, negotiate_format, resolve_quality, shutdown_transcode_pool, transcode_async,
+    variant_filename,
+)
+from deadline import DeadlineExceeded, deadline_for
+from circuit_breaker import CircuitOpen, circuit_stats
+from dispatcher import dispatcher_stats, priority_for_request
+from workflow_templates import TEMPLATE_FILES, load_template, resolve_parameters
+from single_flight import coalescing_key, file_digest, get_single_flight
+from log_setup import bind_log_context, logging_stats, reset_log_context, setup_logging
 
 logger = logging.getLogger("main")
 
-app = FastAPI(title="Image Recovery Bot API")
+# Đang tắt server: không nhận job mới, chờ job đang chạy xong (xem _lifespan)
+_draining = False
+# Mốc monotonic bắt đầu drain: uvicorn (chờ request) và _drain_jobs dùng chung API_SHUTDOWN_GRACE
+_drain_started_at: Optional[float] = None
+# Flight còn chạy nền sau khi response return=image đã trả về (upload storage, preview)
+_background_flights: Set[asyncio.Future] = set()
+
+
+def start_draining(reason: str) -> None:
+    """Ngừng nhận job mới: request mới nhận 503 + Retry-After và /health báo 503 để load balancer
+    chuyển traffic sang instance khác. run_api.py gọi ngay khi uvicorn nhận SIGINT/SIGTERM, trước
+    khi nó ngừng nhận kết nối và chờ request đang chạy."""
+    global _draining, _drain_started_at
+    if _draining:
+        return
+    _draining = True
+    _drain_started_at = time.monotonic()
+    logger.info(f"Draining ({reason}): new jobs are rejected with 503")
+
+
+def _preinit_shared_clients() -> None:
+    """Khởi tạo trước storage (Firebase), job journal và template workflow để request
+    đầu tiên của mỗi worker không phải trả chi phí này. (I/O đồng bộ)"""
+    get_shared_storage_service()
+    get_job_journal()
+    for name in TEMPLATE_FILES:
+        load_template(name)
+
+
+def _pending_flights() -> Set[asyncio.Future]:
+    return {task for task in _background_flights | set(get_single_flight().tasks()) if not task.done()}
+
+
+async def _drain_jobs(grace: float) -> None:
+    """Chờ các job đang chạy (xử lý + upload kết quả, kể cả flight chạy nền của return=image)
+    xong, tối đa `grace` giây tính từ lúc bắt đầu drain (thời gian uvicorn đã chờ request được
+    trừ ra); flight còn lại bị hủy như khi process bị ngắt (prompt đã queue vẫn nằm trong
+    journal của các request thành viên để khôi phục)."""
+    registry = get_job_registry()
+    deadline = (_drain_started_at or time.monotonic()) + grace
+    while (registry.active() or _pending_flights()) and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+    pending = _pending_flights()
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.wait(pending, timeout=5)
+    left = registry.active()
+    if left or pending:
+        logger.warning(f"Shutting down with {len(left)} unfinished job(s) and {len(pending)} interrupted "
+                       f"flight(s); they stay in the journal for recovery on next start")
+    else:
+        logger.info("All in-flight jobs drained")
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    # Mỗi worker process tự cấu hình logging (hàng đợi + thread listener riêng)
+    setup_logging()
+    await asyncio.to_thread(_preinit_shared_clients)
+    get_health_prober().start()
+    if config.RECOVER_JOBS_ON_STARTUP:
+        # Reattach vào prompt của các job dang dở trước lần restart trước (không submit lại)
+        await asyncio.to_thread(recover_unfinished_jobs, "api")
+    yield
+    # Chạy qua run_api.py thì đã drain từ lúc nhận tín hiệu; uvicorn đã chờ các request đang chạy
+    # (timeout_graceful_shutdown) → chờ nốt job/flight chạy nền trước khi dừng service nền
+    start_draining("lifespan shutdown")
+    await _drain_jobs(config.API_SHUTDOWN_GRACE)
+    await get_health_prober().stop()
+    shutdown_transcode_pool()
+
+
+app = FastAPI(title="Image Recovery Bot API", lifespan=_lifespan)
 
 
 @app.get("/health")
 async def health_check():
-    services = {"comfyui": "unknown", "storage": "unknown"}
+    """Trạng thái các service, đọc từ cache của health prober (không gọi mạng)."""
+    if _draining:
+        raise HTTPException(status_code=503, detail="Server is shutting down")
+    prober = get_health_prober()
+    return {
+        "status": "ok",
+        "services": prober.summary(),
+        "details": prober.snapshot(),
+        "workflows": prober.validator.snapshot(),
+        "warmup": prober.warmup.snapshot(),
+    }
 
-    # Check ComfyUI
-    try:
-        comfy_url = f"{config.COMFYUI_SERVER_URL.rstrip('/')}/history/0"
-        r = requests.get(comfy_url, timeout=5)
-        services["comfyui"] = "running" if r.status_code == 200 else f"error_http_{r.status_code}"
-    except Exception as e:
-        services["comfyui"] = f"error: {e}"
 
-    # Check storage
-    try:
-        svc = get_storage_service()
-        services["storage"] = "initialized"
-    except Exception as e:
-        services["storage"] = f"error: {e}"
+@app.get("/metrics/storage")
+async def storage_metrics():
+    """Latency upload lên storage (p50/p95/max) và số lỗi."""
+    return get_shared_storage_service().stats()
 
-    return {"status": "ok", "services": services}
 
+@app.get("/metrics/queue")
+async def queue_metrics():
+    """Độ sâu hàng đợi cục bộ theo lớp ưu tiên, số prompt trên mỗi backend ComfyUI, số request đang được gộp
+    và trạng thái circuit breaker của từng backend."""
+    return {"backends": dispatcher_stats(), "single_flight": get_single_flight().stats(),
+            "transcode_cache": get_variant_cache().stats(), "logging": logging_stats(),
+            "circuits": circuit_stats()}
 
-async def _save_upload_to_temp(upload: UploadFile) -> str:
-    tmpdir = os.path.join(os.getcwd(), "temp")
-    os.makedirs(tmpdir, exist_ok=True)
-    filename = f"{uuid.uuid4().hex}_{upload.filename}"
-    path = os.path.join(tmpdir, filename)
 
-    with open(path, "wb") as out_file:
-        shutil.copyfileobj(upload.file, out_file)
-
-    return path
+_IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
 
 
-@app.post("/recover-image")
-async def recover_image(
-    image: UploadFile = File(...),
-    prompt: str = Form(...),
-    strength: float = Form(0.8),
-    steps: int = Form(20),
-    guidance_scale: float = Form(7.5),
-):
-    start_time = time.time()
+def _parse_range(header: str, size: int) -> Optional[tuple]:
+    """Đọc header Range dạng "bytes=a-b" / "bytes=a-" / "bytes=-n". Nhiều range → None (trả cả file)."""
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    if first:
+        start = int(first)
+        end = int(last) if last else size - 1
+    else:
+        start = max(0, size - int(last))
+        end = size - 1
+    return start, min(end, size - 1)
 
-    # Save uploaded image to temp
-    try:
-        input_path = await _save_upload_to_temp(image)
-    except Exception as e:
-        logger.exception("Failed to save uploaded file")
-        raise HTTPException(status_code=500, detail=f"Failed to save uploaded file: {e}")
 
-    client = ComfyUIClient()
+@app.api_route("/files/{key}", methods=["GET", "HEAD"])
+async def get_stored_file(key: str, request: Request):
+    """Phục vụ file trong kho local content-addressed.
 
+    Key là sha256 của nội dung nên ETag mạnh = key và file không bao giờ đổi →
+    Cache-Control immutable, CDN/reverse proxy có thể cache vĩnh viễn. Hỗ trợ
+    If-None-Match (304) và Range (206).
+    """
+    path = get_local_store().path_for(key)
+    if path is None or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    etag = f'"{key.split(".")[0]}"'
+    headers = {"ETag": etag, "Cache-Control": _IMMUTABLE_CACHE, "Accept-Ranges": "bytes"}
+    media_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if range_header:
+        size = os.path.getsize(path)
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            byte_range = None
+        if byte_range is not None:
+            start, end = byte_range
+            if start >= size or start > end:
+                return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+            def _read_slice() -> bytes:
+                with open(path, "rb") as f:
+                    f.seek(start)
+                    return f.read(end - start + 1)
+
+            body = b"" if request.method == "HEAD" else await asyncio.to_thread(_read_slice)
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return Response(content=body, status_code=206, media_type=media_type, headers=headers)
+
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+def _pick_comfyui_backend(workflow) -> str:
+    """Chọn backend ComfyUI cho job; fail nhanh (503) nếu biết chắc tất cả đang down
+    hoặc không backend nào chạy được workflow (thiếu custom node, template sai...)."""
+    prober = get_health_prober()
+    backend = prober.pick_backend(workflow)
+    if backend is None:
+        if prober.pick_backend() is None:
+            raise HTTPException(status_code=503, detail="ComfyUI backend is currently unavailable")
+        raise HTTPException(status_code=503, detail=f"No ComfyUI backend can currently run workflow {workflow}")
+    return backend
+
+
+async def _cancel_on_disconnect(request: Request, job) -> None:
+    """Hủy job khi client HTTP ngắt kết nối: không ai nhận kết quả thì không tốn GPU nữa."""
+    while not job.cancelled:
+        if await request.is_disconnected():
+            logger.info(f"Client disconnected, cancelling job {job.job_id}")
+            await asyncio.to_thread(get_job_registry().cancel, job.job_id)
+            return
+        await asyncio.sleep(1)
+
+
+def _find_error(exc: BaseException, error_type):
+    """Tìm lỗi kiểu `error_type` trong chuỗi exception (các stage bọc lỗi thành HTTPException)."""
+    while exc is not None:
+        if isinstance(exc, error_type):
+            return exc
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+
+@asynccontextmanager
+async def _job_scope(request: Request, kind: str, backend: str, deadline: Optional[str] = None):
+    """Đăng ký job cho một request: có thể hủy qua DELETE /jobs/{job_id} (client có thể
+    tự đặt job_id qua header X-Job-Id), tự hủy khi client ngắt kết nối, và luôn dọn
+    file tạm khi kết thúc.
+
+    Deadline của job lấy từ header X-Request-Deadline, form field `deadline` (số giây
+    hoặc unix timestamp) hoặc mặc định theo workflow; trễ hạn → 504. Lớp ưu tiên
+    lấy theo API key (header X-API-Key) hoặc endpoint.
+    """
+    if _draining:
+        raise HTTPException(status_code=503, detail="Server is shutting down, retry on another instance",
+                            headers={"Retry-After": "5"})
+    registry = get_job_registry()
     try:
-        # process_image_recovery is CPU/blocking — run in thread
-        result_filename = await asyncio.to_thread(
-            client.process_image_recovery,
-            input_path,
-            prompt,
-            strength,
-            steps,
-            guidance_scale,
+        job = registry.create(
+            kind,
+            backend=backend,
+            job_id=request.headers.get("X-Job-Id"),
+            deadline=deadline_for(kind, request.headers.get("X-Request-Deadline") or deadline),
+            priority=priority_for_request(request.url.path, request.headers.get("X-API-Key")),
         )
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    log_token = bind_log_context(job_id=job.job_id)
+    watcher = asyncio.create_task(_cancel_on_disconnect(request, job))
+    interrupted = False
+    try:
+        yield job
+    except asyncio.CancelledError:
+        # Server bị tắt trước khi job xong (hết thời gian graceful shutdown)
+        interrupted = True
+        raise
     except Exception as e:
-        logger.exception("ComfyUI processing failed")
-        raise HTTPException(status_code=500, detail=f"ComfyUI processing failed: {e}")
+        if job.cancelled:
+            raise HTTPException(status_code=499, detail=f"Job {job.job_id} was cancelled") from None
+        exceeded = _find_error(e, DeadlineExceeded)
+        if exceeded is not None or job.deadline.expired:
+            # Không ai chờ kết quả nữa → gỡ prompt khỏi ComfyUI nếu còn đang chờ/chạy
+            if job.prompt_id:
+                await asyncio.to_thread(job.cancel)
+            detail = str(exceeded) if exceeded is not None else f"Job {job.job_id} missed its deadline"
+            raise HTTPException(status_code=504, detail=detail) from None
+        opened = _find_error(e, CircuitOpen)
+        if opened is not None:
+            # Backend bị ngắt mạch giữa chừng: báo client thử lại sau thay vì 500
+            raise HTTPException(status_code=503, detail=str(opened),
+                                headers={"Retry-After": str(max(1, int(opened.retry_after)))}) from None
+        raise
+    finally:
+        watcher.cancel()
+        registry.finish(job, interrupted=interrupted)
+        reset_log_context(log_token)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Trạng thái job: job đang chạy trong process, hoặc bản ghi mới nhất trong journal
+    (kể cả job được khôi phục sau restart, khi đó `result` là URL ảnh kết quả)."""
+    job = get_job_registry().get(job_id)
+    if job is not None:
+        return job.to_dict()
+    journal = get_job_journal()
+    entry = await asyncio.to_thread(journal.latest, job_id) if journal else None
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return entry
+
+
+@app.get("/jobs/{job_id}/preview")
+async def get_job_preview(job_id: str):
+    """Latent preview mới nhất của job đang chạy (cập nhật tối đa mỗi PREVIEW_FRAME_INTERVAL giây).
+
+    Header X-Preview-Seq tăng mỗi frame mới để client poll biết có ảnh mới chưa.
+    """
+    job = get_job_registry().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    preview, seq = job.preview, job.preview_seq
+    if preview is None:
+        raise HTTPException(status_code=404, detail=f"No preview available yet for job {job_id}")
+    data, content_type = preview
+    return Response(content=data, media_type=content_type,
+                    headers={"Cache-Control": "no-store", "X-Preview-Seq": str(seq)})
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Hủy job đang chạy: xóa prompt khỏi queue ComfyUI hoặc interrupt nếu đang chạy."""
+    where = await asyncio.to_thread(get_job_registry().cancel, job_id)
+    if where is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return {"success": True, "job_id": job_id, "cancelled": where}
+
+
+async def _store_result(storage, client: ComfyUIClient, result_filename: str, job, flight) -> ResultFile:
+    """Stream ảnh kết quả từ ComfyUI tới storage, file tạm và response của các request
+    return=image cùng lúc, rồi tạo ảnh preview nhỏ (JPEG/WebP) từ file; trả về ResultFile
+    với info["public_url"]/info["preview_url"].
+
+    Mỗi job chỉ giữ vài chunk trong RAM thay vì cả ảnh. Preview lỗi không làm hỏng request:
+    preview_url = None. `storage` = None (return=image&store=false): không lưu, không preview.
+    Caller gọi result.release() khi dùng xong file.
+    """
+    result = await stream_result(client, result_filename, storage, tee=flight.open_tee(),
+                                 timeout=job.timeout_for(None, "download"))
+    result.info["preview_url"] = None
+    if storage is None:
+        return result
+    if result.info["public_url"] is None:
+        result.release()
+        raise Exception(f"Failed to upload {result_filename} to storage")
 
     try:
-        # get_image is blocking — run in thread
-        image_bytes = await asyncio.to_thread(client.get_image, result_filename, "", "output")
+        data, content_type = await asyncio.to_thread(make_preview, result.path)
+        result.info["preview_url"] = await storage.upload_image(
+            data, preview_filename(result_filename, content_type), content_type=content_type)
     except Exception as e:
-        logger.exception("Failed to retrieve result image from ComfyUI")
-        raise HTTPException(status_code=500, detail=f"Failed to retrieve result image: {e}")
+        logger.warning(f"Failed to build/store preview for {result_filename}: {e}")
+    return result
 
+
+def _check_workflow_parameters(workflows, preset: Optional[str], params: Optional[dict] = None) -> None:
+    """Kiểm tra preset/tham số trước khi nhận job (lỗi → 400, chưa tốn upload hay GPU)."""
     try:
-        storage = get_storage_service()
-    except Exception as e:
-        logger.exception("Failed to initialize storage service")
-        raise HTTPException(status_code=500, detail=f"Failed to initialize storage service: {e}")
+        for name in ((workflows,) if isinstance(workflows, str) else workflows):
+            resolve_parameters(name, preset, params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 
+def _response_mode(request: Request, store: Optional[bool]) -> Tuple[str, bool]:
+    """("json" | "image", có lưu storage không) từ query `?return=` hoặc header Accept.
+
+    Không có `?return=`: Accept chỉ liệt kê type ảnh (vd "image/png", "image/webp, */*")
+    → trả thẳng ảnh. Chế độ json luôn lưu storage (cần URL); chế độ image mặc định
+    DIRECT_RESPONSE_STORE, ghi đè bằng tham số `store`.
+    """
+    mode = request.query_params.get("return")
+    if mode is None:
+        types = [part.split(";")[0].strip().lower() for part in (request.headers.get("accept") or "").split(",")]
+        types = [t for t in types if t and t != "*/*"]
+        mode = "image" if types and all(t.startswith("image/") for t in types) else "json"
+    if mode not in ("json", "image"):
+        raise HTTPException(status_code=400, detail=f"Unsupported return mode '{mode}' (use 'json' or 'image')")
+    if mode == "json":
+        return mode, True
+    return mode, config.DIRECT_RESPONSE_STORE if store is None else store
+
+
+async def _iter_stream(reader: TeeReader):
+    """Body của StreamingResponse: đọc từng chunk từ tee; client ngắt kết nối → tách sink khỏi tee
+    (abandon() đánh thức thread đang chờ next_chunk, không giữ thread của executor).
+
+    Sink bị tách vì client đọc quá chậm → raise để server cắt kết nối: response dừng giữa
+    chừng thay vì kết thúc "bình thường" với ảnh bị cụt.
+    """
     try:
-        public_url = await storage.upload_image(image_bytes, result_filename, content_type="image/png")
-    except Exception as e:
-        logger.exception("Failed to upload result image to storage")
-        raise HTTPException(status_code=500, detail=f"Failed to upload image to storage: {e}")
+        while True:
+            try:
+                chunk = await asyncio.to_thread(reader.next_chunk)
+            except SinkAbandoned:
+                logger.warning(f"Image response stream '{reader.name}' was detached, closing the connection")
+                raise
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        reader.abandon()
+
+
+def _release_when_done(task: asyncio.Future) -> None:
+    if not task.cancelled() and task.exception() is None:
+        task.result().release()
+
+
+async def _image_response(job, key: str, work, output: Tuple[str, int]) -> Response:
+    """return=image: trả thẳng bytes ảnh kết quả trong HTTP response, không chờ upload storage.
+
+    PNG: response bắt đầu stream ngay khi worker mở /view của ComfyUI (cùng tee với file tạm
+    và upload storage, chạy song song). Định dạng khác, hoặc request gộp vào flight đã bắt
+    đầu stream: đọc/transcode từ file kết quả sau khi flight xong.
+    """
+    fmt, quality = output
+    stream_ready = asyncio.get_running_loop().create_future()
+
+    def _on_stream(reader: TeeReader) -> None:
+        if stream_ready.done():
+            reader.abandon()
+        else:
+            stream_ready.set_result(reader)
 
-    elapsed = time.time() - start_time
-    job_id = uuid.uuid4().hex
+    flight = asyncio.ensure_future(
+        get_single_flight().run(key, job, work, on_stream=_on_stream if fmt == "png" else None))
+    try:
+        await asyncio.wait({flight, stream_ready}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        flight.cancel()
+        raise
+    headers = {"X-Job-Id": job.job_id, "Cache-Control": "no-store"}
+
+    if stream_ready.done() and not flight.done():
+        # Ảnh đang về: phần còn lại của flight (file tạm, storage, preview) chạy tiếp phía sau
+        flight.add_done_callback(_release_when_done)
+        _background_flights.add(flight)
+        flight.add_done_callback(_background_flights.discard)
+        job.record("delivered")
+        return StreamingResponse(_iter_stream(stream_ready.result()), media_type="image/png", headers=headers)
+    if stream_ready.done():
+        stream_ready.result().abandon()
+    else:
+        stream_ready.cancel()
+
+    result = flight.result()
+    try:
+        if fmt == "png":
+            data, content_type = await asyncio.to_thread(result.read_bytes), "image/png"
+        else:
+            data, content_type = await transcode_async(result.path, fmt, quality, digest=result.digest)
+    finally:
+        result.release()
+    if result.info.get("public_url"):
+        headers["X-Original-Url"] = result.info["public_url"]
+    if result.info.get("selected"):
+        headers["X-Used-Workflow"] = result.info["selected"]
+    job.record("delivered", result=result.info.get("public_url"))
+    return Response(content=data, media_type=content_type, headers=headers)
+
+
+def _negotiate_output(request: Request, output_format: Optional[str], quality: Optional[int]) -> Tuple[str, int]:
+    """Định dạng/chất lượng ảnh kết quả từ tham số output_format/quality hoặc header Accept (lỗi → 400)."""
+    try:
+        return negotiate_format(output_format, request.headers.get("accept")), resolve_quality(quality)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    return {
-        "success": True,
-        "job_id": job_id,
-        "processing_time": elapsed,
-        "result_image_url": public_url,
-    }
 
+async def _store_variant(result: ResultFile, original_url: str, output: Tuple[str, int]) -> Tuple[str, str]:
+    """Lưu biến thể theo định dạng client chọn (PNG gốc đã được lưu); trả về (url, content_type).
 
-@app.post("/recover-image-from-url")
-async def recover_image_from_url(
-    image_url: str = Form(...),
-    prompt: str = Form(...),
-    strength: float = Form(0.8),
-    steps: int = Form(20),
-    guidance_scale: float = Form(7.5),
-):
-    # Download image
+    Transcode lỗi không làm hỏng request (GPU đã chạy xong): trả về ảnh PNG gốc.
+    """
+    fmt, quality = output
+    if fmt == "png":
+        return original_url, "image/png"
     try:
-        r = requests.get(image_url, timeout=15)
-        r.raise_for_status()
+        data, content_type = await transcode_async(result.path, fmt, quality, digest=result.digest)
+        url = await get_shared_storage_service().upload_image(
+            data, variant_filename(result.filename, fmt), content_type=content_type)
+        return url, content_type
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Failed to download image: {e}")
+        logger.warning(f"Failed to transcode/store {fmt} variant of {result.filename}, returning PNG: {e}")
+        return original_url, "image/png"
+
+
+async def _flight_key(workflow: str, prompt: str, paths, preset: Optional[str],
+                      params: Optional[dict] = None, store: bool = True) -> str:
+    """Key single-flight: sha256 ảnh input/tham chiếu + workflow + prompt + preset/tham số.
 
-    # Save to temp
-    tmpname = f"{uuid.uuid4().hex}.jpg"
+    Flight không lưu storage (return=image&store=false) không gộp với request cần URL.
+    """
+    digests = [await asyncio.to_thread(file_digest, path) if path else None for path in paths]
+    params = dict(params or {}, preset=preset)
+    if not store:
+        params["store"] = False
+    return coalescing_key(workflow, prompt, digests, params)
+
+
+async def _save_upload_to_temp(upload: UploadFile) -> str:
     tmpdir = os.path.join(os.getcwd(), "temp")
     os.makedirs(tmpdir, exist_ok=True)
-    tmp_path = os.path.join(tmpdir, tmpname)
-    with open(tmp_path, "wb") as f:
-        f.write(r.content)
+    filename = f"{uuid.uuid4().hex}_{upload.filename}"
+    path = os.path.join(tmpdir, filename)
 
-    # Reuse recover_image flow by calling client directly
-    client = ComfyUIClient()
-    try:
-        result_filename = await asyncio.to_thread(
-            client.process_image_recovery,
-            tmp_path,
-            prompt,
-            strength,
-            steps,
-            guidance_scale,
-        )
+    with open(path, "wb") as out_file:
+        shutil.copyfileobj(upload.file, out_file)
 
-        image_bytes = await asyncio.to_thread(client.get_image, result_filename, "", "output")
-    except Exception as e:
-        logger.exception("ComfyUI processing failed for URL")
-        raise HTTPException(status_code=500, detail=f"ComfyUI processing failed: {e}")
+    return path
 
-    try:
-        storage = get_storage_service()
-        public_url = await storage.upload_image(image_bytes, result_filename, content_type="image/png")
-    except Exception as e:
-        logger.exception("Failed to upload image to storage for URL flow")
-        raise HTTPException(status_code=500, detail=f"Failed to upload image to storage: {e}")
 
-    return {"success": True, "result_image_url": public_url}
+@app.post("/recover-image")
+async def recover_image(
+    request: Request,
+    image: UploadFile = File(...),
+    prompt: str = Form(...),
+    strength: Optional[float] = Form(None),
+    steps: Optional[int] = Form(None),
+    guidance_scale: Optional[float] = Form(None),
+    preset: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None),
+    store: Optional[bool] = Form(None),
+    deadline: Optional[str] = Form(None),
+):
+    # Tham số bỏ trống → giữ giá trị của preset/template Restore.json
+    _check_workflow_parameters("restore", preset,
+                               {"strength": strength, "steps": steps, "guidance_scale": guidance_scale})
+    output = _negotiate_output(request, output_format, quality)
+    mode, store = _response_mode(request, store)
+    # Fail nhanh nếu health prober biết chắc ComfyUI đang down
+    backend = _pick_comfyui_backend("restore")
+
+    async with _job_scope(request, "restore", backend, deadline) as job:
+        start_time = time.time()
+
+        # Save uploaded image to temp
+        try:
+            input_path = job.add_temp_path(await _save_upload_to_temp(image))
+        except Exception as e:
+            logger.exception("Failed to save uploaded file")
+            raise HTTPException(status_code=500, detail=f"Failed to save uploaded file: {e}")
+
+        key = await _flight_key("restore", prompt, (input_path,), preset,
+                                {"strength": strength, "steps": steps, "guidance_scale": guidance_scale}, store)
+
+        async def _work(worker, flight):
+            client = ComfyUIClient(backend)
+
+            try:
+                # process_image_recovery is CPU/blocking — run in thread
+                result_filename = await asyncio.to_thread(
+                    client.process_image_recovery,
+                    input_path,
+                    prompt,
+                    strength,
+                    steps,
+                    guidance_scale,
+                    progress_callback=flight.publish_progress,
+                    job=worker,
+                    preset=preset,
+                    preview_callback=flight.publish_preview,
+                )
+            except Exception as e:
+                logger.exception("ComfyUI processing failed")
+                raise HTTPException(status_code=500, detail=f"ComfyUI processing failed: {e}")
+
+            try:
+                worker.check_deadline("store")
+                storage = get_shared_storage_service() if store else None
+            except Exception as e:
+                logger.exception("Failed to initialize storage service")
+                raise HTTPException(status_code=500, detail=f"Failed to initialize storage service: {e}")
+
+            try:
+                # Stream /view tới file tạm + storage cùng lúc (không giữ cả ảnh trong RAM)
+                result = await _store_result(storage, client, result_filename, worker, flight)
+                worker.record("stored", result=result.info["public_url"])
+            except Exception as e:
+                logger.exception("Failed to upload result image to storage")
+                raise HTTPException(status_code=500, detail=f"Failed to upload image to storage: {e}")
+            return result
+
+        # Request giống hệt đang chạy (double-tap, client retry) → chờ chung kết quả
+        if mode == "image":
+            return await _image_response(job, key, _work, output)
+        result = await get_single_flight().run(key, job, _work)
+        try:
+            public_url, preview_url = result.info["public_url"], result.info["preview_url"]
+            result_url, content_type = await _store_variant(result, public_url, output)
+        finally:
+            result.release()
+        job.record("stored", result=result_url)
+
+        elapsed = time.time() - start_time
+
+        return {
+            "success": True,
+            "job_id": job.job_id,
+            "processing_time": elapsed,
+            "result_image_url": result_url,
+            "content_type": content_type,
+            "original_image_url": public_url,
+            "preview_url": preview_url,
+        }
+
+
+@app.post("/recover-image-from-url")
+async def recover_image_from_url(
+    request: Request,
+    image_url: str = Form(...),
+    prompt: str = Form(...),
+    strength: Optional[float] = Form(None),
+    steps: Optional[int] = Form(None),
+    guidance_scale: Optional[float] = Form(None),
+    preset: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None),
+    store: Optional[bool] = Form(None),
+    deadline: Optional[str] = Form(None),
+):
+    # Tham số bỏ trống → giữ giá trị của preset/template Restore.json
+    _check_workflow_parameters("restore", preset,
+                               {"strength": strength, "steps": steps, "guidance_scale": guidance_scale})
+    output = _negotiate_output(request, output_format, quality)
+    mode, store = _response_mode(request, store)
+    # Fail nhanh nếu health prober biết chắc ComfyUI đang down
+    backend = _pick_comfyui_backend("restore")
+
+    async with _job_scope(request, "restore", backend, deadline) as job:
+        # Download image
+        try:
+            r = await asyncio.to_thread(requests.get, image_url, timeout=job.timeout_for(15, "download"))
+            r.raise_for_status()
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Failed to download image: {e}")
+
+        # Save to temp
+        tmpname = f"{uuid.uuid4().hex}.jpg"
+        tmpdir = os.path.join(os.getcwd(), "temp")
+        os.makedirs(tmpdir, exist_ok=True)
+        tmp_path = job.add_temp_path(os.path.join(tmpdir, tmpname))
+        with open(tmp_path, "wb") as f:
+            f.write(r.content)
+
+        key = await _flight_key("restore", prompt, (tmp_path,), preset,
+                                {"strength": strength, "steps": steps, "guidance_scale": guidance_scale}, store)
+
+        async def _work(worker, flight):
+            # Reuse recover_image flow by calling client directly
+            client = ComfyUIClient(backend)
+            try:
+                result_filename = await asyncio.to_thread(
+                    client.process_image_recovery,
+                    tmp_path,
+                    prompt,
+                    strength,
+                    steps,
+                    guidance_scale,
+                    progress_callback=flight.publish_progress,
+                    job=worker,
+                    preset=preset,
+                    preview_callback=flight.publish_preview,
+                )
+            except Exception as e:
+                logger.exception("ComfyUI processing failed for URL")
+                raise HTTPException(status_code=500, detail=f"ComfyUI processing failed: {e}")
+
+            try:
+                worker.check_deadline("store")
+                storage = get_shared_storage_service() if store else None
+                # Stream /view tới file tạm + storage cùng lúc (không giữ cả ảnh trong RAM)
+                result = await _store_result(storage, client, result_filename, worker, flight)
+                worker.record("stored", result=result.info["public_url"])
+            except Exception as e:
+                logger.exception("Failed to upload image to storage for URL flow")
+                raise HTTPException(status_code=500, detail=f"Failed to upload image to storage: {e}")
+            return result
+
+        if mode == "image":
+            return await _image_response(job, key, _work, output)
+        result = await get_single_flight().run(key, job, _work)
+        try:
+            public_url, preview_url = result.info["public_url"], result.info["preview_url"]
+            result_url, content_type = await _store_variant(result, public_url, output)
+        finally:
+            result.release()
+        job.record("stored", result=result_url)
+
+        return {"success": True, "job_id": job.job_id, "result_image_url": result_url, "content_type": content_type,
+                "original_image_url": public_url, "preview_url": preview_url}
 
 
 # ============== INPAINTING WORKFLOW APIs ==============
 
 @app.post("/inpaint-image")
 async def inpaint_image(
+    request: Request,
     image: UploadFile = File(...),
     prompt: str = Form(...),
     ref_image2: UploadFile = File(None),
     ref_image3: UploadFile = File(None),
+    steps: Optional[int] = Form(None),
+    guidance_scale: Optional[float] = Form(None),
+    preset: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None),
+    store: Optional[bool] = Form(None),
+    deadline: Optional[str] = Form(None),
 ):
     """API inpainting sử dụng workflow Inpainting.json.
 
     - image: ảnh chính cần chỉnh sửa
     - prompt: mô tả chỉnh sửa
     - ref_image2/ref_image3: ảnh tham chiếu tùy chọn
+    - preset: "draft" (nhanh, ít bước, ít pixel) hoặc "full" (mặc định); steps/guidance_scale ghi đè preset
+    - output_format/quality: png/webp/jpeg/avif cho ảnh kết quả (hoặc theo header Accept); PNG gốc vẫn được lưu
     """
-    start_time = time.time()
-
-    # Lưu các file vào temp
-    try:
-        input_path = await _save_upload_to_temp(image)
-        ref2_path = await _save_upload_to_temp(ref_image2) if ref_image2 else None
-        ref3_path = await _save_upload_to_temp(ref_image3) if ref_image3 else None
-    except Exception as e:
-        logger.exception("Failed to save uploaded files for inpainting")
-        raise HTTPException(status_code=500, detail=f"Failed to save uploaded files: {e}")
-
-    client = ComfyUIClient()
-
-    try:
-        # process_inpainting là blocking — chạy trong thread
-        result_filename = await asyncio.to_thread(
-            client.process_inpainting,
-            input_path,
-            prompt,
-            ref2_path,
-            ref3_path,
-        )
-    except Exception as e:
-        logger.exception("ComfyUI inpainting failed")
-        raise HTTPException(status_code=500, detail=f"ComfyUI inpainting failed: {e}")
-
-    try:
-        image_bytes = await asyncio.to_thread(client.get_image, result_filename, "", "output")
-    except Exception as e:
-        logger.exception("Failed to retrieve inpainting result image from ComfyUI")
-        raise HTTPException(status_code=500, detail=f"Failed to retrieve result image: {e}")
-
-    try:
-        storage = get_storage_service()
-        public_url = await storage.upload_image(image_bytes, result_filename, content_type="image/png")
-    except Exception as e:
-        logger.exception("Failed to upload inpainting image to storage")
-        raise HTTPException(status_code=500, detail=f"Failed to upload image to storage: {e}")
-
-    elapsed = time.time() - start_time
-    job_id = uuid.uuid4().hex
-
-    return {
-        "success": True,
-        "job_id": job_id,
-        "processing_time": elapsed,
-        "result_image_url": public_url,
-    }
+    params = {"steps": steps, "guidance_scale": guidance_scale}
+    _check_workflow_parameters("inpaint", preset, params)
+    output = _negotiate_output(request, output_format, quality)
+    mode, store = _response_mode(request, store)
+    # Fail nhanh nếu health prober biết chắc ComfyUI đang down
+    backend = _pick_comfyui_backend("inpaint")
+
+    async with _job_scope(request, "inpaint", backend, deadline) as job:
+        start_time = time.time()
+
+        # Lưu các file vào temp
+        try:
+            input_path = job.add_temp_path(await _save_upload_to_temp(image))
+            ref2_path = job.add_temp_path(await _save_upload_to_temp(ref_image2)) if ref_image2 else None
+            ref3_path = job.add_temp_path(await _save_upload_to_temp(ref_image3)) if ref_image3 else None
+        except Exception as e:
+            logger.exception("Failed to save uploaded files for inpainting")
+            raise HTTPException(status_code=500, detail=f"Failed to save uploaded files: {e}")
+
+        key = await _flight_key("inpaint", prompt, (input_path, ref2_path, ref3_path), preset, params, store)
+
+        async def _work(worker, flight):
+            client = ComfyUIClient(backend)
+
+            try:
+                # process_inpainting là blocking — chạy trong thread
+                result_filename = await asyncio.to_thread(
+                    client.process_inpainting,
+                    input_path,
+                    prompt,
+                    ref2_path,
+                    ref3_path,
+                    progress_callback=flight.publish_progress,
+                    job=worker,
+                    preset=preset,
+                    params=params,
+                    preview_callback=flight.publish_preview,
+                )
+            except Exception as e:
+                logger.exception("ComfyUI inpainting failed")
+                raise HTTPException(status_code=500, detail=f"ComfyUI inpainting failed: {e}")
+
+            try:
+                worker.check_deadline("store")
+                storage = get_shared_storage_service() if store else None
+                # Stream /view tới file tạm + storage cùng lúc (không giữ cả ảnh trong RAM)
+                result = await _store_result(storage, client, result_filename, worker, flight)
+                worker.record("stored", result=result.info["public_url"])
+            except Exception as e:
+                logger.exception("Failed to upload inpainting image to storage")
+                raise HTTPException(status_code=500, detail=f"Failed to upload image to storage: {e}")
+            return result
+
+        if mode == "image":
+            return await _image_response(job, key, _work, output)
+        result = await get_single_flight().run(key, job, _work)
+        try:
+            public_url, preview_url = result.info["public_url"], result.info["preview_url"]
+            result_url, content_type = await _store_variant(result, public_url, output)
+        finally:
+            result.release()
+        job.record("stored", result=result_url)
+
+        elapsed = time.time() - start_time
+
+        return {
+            "success": True,
+            "job_id": job.job_id,
+            "processing_time": elapsed,
+            "result_image_url": result_url,
+            "content_type": content_type,
+            "original_image_url": public_url,
+            "preview_url": preview_url,
+        }
 
 
 @app.post("/inpaint-image-from-url")
 async def inpaint_image_from_url(
+    request: Request,
     image_url: str = Form(...),
     prompt: str = Form(...),
     ref_image2_url: str = Form(None),
     ref_image3_url: str = Form(None),
+    steps: Optional[int] = Form(None),
+    guidance_scale: Optional[float] = Form(None),
+    preset: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None),
+    store: Optional[bool] = Form(None),
+    deadline: Optional[str] = Form(None),
 ):
     """API inpainting từ URL sử dụng workflow Inpainting.json.
     Các ảnh tham chiếu có thể để trống.
     """
-    def _download_to_temp(url: str) -> str:
-        r = requests.get(url, timeout=15)
-        r.raise_for_status()
-        tmpname = f"{uuid.uuid4().hex}.jpg"
-        tmpdir = os.path.join(os.getcwd(), "temp")
-        os.makedirs(tmpdir, exist_ok=True)
-        tmp_path = os.path.join(tmpdir, tmpname)
-        with open(tmp_path, "wb") as f:
-            f.write(r.content)
-        return tmp_path
-
-    try:
-        input_path = _download_to_temp(image_url)
-        ref2_path = _download_to_temp(ref_image2_url) if ref_image2_url else None
-        ref3_path = _download_to_temp(ref_image3_url) if ref_image3_url else None
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Failed to download image(s): {e}")
-
-    client = ComfyUIClient()
-    try:
-        result_filename = await asyncio.to_thread(
-            client.process_inpainting,
-            input_path,
-            prompt,
-            ref2_path,
-            ref3_path,
-        )
-        image_bytes = await asyncio.to_thread(client.get_image, result_filename, "", "output")
-    except Exception as e:
-        logger.exception("ComfyUI inpainting failed for URL flow")
-        raise HTTPException(status_code=500, detail=f"ComfyUI inpainting failed: {e}")
-
-    try:
-        storage = get_storage_service()
-        public_url = await storage.upload_image(image_bytes, result_filename, content_type="image/png")
-    except Exception as e:
-        logger.exception("Failed to upload inpainting image (URL flow) to storage")
-        raise HTTPException(status_code=500, detail=f"Failed to upload image to storage: {e}")
-
-    return {"success": True, "result_image_url": public_url}
+    params = {"steps": steps, "guidance_scale": guidance_scale}
+    _check_workflow_parameters("inpaint", preset, params)
+    output = _negotiate_output(request, output_format, quality)
+    mode, store = _response_mode(request, store)
+    # Fail nhanh nếu health prober biết chắc ComfyUI đang down
+    backend = _pick_comfyui_backend("inpaint")
+
+    async with _job_scope(request, "inpaint", backend, deadline) as job:
+        def _download_to_temp(url: str) -> str:
+            r = requests.get(url, timeout=job.timeout_for(15, "download"))
+            r.raise_for_status()
+            tmpname = f"{uuid.uuid4().hex}.jpg"
+            tmpdir = os.path.join(os.getcwd(), "temp")
+            os.makedirs(tmpdir, exist_ok=True)
+            tmp_path = job.add_temp_path(os.path.join(tmpdir, tmpname))
+            with open(tmp_path, "wb") as f:
+                f.write(r.content)
+            return tmp_path
+
+        try:
+            input_path, ref2_path, ref3_path = await asyncio.gather(
+                asyncio.to_thread(_download_to_temp, image_url),
+                asyncio.to_thread(_download_to_temp, ref_image2_url) if ref_image2_url else asyncio.sleep(0),
+                asyncio.to_thread(_download_to_temp, ref_image3_url) if ref_image3_url else asyncio.sleep(0),
+            )
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Failed to download image(s): {e}")
+
+        key = await _flight_key("inpaint", prompt, (input_path, ref2_path, ref3_path), preset, params, store)
+
+        async def _work(worker, flight):
+            client = ComfyUIClient(backend)
+            try:
+                result_filename = await asyncio.to_thread(
+                    client.process_inpainting,
+                    input_path,
+                    prompt,
+                    ref2_path,
+                    ref3_path,
+                    progress_callback=flight.publish_progress,
+                    job=worker,
+                    preset=preset,
+                    params=params,
+                    preview_callback=flight.publish_preview,
+                )
+            except Exception as e:
+                logger.exception("ComfyUI inpainting failed for URL flow")
+                raise HTTPException(status_code=500, detail=f"ComfyUI inpainting failed: {e}")
+
+            try:
+                worker.check_deadline("store")
+                storage = get_shared_storage_service() if store else None
+                # Stream /view tới file tạm + storage cùng lúc (không giữ cả ảnh trong RAM)
+                result = await _store_result(storage, client, result_filename, worker, flight)
+                worker.record("stored", result=result.info["public_url"])
+            except Exception as e:
+                logger.exception("Failed to upload inpainting image (URL flow) to storage")
+                raise HTTPException(status_code=500, detail=f"Failed to upload image to storage: {e}")
+            return result
+
+        if mode == "image":
+            return await _image_response(job, key, _work, output)
+        result = await get_single_flight().run(key, job, _work)
+        try:
+            public_url, preview_url = result.info["public_url"], result.info["preview_url"]
+            result_url, content_type = await _store_variant(result, public_url, output)
+        finally:
+            result.release()
+        job.record("stored", result=result_url)
+
+        return {"success": True, "job_id": job.job_id, "result_image_url": result_url, "content_type": content_type,
+                "original_image_url": public_url, "preview_url": preview_url}
 
 
 # ============== AUTO WORKFLOW SELECTION ==============
 
-def _classify_by_keywords(text: str) -> str:
-    t = (text or "").lower()
-    inpaint_keys = [
-        "inpaint", "change", "replace", "switch", "background", "remove object", "add object",
-        "doi", "thay", "thêm", "xóa", "đổi nền", "bãi biển", "beach", "blend lighting",
-        "áo", "quần", "tóc", "ghép", "edit"
-    ]
-    restore_keys = [
-        "restore", "recover", "enhance", "old photo", "fix scratch", "scratch", "stain",
-        "remove noise", "grain", "sharpen", "color", "exposure", "discolor", "blur",
-        "phục hồi", "phục chế", "khử nhiễu", "vết xước", "vết bẩn", "tăng chi tiết", "cân bằng màu"
-    ]
-    inpaint_score = sum(k in t for k in inpaint_keys)
-    restore_score = sum(k in t for k in restore_keys)
-    if inpaint_score > restore_score:
-        return "inpaint"
-    return "restore"
-
-
-def _classify_with_local_llm(text: str) -> str:
-    """Cố gắng phân loại qua LLM chạy local (ví dụ Ollama). Fallback sang keyword nếu lỗi.
-
-    Cấu hình qua env:
-    - OLLAMA_URL (mặc định http://localhost:11434)
-    - OLLAMA_MODEL (ví dụ: qwen2.5:3b, llama3.1:8b, v.v.)
-    - Nếu không có OLLAMA_MODEL, bỏ qua Ollama.
-    """
-    try:
-        ollama_model = os.getenv("OLLAMA_MODEL")
-        if not ollama_model:
-            return _classify_by_keywords(text)
-
-        ollama_url = os.getenv("OLLAMA_URL", "http://localhost:11434").rstrip("/")
-        url = f"{ollama_url}/api/generate"
-        instruction = (
-            "You are a classifier. Decide the best workflow for an image request. "
-            "Return exactly one token: 'restore' or 'inpaint'.\n\n"
-            "If the user asks to change content (background, clothes, remove/add objects), answer 'inpaint'. "
-            "If the user asks to restore/enhance/fix quality (scratches, noise, colors), answer 'restore'.\n\n"
-            f"User request: {text}\nAnswer:"
-        )
-        payload = {
-            "model": ollama_model,
-            "prompt": instruction,
-            "stream": False,
-        }
-        r = requests.post(url, json=payload, timeout=10)
-        r.raise_for_status()
-        data = r.json() or {}
-        resp = (data.get("response") or "").strip().lower()
-        if "inpaint" in resp:
-            return "inpaint"
-        if "restore" in resp:
-            return "restore"
-        # Nếu không chắc, fallback keyword
-        return _classify_by_keywords(text)
-    except Exception:
-        return _classify_by_keywords(text)
-
-
-def classify_workflow(user_text: str) -> str:
-    """Phân loại workflow: 'restore' hoặc 'inpaint' (LLM local -> keyword fallback)."""
-    return _classify_with_local_llm(user_text)
-
-
 @app.post("/process-image")
 async def process_image_auto(
+    request: Request,
     image: UploadFile = File(...),
     prompt: str = Form(...),
     ref_image2: UploadFile = File(None),
     ref_image3: UploadFile = File(None),
+    preset: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None),
+    store: Optional[bool] = Form(None),
+    deadline: Optional[str] = Form(None),
 ):
     """Endpoint tự động chọn workflow (Restore vs Inpainting) dựa trên yêu cầu người dùng.
 
     - Ưu tiên phân loại bằng LLM local (Ollama) nếu có OLLAMA_MODEL, nếu không fallback heuristic.
-    - Nếu chọn 'restore' → chạy process_image_recovery
-    - Nếu chọn 'inpaint' → chạy process_inpainting (dùng ref_image2/ref_image3 nếu có)
+    - Ảnh được upload lên ComfyUI song song với bước phân loại
+    - Nếu chọn 'restore' → chạy Restore.json
+    - Nếu chọn 'inpaint' → chạy Inpainting.json (dùng ref_image2/ref_image3 nếu có)
+    - preset ("draft"/"full") áp dụng cho workflow được chọn
+    - output_format/quality: định dạng ảnh kết quả như /inpaint-image
     """
-    start_time = time.time()
-
-    # Lưu file vào temp
-    try:
-        input_path = await _save_upload_to_temp(image)
-        ref2_path = await _save_upload_to_temp(ref_image2) if ref_image2 else None
-        ref3_path = await _save_upload_to_temp(ref_image3) if ref_image3 else None
-    except Exception as e:
-        logger.exception("Failed to save uploaded files for /process-image")
-        raise HTTPException(status_code=500, detail=f"Failed to save uploaded files: {e}")
-
-    selected = classify_workflow(prompt)
-
-    client = ComfyUIClient()
-    try:
-        if selected == "restore":
-            result_filename = await asyncio.to_thread(
-                client.process_image_recovery,
-                input_path,
-                prompt,
-                0.8,
-                20,
-                7.5,
-            )
-        else:
-            result_filename = await asyncio.to_thread(
-                client.process_inpainting,
-                input_path,
-                prompt,
-                ref2_path,
-                ref3_path,
-            )
-    except Exception as e:
-        logger.exception("ComfyUI processing failed for /process-image")
-        raise HTTPException(status_code=500, detail=f"ComfyUI processing failed: {e}")
-
-    try:
-        image_bytes = await asyncio.to_thread(client.get_image, result_filename, "", "output")
-    except Exception as e:
-        logger.exception("Failed to retrieve result image from ComfyUI (/process-image)")
-        raise HTTPException(status_code=500, detail=f"Failed to retrieve result image: {e}")
-
-    try:
-        storage = get_storage_service()
-        public_url = await storage.upload_image(image_bytes, result_filename, content_type="image/png")
-    except Exception as e:
-        logger.exception("Failed to upload image to storage (/process-image)")
-        raise HTTPException(status_code=500, detail=f"Failed to upload image to storage: {e}")
-
-    elapsed = time.time() - start_time
-    job_id = uuid.uuid4().hex
-
-    return {
-        "success": True,
-        "job_id": job_id,
-        "processing_time": elapsed,
-        "used_workflow": selected,
-        "result_image_url": public_url,
-    }
+    _check_workflow_parameters(("restore", "inpaint"), preset)
+    output = _negotiate_output(request, output_format, quality)
+    mode, store = _response_mode(request, store)
+    # Fail nhanh nếu health prober biết chắc ComfyUI đang down
+    backend = _pick_comfyui_backend(("restore", "inpaint"))
+
+    async with _job_scope(request, "auto", backend, deadline) as job:
+        start_time = time.time()
+
+        # Lưu file vào temp
+        try:
+            input_path = job.add_temp_path(await _save_upload_to_temp(image))
+            ref2_path = job.add_temp_path(await _save_upload_to_temp(ref_image2)) if ref_image2 else None
+            ref3_path = job.add_temp_path(await _save_upload_to_temp(ref_image3)) if ref_image3 else None
+        except Exception as e:
+            logger.exception("Failed to save uploaded files for /process-image")
+            raise HTTPException(status_code=500, detail=f"Failed to save uploaded files: {e}")
+
+        # Cùng ảnh + prompt thì bộ phân loại cũng chọn cùng workflow → gộp cả bước phân loại
+        key = await _flight_key("auto", prompt, (input_path, ref2_path, ref3_path), preset, store=store)
+
+        async def _work(worker, flight):
+            client = ComfyUIClient(backend)
+
+            async def _upload(path: Optional[str]) -> Optional[str]:
+                if not path:
+                    return None
+                return await asyncio.to_thread(client.upload_image_file, path, worker.timeout_for(None, "upload"))
+
+            # Upload ảnh lên ComfyUI song song với việc phân loại (Ollama có thể mất
+            # tới vài giây khi cache miss): ảnh upload giống nhau dù chọn workflow nào.
+            try:
+                selected, image1, image2, image3 = await asyncio.gather(
+                    asyncio.to_thread(classify_workflow, prompt),
+                    _upload(input_path),
+                    _upload(ref2_path),
+                    _upload(ref3_path),
+                )
+            except Exception as e:
+                logger.exception("Failed to upload images to ComfyUI for /process-image")
+                raise HTTPException(status_code=500, detail=f"ComfyUI processing failed: {e}")
+
+            try:
+                if selected == "restore":
+                    def _backup_input():
+                        # Giữ bản backup ảnh input như process_image_recovery
+                        with open(input_path, "rb") as f:
+                            client.backup_input_image(f.read(), image1)
+
+                    result_filename, _ = await asyncio.gather(
+                        asyncio.to_thread(client.run_restore, image1, prompt, flight.publish_progress,
+                                          job=worker, preset=preset, preview_callback=flight.publish_preview),
+                        asyncio.to_thread(_backup_input),
+                    )
+                    await asyncio.to_thread(client.clear_cache)
+                else:
+                    result_filename = await asyncio.to_thread(
+                        client.run_inpainting,
+                        image1,
+                        prompt,
+                        image2,
+                        image3,
+                        flight.publish_progress,
+                        job=worker,
+                        preset=preset,
+                        preview_callback=flight.publish_preview,
+                    )
+            except Exception as e:
+                logger.exception("ComfyUI processing failed for /process-image")
+                raise HTTPException(status_code=500, detail=f"ComfyUI processing failed: {e}")
+
+            try:
+                worker.check_deadline("store")
+                storage = get_shared_storage_service() if store else None
+                # Stream /view tới file tạm + storage cùng lúc (không giữ cả ảnh trong RAM)
+                result = await _store_result(storage, client, result_filename, worker, flight)
+                worker.record("stored", result=result.info["public_url"])
+            except Exception as e:
+                logger.exception("Failed to upload image to storage (/process-image)")
+                raise HTTPException(status_code=500, detail=f"Failed to upload image to storage: {e}")
+            result.info["selected"] = selected
+            return result
+
+        if mode == "image":
+            return await _image_response(job, key, _work, output)
+        result = await get_single_flight().run(key, job, _work)
+        try:
+            selected, public_url, preview_url = (result.info["selected"], result.info["public_url"],
+                                                 result.info["preview_url"])
+            result_url, content_type = await _store_variant(result, public_url, output)
+        finally:
+            result.release()
+        job.record("stored", result=result_url)
+
+        elapsed = time.time() - start_time
+
+        return {
+            "success": True,
+            "job_id": job.job_id,
+            "processing_time": elapsed,
+            "used_workflow": selected,
+            "result_image_url": result_url,
+            "content_type": content_type,
+            "original_image_url": public_url,
+            "preview_url": preview_url,
+        }
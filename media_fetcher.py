@@ -0,0 +1,49 @@
+import asyncio
+import logging
+import random
+from typing import List, Sequence, Union
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramMediaFetcher:
+    """Tải nhiều file Telegram song song thẳng vào bộ nhớ.
+
+    Mỗi file được resolve (`get_file`) và tải (`download_as_bytearray`) trong
+    cùng một vòng retry với exponential backoff + jitter. Tất cả file của một
+    job được tải đồng thời nên độ trễ bằng file chậm nhất thay vì tổng các file.
+    """
+
+    def __init__(self, bot, max_retries: int = None, backoff: float = None, max_backoff: float = 8.0):
+        self.bot = bot
+        self.max_retries = max_retries if max_retries is not None else config.TELEGRAM_DOWNLOAD_RETRIES
+        self.backoff = backoff if backoff is not None else config.TELEGRAM_DOWNLOAD_BACKOFF
+        self.max_backoff = max_backoff
+
+    async def fetch(self, file_id: str) -> bytes:
+        """Tải một file về dạng bytes, retry cả bước get_file lẫn bước download."""
+        last_error = None
+        for attempt in range(self.max_retries):
+            try:
+                tg_file = await self.bot.get_file(file_id)
+                data = await tg_file.download_as_bytearray()
+                logger.info(f"✅ Downloaded Telegram file {file_id}: {len(data)} bytes")
+                return bytes(data)
+            except Exception as e:
+                last_error = e
+                if attempt == self.max_retries - 1:
+                    break
+                delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+                delay += random.uniform(0, delay / 2)
+                logger.warning(
+                    f"Download of {file_id} failed (attempt {attempt + 1}/{self.max_retries}): {e}; "
+                    f"retrying in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+        raise last_error
+
+    async def fetch_many(self, file_ids: Sequence[str]) -> List[Union[bytes, Exception]]:
+        """Tải đồng thời nhiều file. Giữ nguyên thứ tự; file lỗi trả về Exception."""
+        return await asyncio.gather(*(self.fetch(fid) for fid in file_ids), return_exceptions=True)
@@ -0,0 +1,97 @@
+import json
+import time
+import struct
+import logging
+from typing import Any, Callable, Dict, Optional
+
+from config import config
+from log_setup import HOT_PATH
+
+logger = logging.getLogger(__name__)
+
+# Loại event trong binary frame của ComfyUI /ws (4 byte đầu, big-endian)
+PREVIEW_IMAGE = 1
+UNENCODED_PREVIEW_IMAGE = 2
+PREVIEW_IMAGE_WITH_METADATA = 4
+
+# PREVIEW_IMAGE: 4 byte tiếp theo là định dạng ảnh
+_IMAGE_FORMATS = {1: "image/jpeg", 2: "image/png"}
+
+# on_frame(frame) — frame = {"image", "content_type", "prompt_id", "node"}
+FrameCallback = Callable[[Dict[str, Any]], None]
+
+
+def _sniff_content_type(data: bytes) -> str:
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def decode_preview_frame(raw: bytes) -> Optional[Dict[str, Any]]:
+    """Giải mã binary frame preview của ComfyUI; None nếu không phải frame ảnh.
+
+    - PREVIEW_IMAGE: [event][format][ảnh]
+    - PREVIEW_IMAGE_WITH_METADATA: [event][độ dài metadata][metadata JSON][ảnh],
+      metadata có prompt_id/node_id để lọc đúng prompt
+    """
+    if len(raw) < 8:
+        return None
+    event, = struct.unpack(">I", raw[:4])
+    if event == PREVIEW_IMAGE:
+        fmt, = struct.unpack(">I", raw[4:8])
+        image = bytes(raw[8:])
+        return {"image": image, "content_type": _IMAGE_FORMATS.get(fmt) or _sniff_content_type(image),
+                "prompt_id": None, "node": None}
+    if event == PREVIEW_IMAGE_WITH_METADATA:
+        length, = struct.unpack(">I", raw[4:8])
+        try:
+            metadata = json.loads(raw[8:8 + length])
+        except ValueError:
+            return None
+        image = bytes(raw[8 + length:])
+        return {"image": image, "content_type": metadata.get("image_type") or _sniff_content_type(image),
+                "prompt_id": metadata.get("prompt_id"), "node": metadata.get("node_id")}
+    # UNENCODED_PREVIEW_IMAGE và các event khác: bỏ qua
+    return None
+
+
+class PreviewRelay:
+    """Nhận binary frame từ WS listener, giải mã và chuyển tiếp tối đa 1 frame mỗi `interval` giây.
+
+    KSampler gửi preview sau mỗi step (có thể vài chục frame/giây); frame tới trong
+    khoảng throttle bị bỏ. Callback chạy đồng bộ trên thread của WS listener nên
+    phải nhanh (vd chỉ lưu vào job hoặc schedule coroutine lên event loop).
+    """
+
+    def __init__(self, on_frame: FrameCallback, interval: float = None, prompt_id: Optional[str] = None):
+        self.on_frame = on_frame
+        self.interval = interval if interval is not None else config.PREVIEW_FRAME_INTERVAL
+        self.prompt_id = prompt_id
+        self.received = 0
+        self.relayed = 0
+        self._last_sent = 0.0
+
+    def feed(self, raw: bytes) -> bool:
+        """Xử lý một binary message; True nếu frame được chuyển tiếp."""
+        self.received += 1
+        now = time.monotonic()
+        if now - self._last_sent < self.interval:
+            return False
+        try:
+            frame = decode_preview_frame(raw)
+        except Exception as e:
+            logger.debug("Could not decode preview frame: %s", e, extra=HOT_PATH)
+            return False
+        if frame is None or not frame["image"]:
+            return False
+        if self.prompt_id and frame["prompt_id"] and frame["prompt_id"] != self.prompt_id:
+            return False
+        self._last_sent = now
+        self.relayed += 1
+        try:
+            self.on_frame(frame)
+        except Exception as e:
+            logger.warning("Preview frame callback raised: %s", e, extra=HOT_PATH)
+        return True
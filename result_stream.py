@@ -0,0 +1,309 @@
+import os
+import time
+import uuid
+import queue
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+from config import config
+from log_setup import bind_log_context
+
+logger = logging.getLogger(__name__)
+
+_EOF = object()
+# Đánh thức consumer đang chờ hàng đợi khi sink bị bỏ dở (không mang dữ liệu)
+_WAKE = object()
+
+
+class SinkAbandoned(Exception):
+    """Sink đã bỏ dở (lỗi upload, client HTTP ngắt kết nối)."""
+
+
+class TeeReader:
+    """File-like (read/tell) đọc các chunk mà StreamTee đẩy tới.
+
+    Hàng đợi giới hạn `maxsize` chunk: sink chậm làm chậm cả luồng (backpressure) thay vì
+    để dữ liệu dồn trong RAM. Chunk được chia sẻ giữa các sink, không chép.
+    Sink bị bỏ dở (abandon) thì lần đọc đang chờ và các lần đọc sau raise SinkAbandoned.
+    """
+
+    def __init__(self, name: str, maxsize: int, required: bool = False):
+        self.name = name
+        self.required = required
+        self.error: Optional[BaseException] = None
+        self._queue: "queue.Queue" = queue.Queue(maxsize=maxsize)
+        self._buffer = memoryview(b"")
+        self._pos = 0
+        self._eof = False
+        self._abandoned = threading.Event()
+
+    # ---------- phía StreamTee ----------
+    def feed(self, chunk: Any) -> bool:
+        """Đẩy chunk (hoặc _EOF) vào hàng đợi; False nếu sink đã bỏ dở.
+
+        Sink không đọc gì quá RESULT_STREAM_STALL_TIMEOUT giây (vd client HTTP treo) bị tách ra
+        để không giữ các sink khác.
+        """
+        deadline = time.monotonic() + config.RESULT_STREAM_STALL_TIMEOUT
+        while not self._abandoned.is_set():
+            try:
+                self._queue.put(chunk, timeout=0.5)
+                return True
+            except queue.Full:
+                if time.monotonic() > deadline:
+                    logger.warning(f"Stream sink '{self.name}' stalled, detaching it")
+                    self.abandon(SinkAbandoned(f"{self.name} stalled"))
+        return False
+
+    def finish(self, item: Any) -> None:
+        """Kết thúc luồng (_EOF hoặc lỗi nguồn) cho sink, kể cả sink đã bỏ dở: consumer đang
+        chờ luôn được đánh thức."""
+        if not self.feed(item):
+            self._wake()
+
+    def _wake(self) -> None:
+        try:
+            self._queue.put_nowait(_WAKE)
+        except queue.Full:
+            # Hàng đợi đầy thì consumer không bị chặn ở get(); lần chờ kế tiếp thấy cờ abandoned
+            pass
+
+    @property
+    def abandoned(self) -> bool:
+        return self._abandoned.is_set()
+
+    # ---------- phía sink ----------
+    def abandon(self, error: Optional[BaseException] = None) -> None:
+        """Sink bỏ dở: StreamTee ngừng đẩy chunk cho sink này (các sink khác không bị ảnh hưởng).
+
+        Thread consumer đang chờ next_chunk()/read() được đánh thức và nhận SinkAbandoned.
+        """
+        if error is not None and self.error is None:
+            self.error = error
+        self._abandoned.set()
+        self._wake()
+
+    def _get(self, timeout: Optional[float] = None) -> Any:
+        # queue.get() theo từng nhịp ngắn: không treo mãi nếu sink bị bỏ dở trong lúc chờ
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._abandoned.is_set():
+                raise SinkAbandoned(self.name) from self.error
+            wait = 0.5 if deadline is None else min(0.5, max(0.0, deadline - time.monotonic()))
+            try:
+                item = self._queue.get(timeout=wait)
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+                continue
+            if item is not _WAKE:
+                return item
+
+    def next_chunk(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        """Chunk kế tiếp (None = hết luồng). Dùng cho sink đọc theo chunk (HTTP, ghi file)."""
+        if self._buffer:
+            chunk, self._buffer = bytes(self._buffer), memoryview(b"")
+            self._pos += len(chunk)
+            return chunk
+        if self._eof:
+            return None
+        chunk = self._get(timeout)
+        if chunk is _EOF:
+            self._eof = True
+            return None
+        if isinstance(chunk, BaseException):
+            self._eof = True
+            raise chunk
+        self._pos += len(chunk)
+        return chunk
+
+    def read(self, size: int = -1) -> bytes:
+        """Đọc đúng `size` byte (ít hơn chỉ khi hết luồng) — đúng ngữ nghĩa resumable upload cần."""
+        if self.abandoned:
+            raise SinkAbandoned(self.name)
+        parts: List[bytes] = []
+        wanted = size if size is not None and size >= 0 else None
+        got = 0
+        while wanted is None or got < wanted:
+            if not self._buffer:
+                if self._eof:
+                    break
+                chunk = self._get()
+                if chunk is _EOF:
+                    self._eof = True
+                    break
+                if isinstance(chunk, BaseException):
+                    self._eof = True
+                    raise chunk
+                self._buffer = memoryview(chunk)
+            take = len(self._buffer) if wanted is None else min(len(self._buffer), wanted - got)
+            parts.append(self._buffer[:take].tobytes() if take < len(self._buffer) else bytes(self._buffer))
+            self._buffer = self._buffer[take:]
+            got += take
+        self._pos += got
+        return b"".join(parts) if len(parts) != 1 else parts[0]
+
+    def tell(self) -> int:
+        return self._pos
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+
+class StreamTee:
+    """Chép một luồng chunk (vd response /view của ComfyUI) tới nhiều sink cùng lúc.
+
+    Mỗi sink có một TeeReader với hàng đợi giới hạn; bộ nhớ mỗi job chỉ còn khoảng
+    `queue_size` chunk cho mỗi sink thay vì cả ảnh. Sink không bắt buộc bị lỗi chỉ
+    bị tách ra; sink bắt buộc (`required`) lỗi thì cả luồng dừng.
+    """
+
+    def __init__(self, queue_size: int = None):
+        self.queue_size = queue_size or config.RESULT_STREAM_QUEUE
+        self.readers: List[TeeReader] = []
+        self.bytes = 0
+
+    def reader(self, name: str, required: bool = False) -> TeeReader:
+        reader = TeeReader(name, self.queue_size, required=required)
+        self.readers.append(reader)
+        return reader
+
+    def pump(self, chunks: Iterable[bytes]) -> int:
+        """Đẩy toàn bộ luồng tới các sink (I/O đồng bộ → gọi qua asyncio.to_thread); trả về số byte."""
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                self.bytes += len(chunk)
+                live = 0
+                for reader in self.readers:
+                    if reader.abandoned:
+                        if reader.required:
+                            raise reader.error or SinkAbandoned(reader.name)
+                        continue
+                    if reader.feed(chunk):
+                        live += 1
+                if not live:
+                    raise SinkAbandoned("all sinks")
+        except BaseException as e:
+            # Báo lỗi nguồn cho các sink đang chờ để không treo
+            for reader in self.readers:
+                reader.finish(e if isinstance(e, Exception) else SinkAbandoned("source"))
+            raise
+        for reader in self.readers:
+            reader.finish(_EOF)
+        return self.bytes
+
+
+class ResultFile:
+    """Ảnh kết quả đã stream xuống file tạm trên đĩa, dùng chung giữa các request.
+
+    Đếm tham chiếu: mỗi người dùng file gọi release() khi xong; file bị xóa khi không
+    còn ai giữ (single_flight.py chia cho từng request đang chờ qua share()).
+    """
+
+    def __init__(self, filename: str, content_type: str = "image/png"):
+        tmpdir = os.path.join(os.getcwd(), "temp")
+        os.makedirs(tmpdir, exist_ok=True)
+        self.filename = filename
+        self.content_type = content_type
+        self.path = os.path.join(tmpdir, f"result_{uuid.uuid4().hex}{os.path.splitext(filename)[1] or '.png'}")
+        self.size = 0
+        self.digest: Optional[str] = None
+        # Thông tin kèm theo: URL trên storage, workflow đã chọn, ...
+        self.info: Dict[str, Any] = {}
+        self._refs = 1
+        self._lock = threading.Lock()
+
+    def write_from(self, reader: TeeReader) -> None:
+        """Sink ghi file + tính sha256 khi stream (I/O đồng bộ)."""
+        h = hashlib.sha256()
+        with open(self.path, "wb") as f:
+            while True:
+                chunk = reader.next_chunk()
+                if chunk is None:
+                    break
+                h.update(chunk)
+                f.write(chunk)
+                self.size += len(chunk)
+        self.digest = h.hexdigest()
+
+    def read_bytes(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def share(self, holders: int) -> None:
+        """Chia file cho `holders` người dùng (thay cho tham chiếu của người tạo)."""
+        with self._lock:
+            self._refs += holders - 1
+            remaining = self._refs
+        if remaining <= 0:
+            self._remove()
+
+    def release(self) -> None:
+        with self._lock:
+            self._refs -= 1
+            remaining = self._refs
+        if remaining <= 0:
+            self._remove()
+
+    def _remove(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not remove result file {self.path}: {e}")
+
+
+async def _consume(reader: TeeReader, coro) -> Any:
+    try:
+        return await coro
+    except BaseException as e:
+        reader.abandon(e)
+        raise
+
+
+async def stream_result(client, filename: str, storage=None, tee: Optional[StreamTee] = None,
+                        timeout: Optional[float] = None) -> ResultFile:
+    """Stream ảnh kết quả từ /view của ComfyUI tới file tạm, storage và các sink khác của `tee` cùng lúc.
+
+    - File tạm (bắt buộc): cho preview/transcode/Telegram sau đó
+    - Storage (nếu có): upload_stream chạy song song khi đang tải; lỗi chỉ log warning,
+      `result.info["public_url"]` = None
+    - Sink thêm (vd HTTP response) do caller tạo trước bằng tee.reader(...)
+    """
+    bind_log_context(stage="download")
+    tee = tee or StreamTee()
+    result = ResultFile(filename)
+    spool = tee.reader("file", required=True)
+    tasks = [_consume(spool, asyncio.to_thread(result.write_from, spool))]
+    if storage is not None:
+        upload = tee.reader("storage")
+        tasks.append(_consume(upload, storage.upload_stream(upload, filename, content_type=result.content_type)))
+
+    response = await asyncio.to_thread(client.open_image, filename, "", None, timeout)
+    try:
+        pumped, *outcomes = await asyncio.gather(asyncio.to_thread(tee.pump, response.iter_content(
+            config.RESULT_STREAM_CHUNK_SIZE)), *tasks, return_exceptions=True)
+    finally:
+        response.close()
+
+    if isinstance(outcomes[0], BaseException) or isinstance(pumped, BaseException):
+        result.release()
+        error = outcomes[0] if isinstance(outcomes[0], BaseException) else pumped
+        raise Exception(f"Failed to stream result image {filename}: {error}")
+    result.info["public_url"] = None
+    if storage is not None:
+        if isinstance(outcomes[1], BaseException):
+            logger.warning(f"Streaming upload of {filename} to storage failed: {outcomes[1]}")
+        else:
+            result.info["public_url"] = outcomes[1]
+    logger.info(f"Streamed result {filename} ({pumped} bytes) to {len(tee.readers)} sink(s)")
+    return result
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Script để chạy API server (FastAPI + uvicorn)
+"""
+
+import os
+import sys
+import logging
+from pathlib import Path
+
+# Thêm thư mục gốc vào Python path
+sys.path.append(str(Path(__file__).parent))
+
+import uvicorn
+
+from config import config
+from log_setup import setup_logging
+
+logger = logging.getLogger("run_api")
+
+
+class DrainingServer(uvicorn.Server):
+    """uvicorn.Server bật chế độ drain của app (main.start_draining) ngay khi nhận tín hiệu tắt.
+
+    uvicorn đăng ký bound method handle_exit làm signal handler trước khi chạy lifespan,
+    nên phải override ở đây thay vì patch từ trong app.
+    """
+
+    def handle_exit(self, sig, frame) -> None:
+        # main đã được uvicorn import ("main:app") trong process worker này
+        from main import start_draining
+        start_draining(f"signal {sig}")
+        super().handle_exit(sig, frame)
+
+
+def main_sync():
+    """Chạy API với API_WORKERS worker process.
+
+    Khi tắt (SIGTERM/Ctrl+C) app trả 503 cho job mới ngay lập tức, uvicorn ngừng nhận kết
+    nối mới và chờ request đang chạy; tổng thời gian chờ (cả job chạy nền) tối đa
+    API_SHUTDOWN_GRACE giây. Job bị cắt ngang vẫn nằm trong journal để lần khởi động sau
+    reattach vào prompt trên ComfyUI.
+    """
+    workers = max(1, config.API_WORKERS)
+    setup_logging()
+
+    if workers > 1:
+        # Mỗi worker có lifespan riêng: chỉ khôi phục job một lần, ở process cha
+        # (thread khôi phục chạy nền trong lúc uvicorn giám sát các worker)
+        from job_recovery import recover_unfinished_jobs
+        os.environ["RECOVER_JOBS_ON_STARTUP"] = "false"
+        recover_unfinished_jobs("api")
+        logger.info(f"Note: DISPATCH_MAX_INFLIGHT={config.DISPATCH_MAX_INFLIGHT} applies per worker "
+                    f"({workers} workers)")
+
+    print(f"Starting API on {config.API_HOST}:{config.API_PORT} with {workers} worker(s)")
+    server_config = uvicorn.Config(
+        "main:app",
+        host=config.API_HOST,
+        port=config.API_PORT,
+        workers=workers,
+        timeout_graceful_shutdown=int(config.API_SHUTDOWN_GRACE),
+        log_level=config.LOG_LEVEL.lower(),
+        # Log của uvicorn (kể cả access log) đi qua root logger → hàng đợi của log_setup
+        log_config=None,
+    )
+    server = DrainingServer(server_config)
+    if workers > 1:
+        # Như uvicorn.run(workers=N), nhưng mỗi worker chạy DrainingServer
+        from uvicorn.supervisors import Multiprocess
+        sock = server_config.bind_socket()
+        Multiprocess(server_config, target=server.run, sockets=[sock]).run()
+    else:
+        server.run()
+
+
+if __name__ == "__main__":
+    main_sync()
@@ -39,7 +39,7 @@ def check_requirements():
             return False
     except Exception as e:
         print(f"Khong the ket noi API: {e}")
-        print("Vui long chay API truoc: python main.py")
+        print("Vui long chay API truoc: python run_api.py")
         return False
     
     # Kiểm tra ComfyUI (máy hiện tại)
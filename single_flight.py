@@ -0,0 +1,235 @@
+import json
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from config import config
+from deadline import DeadlineExceeded
+from job_journal import TERMINAL_STATES
+from job_registry import Job, JobCancelled, get_job_registry
+from log_setup import HOT_PATH, bind_log_context
+from result_stream import StreamTee, TeeReader
+
+logger = logging.getLogger(__name__)
+
+# on_progress(data) / on_preview(frame): gọi đồng bộ từ thread WS listener
+Callback = Callable[[Dict[str, Any]], None]
+# on_stream(reader): gọi trên event loop khi worker bắt đầu stream ảnh kết quả
+StreamCallback = Callable[[TeeReader], None]
+
+
+def input_digest(data: bytes) -> str:
+    """Hash nội dung ảnh input (sha256, giống key của kho content-addressed)."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    """input_digest của file (I/O đồng bộ → gọi qua asyncio.to_thread)."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def coalescing_key(workflow: str, prompt: str, digests: Iterable[Optional[str]],
+                   params: Optional[Dict[str, Any]] = None) -> str:
+    """Key single-flight: hash input + workflow + prompt (+ preset/tham số, ảnh tham chiếu)."""
+    payload = json.dumps([workflow, prompt, list(digests), params or {}], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Flight:
+    """Một lần chạy ComfyUI dùng chung cho các request trùng nhau.
+
+    `worker` là job thực sự queue prompt lên ComfyUI; các request (kể cả request
+    đầu tiên) là thành viên nhận progress/preview/kết quả của worker. Worker chỉ bị
+    hủy khi thành viên cuối cùng rời đi.
+    """
+
+    def __init__(self, key: str, worker: Job):
+        self.key = key
+        self.worker = worker
+        self.task: Optional[asyncio.Task] = None
+        self._members: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def join(self, member: Job, on_progress: Optional[Callback] = None,
+             on_preview: Optional[Callback] = None, on_stream: Optional[StreamCallback] = None) -> None:
+        with self._lock:
+            self._members[member.job_id] = {"job": member, "progress": on_progress, "preview": on_preview,
+                                            "stream": on_stream}
+        member.coalesced_into = self.worker.job_id
+        # prompt_id/trạng thái của worker được ghi cả dưới job_id của thành viên (journal, recovery)
+        self.worker.add_follower(member)
+
+    def leave(self, member: Job) -> int:
+        """Gỡ thành viên; trả về số thành viên còn lại."""
+        self.worker.remove_follower(member)
+        with self._lock:
+            self._members.pop(member.job_id, None)
+            return len(self._members)
+
+    @property
+    def size(self) -> int:
+        return len(self._members)
+
+    def _subscribers(self):
+        with self._lock:
+            return list(self._members.values())
+
+    def publish_progress(self, data: Dict[str, Any]) -> None:
+        for sub in self._subscribers():
+            sub["job"].set_progress(data)
+            if sub["progress"] is not None:
+                try:
+                    sub["progress"](data)
+                except Exception as e:
+                    logger.warning("Progress subscriber of job %s raised: %s", sub["job"].job_id, e, extra=HOT_PATH)
+
+    def publish_preview(self, frame: Dict[str, Any]) -> None:
+        for sub in self._subscribers():
+            sub["job"].set_preview(frame)
+            if sub["preview"] is not None:
+                try:
+                    sub["preview"](frame)
+                except Exception as e:
+                    logger.warning("Preview subscriber of job %s raised: %s", sub["job"].job_id, e, extra=HOT_PATH)
+
+    def open_tee(self) -> StreamTee:
+        """StreamTee cho ảnh kết quả của worker; thành viên có on_stream nhận một TeeReader riêng.
+
+        Thành viên vào sau khi đã bắt đầu stream thì đọc từ file kết quả.
+        """
+        tee = StreamTee()
+        for sub in self._subscribers():
+            if sub["stream"] is None:
+                continue
+            reader = tee.reader(f"stream:{sub['job'].job_id}")
+            try:
+                sub["stream"](reader)
+            except Exception as e:
+                logger.warning(f"Stream subscriber of job {sub['job'].job_id} raised: {e}")
+                reader.abandon(e)
+        return tee
+
+
+# work(worker, flight) — chạy workflow bằng job `worker`, gửi progress qua flight.publish_*
+WorkFn = Callable[[Job, Flight], Awaitable[Any]]
+
+
+def _release_result(result: Any) -> None:
+    release = getattr(result, "release", None)
+    if release is not None:
+        release()
+
+
+class SingleFlight:
+    """Gộp các request giống hệt nhau đang chạy đồng thời vào một prompt ComfyUI.
+
+    Double-tap, client retry sau timeout của proxy hay ảnh được forward trong group chat
+    tạo ra nhiều request cùng input + workflow + prompt; request trùng key với một
+    flight đang chạy sẽ chờ kết quả của flight đó thay vì chiếm thêm slot GPU.
+    Dùng trên event loop của process (API hoặc bot).
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+
+    async def run(self, key: str, member: Job, work: WorkFn, on_progress: Optional[Callback] = None,
+                  on_preview: Optional[Callback] = None, on_stream: Optional[StreamCallback] = None) -> Any:
+        """Chạy `work` (hoặc gắn vào flight cùng key đang chạy) và trả về kết quả của nó.
+
+        Kết quả có release() (ResultFile) thì caller phải release khi dùng xong.
+        """
+        if not config.SINGLE_FLIGHT_ENABLED:
+            key = f"{key}:{member.job_id}"
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._start(key, member, work)
+        else:
+            logger.info(f"Job {member.job_id} coalesced into in-flight job {flight.worker.job_id} "
+                        f"({flight.size + 1} requests)")
+        flight.join(member, on_progress, on_preview, on_stream)
+
+        interrupted = delivered = False
+        try:
+            while True:
+                done, _ = await asyncio.wait({flight.task}, timeout=0.5)
+                if done:
+                    result = flight.task.result()
+                    delivered = True
+                    return result
+                member.check_cancelled()
+                member.check_deadline("wait")
+        except asyncio.CancelledError:
+            # Process đang tắt: giữ prompt của worker để job_recovery reattach
+            interrupted = True
+            raise
+        finally:
+            if not delivered and flight.task.done() and not flight.task.cancelled() \
+                    and flight.task.exception() is None:
+                # Flight xong đúng lúc request rời đi: trả phần tham chiếu kết quả của request này
+                _release_result(flight.task.result())
+            if flight.leave(member) == 0 and not flight.task.done() and not interrupted:
+                logger.info(f"All requests left job {flight.worker.job_id}, cancelling its prompt")
+                await asyncio.to_thread(flight.worker.cancel)
+
+    def _start(self, key: str, leader: Job, work: WorkFn) -> Flight:
+        # Worker nằm trong registry (drain khi tắt server) nhưng không có owner (/cancel của user
+        # chỉ hủy request của họ) và không ghi journal (các thành viên ghi thay, xem Job.follow)
+        worker = get_job_registry().create(leader.kind, backend=leader.backend, deadline=leader.deadline,
+                                           priority=leader.priority, source=leader.source, journaled=False)
+        # File tạm của request đầu tiên thuộc về worker: request đó có thể rời đi trước khi worker xong
+        worker.temp_paths, leader.temp_paths = leader.temp_paths, []
+        flight = Flight(key, worker)
+        self._flights[key] = flight
+        flight.task = asyncio.get_running_loop().create_task(self._run_flight(flight, work))
+        # Mọi thành viên đã rời đi thì không ai đọc lỗi của task → tránh cảnh báo "never retrieved"
+        flight.task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return flight
+
+    async def _run_flight(self, flight: Flight, work: WorkFn) -> Any:
+        worker = flight.worker
+        interrupted = False
+        # Task chép context của request đầu tiên → log của flight mang job_id của worker
+        bind_log_context(job_id=worker.job_id)
+        try:
+            result = await work(worker, flight)
+            # Kết quả giữ file tạm (result_stream.ResultFile) → mỗi request còn chờ giữ một tham chiếu
+            share = getattr(result, "share", None)
+            if share is not None:
+                share(flight.size)
+            if worker.state not in TERMINAL_STATES:
+                # Kết quả đã giao cho các request thành viên
+                worker.record("delivered")
+            return result
+        except BaseException as e:
+            interrupted = isinstance(e, asyncio.CancelledError) and not worker.cancelled
+            if worker.state not in TERMINAL_STATES and not isinstance(e, asyncio.CancelledError):
+                worker.record("cancelled" if worker.cancelled else "failed",
+                              error=None if isinstance(e, (JobCancelled, DeadlineExceeded)) else str(e))
+            raise
+        finally:
+            self._flights.pop(flight.key, None)
+            get_job_registry().finish(worker, interrupted=interrupted)
+
+    def tasks(self) -> List[asyncio.Task]:
+        """Task của các flight đang chạy (để chờ khi tắt server)."""
+        return [flight.task for flight in list(self._flights.values()) if flight.task is not None]
+
+    def stats(self) -> Dict[str, int]:
+        return {"inflight": len(self._flights),
+                "coalesced": sum(max(0, f.size - 1) for f in self._flights.values())}
+
+
+_single_flight: Optional[SingleFlight] = None
+
+
+def get_single_flight() -> SingleFlight:
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
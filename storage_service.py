@@ -1,11 +1,58 @@
 import os
+import time
+import asyncio
 import logging
-from typing import Optional
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+from urllib.parse import quote
 from abc import ABC, abstractmethod
 from config import config
+from local_store import extension_for, get_local_store
 
 logger = logging.getLogger(__name__)
 
+
+class UploadStats:
+    """Thống kê latency của các upload gần đây (thread-safe)."""
+
+    def __init__(self, window: int = 256):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+
+    def record(self, latency: float, size: int, ok: bool = True) -> None:
+        with self._lock:
+            self.count += 1
+            if ok:
+                self.bytes += size
+                self._latencies.append(latency)
+            else:
+                self.errors += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            count, errors, total = self.count, self.errors, self.bytes
+
+        def _pct(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+
+        return {
+            "uploads": count,
+            "errors": errors,
+            "bytes": total,
+            "p50_ms": _pct(0.5),
+            "p95_ms": _pct(0.95),
+            "max_ms": round(latencies[-1] * 1000, 1) if latencies else None,
+        }
+
+
 class StorageService(ABC):
     """Abstract base class cho storage service"""
     
@@ -14,93 +61,191 @@ class StorageService(ABC):
         """Upload ảnh và trả về URL"""
         pass
 
+    @abstractmethod
+    def upload_image_sync(self, image_bytes: bytes, filename: str, content_type: str = "image/png") -> str:
+        """Như upload_image nhưng block thread gọi: dùng từ thread worker (không có event loop)"""
+        pass
+
+    async def upload_stream(self, reader, filename: str, content_type: str = "image/png") -> str:
+        """Upload từ file-like đọc dần (result_stream.TeeReader); mặc định đọc hết rồi gọi upload_image."""
+        return await self.upload_image(await asyncio.to_thread(reader.read), filename, content_type=content_type)
+
+    def stats(self) -> Dict[str, Any]:
+        """Thống kê upload (latency p50/p95, số lỗi); mặc định không có."""
+        return {}
+
 class LocalStorageService(StorageService):
-    """Local storage implementation cho testing"""
+    """Local storage: kho content-addressed (local_store.py) được API phục vụ qua /files/{key}"""
     
     def __init__(self):
-        self.output_dir = "output_images"
-        os.makedirs(self.output_dir, exist_ok=True)
-        logger.info("Local Storage initialized successfully")
+        self.store = get_local_store()
+        self.base_url = config.LOCAL_STORAGE_PUBLIC_URL.rstrip("/")
+        self.upload_stats = UploadStats()
+        logger.info(f"Local Storage initialized successfully at {self.store.root}")
     
     async def upload_image(self, image_bytes: bytes, filename: str, content_type: str = "image/png") -> str:
-        """Lưu ảnh vào thư mục local và trả về đường dẫn"""
+        """Lưu ảnh vào kho local (ghi atomic, khử trùng lặp) và trả về URL HTTP"""
+        # Hash + ghi file là I/O đồng bộ → chạy trong thread
+        return await asyncio.to_thread(self.upload_image_sync, image_bytes, filename, content_type)
+
+    def upload_image_sync(self, image_bytes: bytes, filename: str, content_type: str = "image/png") -> str:
+        start = time.perf_counter()
         try:
-            import uuid
-            import time
-            
-            # Tạo tên file unique
-            timestamp = int(time.time())
-            unique_filename = f"{timestamp}_{filename}"
-            file_path = os.path.join(self.output_dir, unique_filename)
-            
-            # Lưu file
-            with open(file_path, 'wb') as f:
-                f.write(image_bytes)
-            
-            # Trả về đường dẫn file (trong thực tế sẽ là URL)
-            logger.info(f"Image saved locally: {file_path}")
-            return f"file://{os.path.abspath(file_path)}"
-            
+            key = self.store.put(image_bytes, extension_for(filename, content_type))
         except Exception as e:
+            self.upload_stats.record(time.perf_counter() - start, len(image_bytes), ok=False)
             logger.error(f"Failed to save image locally: {str(e)}")
             raise
+        self.upload_stats.record(time.perf_counter() - start, len(image_bytes))
+        url = f"{self.base_url}/files/{key}"
+        logger.info(f"Image saved locally: {url}")
+        return url
+
+    async def upload_stream(self, reader, filename: str, content_type: str = "image/png") -> str:
+        """Ghi thẳng luồng vào kho local theo chunk (hash trong lúc ghi)."""
+        start = time.perf_counter()
+        try:
+            key = await asyncio.to_thread(self.store.put_stream, reader, extension_for(filename, content_type))
+        except Exception as e:
+            self.upload_stats.record(time.perf_counter() - start, reader.tell(), ok=False)
+            logger.error(f"Failed to save image stream locally: {str(e)}")
+            raise
+        self.upload_stats.record(time.perf_counter() - start, reader.tell())
+        url = f"{self.base_url}/files/{key}"
+        logger.info(f"Image streamed to local storage: {url}")
+        return url
+
+    def stats(self) -> Dict[str, Any]:
+        return self.upload_stats.snapshot()
 
 class FirebaseStorageService(StorageService):
-    """Firebase Storage implementation"""
+    """Firebase Storage implementation
+
+    Upload chạy trên một thread pool giới hạn (STORAGE_UPLOAD_WORKERS). Quyền đọc
+    public được gắn ngay trong request upload (predefined ACL publicRead) hoặc để
+    bucket tự quản (STORAGE_PUBLIC_ACCESS=bucket), không gọi make_public() riêng.
+    Ảnh lớn hơn STORAGE_RESUMABLE_THRESHOLD dùng resumable upload theo chunk.
+    Nếu có STORAGE_EMULATOR_HOST thì kết nối thẳng tới GCS emulator (vd fake-gcs-server).
+    """
     
     def __init__(self):
+        self.emulator_host = os.getenv("STORAGE_EMULATOR_HOST")
         try:
-            import firebase_admin
-            from firebase_admin import credentials, storage
-            
-            if not firebase_admin._apps:
-                if config.FIREBASE_CREDENTIALS_PATH and os.path.exists(config.FIREBASE_CREDENTIALS_PATH):
-                    cred = credentials.Certificate(config.FIREBASE_CREDENTIALS_PATH)
-                    firebase_admin.initialize_app(cred, {
-                        'storageBucket': config.FIREBASE_STORAGE_BUCKET
-                    })
-                else:
-                    # Sử dụng default credentials (cho production)
-                    firebase_admin.initialize_app()
-            
-            self.bucket = storage.bucket()
-            logger.info("Firebase Storage initialized successfully")
-            
+            if self.emulator_host:
+                self.bucket = self._emulator_bucket()
+            else:
+                self.bucket = self._firebase_bucket()
         except ImportError:
             raise Exception("firebase-admin package not installed. Run: pip install firebase-admin")
         except Exception as e:
             logger.error(f"Failed to initialize Firebase Storage: {str(e)}")
             raise
+
+        self._executor = ThreadPoolExecutor(max_workers=config.STORAGE_UPLOAD_WORKERS,
+                                            thread_name_prefix="storage-upload")
+        self.upload_stats = UploadStats()
+        logger.info("Firebase Storage initialized successfully"
+                    + (f" (emulator at {self.emulator_host})" if self.emulator_host else ""))
+
+    def _emulator_bucket(self):
+        # google-cloud-storage tự dùng STORAGE_EMULATOR_HOST; emulator không cần credentials
+        from google.auth.credentials import AnonymousCredentials
+        from google.cloud import storage as gcs
+
+        client = gcs.Client(project=os.getenv("GOOGLE_CLOUD_PROJECT", "local"), credentials=AnonymousCredentials())
+        return client.bucket(config.FIREBASE_STORAGE_BUCKET)
+
+    def _firebase_bucket(self):
+        import firebase_admin
+        from firebase_admin import credentials, storage
+
+        if not firebase_admin._apps:
+            if config.FIREBASE_CREDENTIALS_PATH and os.path.exists(config.FIREBASE_CREDENTIALS_PATH):
+                cred = credentials.Certificate(config.FIREBASE_CREDENTIALS_PATH)
+                firebase_admin.initialize_app(cred, {
+                    'storageBucket': config.FIREBASE_STORAGE_BUCKET
+                })
+            else:
+                # Sử dụng default credentials (cho production)
+                firebase_admin.initialize_app()
+
+        return storage.bucket()
+
+    def _public_url(self, blob) -> str:
+        if self.emulator_host:
+            host = self.emulator_host if "://" in self.emulator_host else f"http://{self.emulator_host}"
+            return f"{host.rstrip('/')}/{self.bucket.name}/{quote(blob.name)}"
+        # public_url được tính local, không cần request
+        return blob.public_url
     
     async def upload_image(self, image_bytes: bytes, filename: str, content_type: str = "image/png") -> str:
         """Upload ảnh lên Firebase Storage"""
+        # GCS client là đồng bộ → chạy trên pool upload giới hạn để không chặn event loop
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._upload_bytes, image_bytes, filename, content_type, time.perf_counter())
+
+    def upload_image_sync(self, image_bytes: bytes, filename: str, content_type: str = "image/png") -> str:
+        # Vẫn qua pool upload: số upload đồng thời lên GCS giữ trong STORAGE_UPLOAD_WORKERS
+        return self._executor.submit(
+            self._upload_bytes, image_bytes, filename, content_type, time.perf_counter()).result()
+
+    def _upload_bytes(self, image_bytes: bytes, filename: str, content_type: str, start: float) -> str:
+        # Chạy trên thread của pool upload; `start` tính cả thời gian chờ pool
+        # Tạo blob reference
+        blob_name = f"recovered_images/{filename}"
+        blob = self.bucket.blob(blob_name)
+        if len(image_bytes) > config.STORAGE_RESUMABLE_THRESHOLD:
+            # Resumable upload theo chunk: lỗi mạng giữa chừng chỉ phải gửi lại chunk hiện tại
+            blob.chunk_size = config.STORAGE_CHUNK_SIZE
+        kwargs = {"content_type": content_type}
+        if config.STORAGE_PUBLIC_ACCESS == "object":
+            # Gắn quyền đọc public ngay trong request upload thay vì gọi make_public() sau đó
+            kwargs["predefined_acl"] = "publicRead"
         try:
-            import firebase_admin
-            from firebase_admin import storage
-            
-            # Tạo blob reference
-            blob_name = f"recovered_images/{filename}"
-            blob = self.bucket.blob(blob_name)
-            
-            # Upload image
-            blob.upload_from_string(
-                image_bytes,
-                content_type=content_type
-            )
-            
-            # Làm cho file public (tùy chọn)
-            blob.make_public()
-            
-            # Trả về public URL
-            public_url = blob.public_url
-            logger.info(f"Image uploaded to Firebase Storage: {public_url}")
-            
-            return public_url
-            
+            blob.upload_from_string(image_bytes, **kwargs)
+            public_url = self._public_url(blob)
         except Exception as e:
+            self.upload_stats.record(time.perf_counter() - start, len(image_bytes), ok=False)
             logger.error(f"Failed to upload image to Firebase Storage: {str(e)}")
             raise
 
+        latency = time.perf_counter() - start
+        self.upload_stats.record(latency, len(image_bytes))
+        logger.info(f"Image uploaded to Firebase Storage in {latency * 1000:.0f} ms: {public_url}")
+        return public_url
+
+    async def upload_stream(self, reader, filename: str, content_type: str = "image/png") -> str:
+        """Resumable upload đọc dần từ luồng: RAM chỉ giữ một chunk STORAGE_CHUNK_SIZE.
+
+        Kích thước chưa biết trước (đang tải từ ComfyUI) → chunk cuối ngắn hơn đánh dấu hết
+        luồng. Luồng không seek được nên lỗi giữa chừng không retry chunk mà báo lỗi.
+        """
+        blob = self.bucket.blob(f"recovered_images/{filename}")
+        blob.chunk_size = config.STORAGE_CHUNK_SIZE
+
+        def _upload() -> str:
+            kwargs = {"content_type": content_type}
+            if config.STORAGE_PUBLIC_ACCESS == "object":
+                kwargs["predefined_acl"] = "publicRead"
+            blob.upload_from_file(reader, **kwargs)
+            return self._public_url(blob)
+
+        start = time.perf_counter()
+        try:
+            public_url = await asyncio.get_running_loop().run_in_executor(self._executor, _upload)
+        except Exception as e:
+            self.upload_stats.record(time.perf_counter() - start, reader.tell(), ok=False)
+            logger.error(f"Failed to stream image to Firebase Storage: {str(e)}")
+            raise
+
+        latency = time.perf_counter() - start
+        self.upload_stats.record(latency, reader.tell())
+        logger.info(f"Image streamed to Firebase Storage in {latency * 1000:.0f} ms: {public_url}")
+        return public_url
+
+    def stats(self) -> Dict[str, Any]:
+        return self.upload_stats.snapshot()
+
 
 def get_storage_service() -> StorageService:
     """Factory function để tạo storage service"""
@@ -116,3 +261,16 @@ def get_storage_service() -> StorageService:
         except Exception as local_e:
             logger.error(f"Failed to initialize Local Storage: {str(local_e)}")
             raise Exception("Cannot initialize any storage service")
+
+
+_shared_storage: Optional[StorageService] = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_storage_service() -> StorageService:
+    """Storage service dùng chung trong process (chỉ khởi tạo một lần)."""
+    global _shared_storage
+    with _shared_lock:
+        if _shared_storage is None:
+            _shared_storage = get_storage_service()
+        return _shared_storage
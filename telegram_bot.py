@@ -1,36 +1,102 @@
 import os
+import time
 import logging
 import asyncio
-import tempfile
-import requests
-import json
-from typing import Dict, Optional
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from typing import Dict, Optional, Tuple
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from telegram.constants import ParseMode
-from telegram.error import BadRequest
-import httpx
 from io import BytesIO
 from PIL import Image
 
 from config import config
-from storage_service import get_storage_service
+from storage_service import get_shared_storage_service
 from comfyui_client import ComfyUIClient
-
-# Thiết lập logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+from loop_monitor import EventLoopLagMonitor
+from health_prober import get_health_prober
+from media_fetcher import TelegramMediaFetcher
+from workflow_classifier import classify_workflow
+from workflow_templates import (
+    DEFAULT_PRESET, build_restore_workflow, build_inpainting_workflow, pick_result_filename,
 )
+from job_registry import get_job_registry, Job, JobCancelled
+from deadline import DeadlineExceeded, deadline_for
+from job_recovery import recover_unfinished_jobs
+from image_preview import make_preview
+from image_transcode import negotiate_format, shutdown_transcode_pool, transcode_async, variant_filename
+from result_stream import ResultFile, stream_result
+from single_flight import coalescing_key, get_single_flight, input_digest
+from log_setup import HOT_PATH, bind_log_context, reset_log_context, setup_logging
+
+# Thiết lập logging (ghi qua hàng đợi ở thread riêng, xem log_setup.py)
+setup_logging()
 logger = logging.getLogger(__name__)
 
+class TelegramLivePreview:
+    """Hiển thị latent preview trong lúc sampling bằng một tin nhắn ảnh được edit liên tục.
+
+    `on_frame` được gọi từ thread WS listener (qua PreviewRelay); tối đa 1 lần gửi/edit
+    mỗi TELEGRAM_PREVIEW_INTERVAL giây và không chồng lệnh khi lần edit trước chưa xong.
+    """
+
+    def __init__(self, message, loop: asyncio.AbstractEventLoop, interval: float = None):
+        self.message = message
+        self.loop = loop
+        self.interval = interval if interval is not None else config.TELEGRAM_PREVIEW_INTERVAL
+        self._photo_msg = None
+        self._pending = None
+        self._last_sent = 0.0
+        self._closed = False
+
+    def on_frame(self, frame: Dict) -> None:
+        now = time.monotonic()
+        if self._closed or (self._pending is not None and not self._pending.done()):
+            return
+        if now - self._last_sent < self.interval:
+            return
+        self._last_sent = now
+        self._pending = asyncio.run_coroutine_threadsafe(self._show(frame["image"]), self.loop)
+
+    async def _show(self, image: bytes) -> None:
+        try:
+            photo = BytesIO(image)
+            photo.name = "preview.jpg"
+            if self._photo_msg is None:
+                self._photo_msg = await self.message.reply_photo(photo=photo, caption="👀 Xem trước (đang xử lý)...")
+            else:
+                await self._photo_msg.edit_media(InputMediaPhoto(photo, caption="👀 Xem trước (đang xử lý)..."))
+        except Exception as e:
+            logger.warning("Could not update live preview: %s", e, extra=HOT_PATH)
+
+    async def close(self) -> None:
+        """Xóa tin nhắn preview khi đã có kết quả (hoặc job lỗi/bị hủy)."""
+        self._closed = True
+        if self._pending is not None and not self._pending.done():
+            try:
+                await asyncio.wrap_future(self._pending)
+            except Exception:
+                pass
+        if self._photo_msg is not None:
+            try:
+                await self._photo_msg.delete()
+            except Exception as e:
+                logger.warning(f"Could not delete live preview message: {e}")
+            self._photo_msg = None
+
+
 class TelegramBot:
     def __init__(self, token: str):
         self.token = token
         self.application = None
         self.user_sessions = {}  # Lưu trữ session của người dùng
         # Khởi tạo storage service (Firebase nếu có, fallback Local)
-        self.storage = get_storage_service()
+        self.storage = get_shared_storage_service()
+        # Trạng thái ComfyUI/storage/Ollama được probe nền và cache lại
+        self.health = get_health_prober()
+        # Log cảnh báo khi có callback chiếm event loop quá lâu
+        self.loop_monitor = EventLoopLagMonitor()
+        # Task nền gửi ảnh full-res (giữ tham chiếu để không bị GC giữa chừng)
+        self._background_tasks = set()
         # Trạng thái luồng inpainting
         # user_sessions[user_id] sẽ có các khóa:
         #  - waiting_for_prompt: bool
@@ -59,6 +125,7 @@ Xin chào {user.first_name}! Tôi có thể giúp bạn phục hồi và cải t
 /help - Hướng dẫn chi tiết
 /settings - Cài đặt tham số mặc định
 /status - Kiểm tra trạng thái API
+/cancel - Hủy yêu cầu đang xử lý
 
 Hãy gửi ảnh để bắt đầu! 🚀
         """
@@ -102,16 +169,30 @@ Hãy gửi ảnh để bắt đầu! 🚀
         
         await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
     
+    _PRESET_LABELS = {"draft": "⚡ Nháp (nhanh)", "full": "💎 Đầy đủ"}
+
+    def _user_preset(self, user_id: int) -> str:
+        """Preset chất lượng user chọn trong /settings (mặc định: DEFAULT_PRESET)."""
+        return self.user_sessions.get(user_id, {}).get('settings', {}).get('preset', DEFAULT_PRESET)
+
+    _FORMAT_LABELS = {"jpeg": "🖼 JPEG", "webp": "🖼 WebP", "png": "🖼 PNG (lossless)"}
+
+    def _user_output_format(self, user_id: int) -> str:
+        """Định dạng ảnh gốc gửi cho user (/settings, mặc định TELEGRAM_OUTPUT_FORMAT)."""
+        requested = self.user_sessions.get(user_id, {}).get('settings', {}).get('output_format')
+        return negotiate_format(requested, default=config.TELEGRAM_OUTPUT_FORMAT)
+
     async def settings_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Xử lý lệnh /settings"""
         user_id = update.effective_user.id
         
         # Lấy settings hiện tại của user
-        current_settings = self.user_sessions.get(user_id, {}).get('settings', {
+        current_settings = {
             'strength': 0.8,
             'steps': 8,
-            'guidance_scale': 1.8
-        })
+            'guidance_scale': 1.8,
+            **self.user_sessions.get(user_id, {}).get('settings', {})
+        }
         
         settings_text = f"""
 ⚙️ **Cài đặt hiện tại:**
@@ -119,6 +200,8 @@ Hãy gửi ảnh để bắt đầu! 🚀
 🔧 **Strength:** {current_settings['strength']}
 📊 **Steps:** {current_settings['steps']}
 🎯 **Guidance Scale:** {current_settings['guidance_scale']}
+⚡ **Chất lượng:** {self._PRESET_LABELS.get(self._user_preset(user_id), self._user_preset(user_id))}
+🖼 **Định dạng ảnh:** {self._user_output_format(user_id).upper()}
 
 Sử dụng các nút bên dưới để thay đổi:
         """
@@ -132,6 +215,11 @@ Sử dụng các nút bên dưới để thay đổi:
                 InlineKeyboardButton("🎯 Guidance", callback_data="set_guidance"),
                 InlineKeyboardButton("🔄 Reset", callback_data="reset_settings")
             ],
+            [
+                InlineKeyboardButton(self._PRESET_LABELS["draft"], callback_data="preset_draft"),
+                InlineKeyboardButton(self._PRESET_LABELS["full"], callback_data="preset_full")
+            ],
+            [InlineKeyboardButton(label, callback_data=f"format_{fmt}") for fmt, label in self._FORMAT_LABELS.items()],
             [InlineKeyboardButton("✅ Hoàn thành", callback_data="close_settings")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -143,30 +231,48 @@ Sử dụng các nút bên dưới để thay đổi:
         )
     
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Kiểm tra trạng thái API"""
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get("http://localhost:8000/health", timeout=10)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    status_text = f"""
+        """Kiểm tra trạng thái hệ thống (đọc từ cache của health prober)"""
+        services = self.health.summary()
+        backends = len(self.health.healthy_backends())
+        status_text = f"""
 📊 **Trạng thái hệ thống:**
 
-🟢 **API:** Hoạt động bình thường
-🤖 **ComfyUI:** {data['services']['comfyui']}
-☁️ **Storage:** {data['services']['storage']}
-
-Sẵn sàng xử lý ảnh! 🚀
-                    """
-                else:
-                    status_text = "🔴 API không hoạt động. Vui lòng thử lại sau."
-                    
-        except Exception as e:
-            status_text = f"❌ Không thể kết nối API: {str(e)}"
+🤖 **ComfyUI:** {services['comfyui']} ({backends}/{len(self.health.comfy_urls)} backend)
+☁️ **Storage:** {services['storage']}
+🧠 **Ollama:** {services['ollama']}
+        """
+        if services['comfyui'] != 'running':
+            status_text += "\n🔴 ComfyUI chưa sẵn sàng. Vui lòng thử lại sau."
+        else:
+            status_text += "\nSẵn sàng xử lý ảnh! 🚀"
         
-        await update.message.reply_text(status_text, parse_mode=ParseMode.MARKDOWN)
+        await update.effective_message.reply_text(status_text, parse_mode=ParseMode.MARKDOWN)
     
+    async def cancel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Xử lý lệnh /cancel: hủy job đang chạy (kể cả prompt trên ComfyUI) và reset session"""
+        user_id = update.effective_user.id
+        registry = get_job_registry()
+        jobs = registry.find_by_owner(user_id)
+        # Hủy remote có gọi HTTP → chạy trong thread
+        for job in jobs:
+            await asyncio.to_thread(registry.cancel, job.job_id)
+
+        sess = self.user_sessions.get(user_id)
+        if sess:
+            task = sess.pop('main_upload_task', None)
+            # Job đang đợi task này sẽ tự dừng ở check_cancelled, chỉ hủy task khi chưa có job
+            if task is not None and not task.done() and not jobs:
+                task.cancel()
+            for key in ('waiting_for_prompt', 'awaiting_ref_choice', 'waiting_for_ref_images'):
+                sess[key] = False
+            for key in ('photo_file_id', 'ref_file_ids', 'workflow_prompt'):
+                sess.pop(key, None)
+
+        if jobs:
+            await update.effective_message.reply_text(f"🛑 Đang hủy {len(jobs)} yêu cầu...")
+        else:
+            await update.effective_message.reply_text("ℹ️ Không có yêu cầu nào đang xử lý.")
+
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Xử lý khi người dùng gửi ảnh"""
         user_id = update.effective_user.id
@@ -183,6 +289,7 @@ Sẵn sàng xử lý ảnh! 🚀
         # Lưu file_id để sử dụng sau
         self.user_sessions[user_id]['photo_file_id'] = photo.file_id
         self.user_sessions[user_id]['waiting_for_prompt'] = True
+        self.user_sessions[user_id].pop('main_upload_task', None)
         
         logger.info(f"User {user_id} session updated: {self.user_sessions[user_id]}")
         
@@ -198,8 +305,8 @@ Sẵn sàng xử lý ảnh! 🚀
         text = update.message.text.strip()
         
         # Debug logging
-        logger.info(f"User {user_id} sent text: '{text}'")
-        logger.info(f"User session: {self.user_sessions.get(user_id, 'No session')}")
+        logger.info("User %s sent text: %r", user_id, text)
+        logger.debug("User session: %s", self.user_sessions.get(user_id, "No session"))
         
         # QUAN TRỌNG: Kiểm tra waiting_for_ref_images TRƯỚC waiting_for_prompt
         # để tránh nhầm khi user nhắn "xong" trong luồng inpainting
@@ -223,7 +330,12 @@ Sẵn sàng xử lý ảnh! 🚀
             # Lưu prompt vào session
             self.user_sessions[user_id]['workflow_prompt'] = text
 
-            selected = self.classify_workflow(text)
+            # Tải + upload ảnh chính lên ComfyUI song song với bước phân loại:
+            # ảnh upload giống nhau dù chọn workflow nào
+            self._start_main_upload(context, user_id)
+
+            # Ollama có thể mất tới 10s → chạy trong thread để không chặn các user khác
+            selected = await asyncio.to_thread(self.classify_workflow, text)
             self.user_sessions[user_id]['selected_workflow'] = selected
             logger.info(f"Classified workflow: {selected}")
 
@@ -263,114 +375,148 @@ Sẵn sàng xử lý ảnh! 🚀
         Chỉ thay ảnh đầu vào và text_b của node StringFunction|pysssss."""
         user_id = update.effective_user.id
         processing_msg = None
+        job = None
+        live_preview = None
+        result = None
+        log_token = None
         
         try:
-            # Health check ComfyUI trước khi xử lý để báo lỗi sớm
-            comfy = ComfyUIClient()
-            if not comfy.health_check():
+            # Health check ComfyUI (đọc cache của prober) trước khi xử lý để báo lỗi sớm
+            if self.health.pick_backend("restore") is None:
                 await update.message.reply_text(
                     "❌ Không thể kết nối ComfyUI. Hãy kiểm tra cấu hình COMFYUI_SERVER_URL, port 8188, và firewall rồi thử lại.")
                 return
 
+            # Đăng ký job để user có thể /cancel
+            job = get_job_registry().create("restore", owner=user_id, deadline=deadline_for("restore"),
+                                              priority=config.BOT_PRIORITY, source="bot")
+            log_token = bind_log_context(job_id=job.job_id)
+
             processing_msg = await update.message.reply_text(
                 "🔄 Đang xử lý ảnh... Vui lòng chờ trong giây lát...",
                 parse_mode=ParseMode.MARKDOWN
             )
 
-            photo_file_id = self.user_sessions[user_id]['photo_file_id']
-            file = await context.bot.get_file(photo_file_id)
-
-            with tempfile.TemporaryDirectory() as tmpdir:
-                local_path = os.path.join(tmpdir, "input.jpg")
-                await file.download_to_drive(local_path)
+            # Ảnh đã được tải + upload song song khi phân loại prompt
+            backend, image_filename, image_digest = await self._get_main_upload(context, user_id)
+            job.check_cancelled()
+            if not self.health.validator.supports(backend, "restore"):
+                raise Exception(f"ComfyUI backend {backend} cannot run the restore workflow")
+            job.check_deadline("upload")
 
-                client = ComfyUIClient()
+            client = ComfyUIClient(backend)
+            
+            # Lấy thông tin queue trước khi bắt đầu
+            try:
+                queue_info = await asyncio.to_thread(client.get_queue_status)
+                queue_pending = queue_info.get('queue_pending', [])
+                queue_running = queue_info.get('queue_running', [])
                 
-                # Lấy thông tin queue trước khi bắt đầu
-                try:
-                    queue_info = client.get_queue_status()
-                    queue_pending = queue_info.get('queue_pending', [])
-                    queue_running = queue_info.get('queue_running', [])
+                if queue_pending or queue_running:
+                    queue_text = f"📊 **Queue Status:**\n"
+                    if queue_running:
+                        queue_text += f"🔄 Đang chạy: {len(queue_running)} task(s)\n"
+                    if queue_pending:
+                        queue_text += f"⏳ Đang chờ: {len(queue_pending)} task(s)\n"
                     
-                    if queue_pending or queue_running:
-                        queue_text = f"📊 **Queue Status:**\n"
-                        if queue_running:
-                            queue_text += f"🔄 Đang chạy: {len(queue_running)} task(s)\n"
-                        if queue_pending:
-                            queue_text += f"⏳ Đang chờ: {len(queue_pending)} task(s)\n"
+                    await processing_msg.edit_text(
+                        f"🔄 Đang xử lý ảnh...\n\n{queue_text}\n⏱️ Vui lòng chờ...",
+                        parse_mode=ParseMode.MARKDOWN
+                    )
+            except Exception as e:
+                logger.warning(f"Could not get queue info: {e}")
+            
+            # Định nghĩa progress callback để cập nhật tin nhắn
+            async def progress_callback(progress_info):
+                try:
+                    if not processing_msg:
+                        return
                         
-                        await processing_msg.edit_text(
-                            f"🔄 Đang xử lý ảnh...\n\n{queue_text}\n⏱️ Vui lòng chờ...",
-                            parse_mode=ParseMode.MARKDOWN
-                        )
+                    # Lấy thông tin progress
+                    current_step = progress_info.get('value', 0)
+                    max_steps = progress_info.get('max', 1)
+                    node_name = progress_info.get('node', 'Unknown')
+                    
+                    # Tính phần trăm
+                    if max_steps > 0:
+                        percentage = int((current_step / max_steps) * 100)
+                    else:
+                        percentage = 0
+                    
+                    # Tạo progress bar
+                    progress_bar = "█" * (percentage // 10) + "░" * (10 - percentage // 10)
+                    
+                    # Cập nhật tin nhắn với progress
+                    progress_text = f"🔄 **Đang xử lý ảnh...**\n\n"
+                    progress_text += f"📊 **Progress:** {progress_bar} {percentage}%\n"
+                    progress_text += f"🎯 **Node:** {node_name}\n"
+                    progress_text += f"⏱️ **Step:** {current_step}/{max_steps}\n\n"
+                    progress_text += f"⏳ Vui lòng chờ..."
+                    
+                    await processing_msg.edit_text(
+                        progress_text,
+                        parse_mode=ParseMode.MARKDOWN
+                    )
                 except Exception as e:
-                    logger.warning(f"Could not get queue info: {e}")
-                
-                # Định nghĩa progress callback để cập nhật tin nhắn
-                async def progress_callback(progress_info):
-                    try:
-                        if not processing_msg:
-                            return
-                            
-                        # Lấy thông tin progress
-                        current_step = progress_info.get('value', 0)
-                        max_steps = progress_info.get('max', 1)
-                        node_name = progress_info.get('node', 'Unknown')
-                        
-                        # Tính phần trăm
-                        if max_steps > 0:
-                            percentage = int((current_step / max_steps) * 100)
-                        else:
-                            percentage = 0
-                        
-                        # Tạo progress bar
-                        progress_bar = "█" * (percentage // 10) + "░" * (10 - percentage // 10)
-                        
-                        # Cập nhật tin nhắn với progress
-                        progress_text = f"🔄 **Đang xử lý ảnh...**\n\n"
-                        progress_text += f"📊 **Progress:** {progress_bar} {percentage}%\n"
-                        progress_text += f"🎯 **Node:** {node_name}\n"
-                        progress_text += f"⏱️ **Step:** {current_step}/{max_steps}\n\n"
-                        progress_text += f"⏳ Vui lòng chờ..."
-                        
-                        await processing_msg.edit_text(
-                            progress_text,
-                            parse_mode=ParseMode.MARKDOWN
-                        )
-                    except Exception as e:
-                        logger.warning(f"Could not update progress: {e}")
-                
-                # Sử dụng method mới với progress callback
+                    logger.warning("Could not update progress: %s", e, extra=HOT_PATH)
+            
+            # Latent preview trong lúc sampling (edit một tin nhắn ảnh)
+            loop = asyncio.get_running_loop()
+            if config.TELEGRAM_LIVE_PREVIEW:
+                live_preview = TelegramLivePreview(update.message, loop)
+
+            preset = self._user_preset(user_id)
+
+            async def _work(worker, flight):
+                # Sử dụng method mới với progress callback; progress/preview phát tới mọi request đang chờ
                 result_filename = await self._process_with_progress(
-                    client, local_path, prompt, progress_callback
+                    client, image_filename, prompt, flight.publish_progress, worker, preset,
+                    preview_callback=flight.publish_preview,
                 )
-
-                # Tải ảnh kết quả từ ComfyUI
-                img_bytes = client.get_image(result_filename)
+                # Stream ảnh kết quả từ ComfyUI xuống file tạm, upload storage cùng lúc
+                return await stream_result(client, result_filename, self.storage,
+                                           timeout=worker.timeout_for(None, "download"))
+
+            # Cùng ảnh + prompt + preset đang chạy (gửi lại, ảnh forward trong group) → dùng chung kết quả
+            result = await get_single_flight().run(
+                coalescing_key("restore", prompt, [image_digest], {"preset": preset}), job, _work,
+                on_progress=lambda data: asyncio.run_coroutine_threadsafe(progress_callback(data), loop),
+                on_preview=live_preview.on_frame if live_preview else None,
+            )
 
             if processing_msg:
                 await processing_msg.delete()
+            if live_preview:
+                await live_preview.close()
 
-            # Upload ảnh kết quả lên storage để lấy URL
-            try:
-                public_url = await self.storage.upload_image(img_bytes, result_filename, content_type="image/png")
-            except Exception:
-                # Nếu upload lỗi, gửi ảnh trực tiếp như fallback
-                await update.message.reply_photo(
-                    photo=BytesIO(img_bytes),
-                    caption=f"🎨 Ảnh đã được phục hồi!\n\nPrompt: {prompt}"
-                )
-            else:
-                # Gửi ảnh qua URL
-                await update.message.reply_photo(
-                    photo=public_url,
-                    caption=f"🎨 Ảnh đã được phục hồi!\n\nPrompt: {prompt}"
-                )
+            # Gửi ngay preview nhỏ; ảnh full-res được upload + gửi ở nền
+            await self._send_preview_then_full(
+                update.message, result,
+                f"🎨 Ảnh đã được phục hồi!\n\nPrompt: {prompt}", job, user_id,
+            )
+            result = None  # _deliver_full_result release file khi gửi xong
 
             self.user_sessions[user_id]['waiting_for_prompt'] = False
             if 'photo_file_id' in self.user_sessions[user_id]:
                 del self.user_sessions[user_id]['photo_file_id']
+            self.user_sessions[user_id].pop('main_upload_task', None)
 
+        except JobCancelled:
+            logger.info(f"Restore job cancelled by user {user_id}")
+            if processing_msg:
+                try:
+                    await processing_msg.delete()
+                except:
+                    pass
+            await update.message.reply_text("🛑 Đã hủy yêu cầu xử lý ảnh.")
+        except DeadlineExceeded as e:
+            logger.warning(f"Restore job for user {user_id} shed: {e}")
+            if processing_msg:
+                try:
+                    await processing_msg.delete()
+                except:
+                    pass
+            await update.message.reply_text("⏱️ Hệ thống đang quá tải, không kịp xử lý ảnh trong thời gian cho phép. Vui lòng thử lại sau.")
         except Exception as e:
             logger.error(f"Error processing image recovery: {str(e)}")
             
@@ -383,7 +529,8 @@ Sẵn sàng xử lý ảnh! 🚀
             
             # Phân loại lỗi kết nối ComfyUI để báo rõ ràng
             msg = str(e)
-            if "Failed to queue prompt" in msg or "Network error queueing prompt" in msg or "Timeout" in msg:
+            if ("Failed to queue prompt" in msg or "Network error queueing prompt" in msg or "Timeout" in msg
+                    or "circuit open" in msg):
                 friendly = (
                     "❌ Không thể kết nối ComfyUI.\n\n"
                     "- Kiểm tra COMFYUI_SERVER_URL (không dùng localhost nếu bot chạy khác máy).\n"
@@ -393,46 +540,35 @@ Sẵn sàng xử lý ảnh! 🚀
             else:
                 friendly = f"❌ Đã xảy ra lỗi: {msg}"
             await update.message.reply_text(friendly)
+        finally:
+            if live_preview:
+                await live_preview.close()
+            if result is not None:
+                result.release()
+            if job is not None:
+                # Quá hạn mà prompt vẫn còn trên ComfyUI → gỡ ra để không chiếm GPU (request gộp chung:
+                # prompt chỉ bị hủy khi không còn thành viên nào chờ, xem SingleFlight.run)
+                if job.deadline.expired and job.prompt_id and not job.cancelled:
+                    await asyncio.to_thread(job.cancel)
+                get_job_registry().finish(job)
+            if log_token is not None:
+                reset_log_context(log_token)
     
-    async def _process_with_progress(self, client: ComfyUIClient, local_path: str, prompt: str, progress_callback):
-        """Xử lý ảnh với progress tracking"""
+    async def _process_with_progress(self, client: ComfyUIClient, image_filename: str, prompt: str, progress_callback,
+                                     job: Optional[Job] = None, preset: Optional[str] = None,
+                                     preview_callback=None):
+        """Xử lý ảnh (đã upload lên ComfyUI) với progress tracking"""
         try:
-            # 1) Upload ảnh lên ComfyUI server với unique filename
-            if not local_path:
-                raise Exception("input_image_path is required")
+            if not image_filename:
+                raise Exception("input image is required")
             
-            # Tạo unique filename để tránh conflict
-            import time
-            import uuid
-            timestamp = int(time.time())
-            unique_id = str(uuid.uuid4())[:8]
-            original_filename = os.path.basename(local_path)
-            name, ext = os.path.splitext(original_filename)
-            unique_filename = f"{name}_{timestamp}_{unique_id}{ext}"
-            
-            # Upload lên ComfyUI server
-            url = f"{client.server_url.rstrip('/')}/upload/image"
-            with open(local_path, "rb") as f:
-                files = {"image": (unique_filename, f, "application/octet-stream")}
-                response = requests.post(url, files=files)
-                response.raise_for_status()
-            
-            image_filename = unique_filename
-            logger.info(f"Uploaded image with unique name: {image_filename}")
-            
-            # 2) Clear cache ComfyUI để đảm bảo workflow chạy đầy đủ
-            client.clear_cache()
+            def _prepare_workflow() -> dict:
+                # Clear cache ComfyUI để đảm bảo workflow chạy đầy đủ (I/O đồng bộ → chạy trong thread)
+                client.clear_cache()
+                # Thay ảnh input, prompt và preset chất lượng của user
+                return build_restore_workflow(image_filename, prompt, preset=preset)
 
-            # 3) Đọc workflow gốc từ Restore.json
-            with open("workflows/Restore.json", "r", encoding="utf-8") as f:
-                workflow = json.loads(f.read())
-            
-            # 4) Chỉ thay đổi 2 thứ: ảnh input và prompt
-            workflow["75"]["inputs"]["image"] = image_filename
-            workflow["60"]["inputs"]["text_b"] = prompt
-            
-            logger.info(f"Updated LoadImage node 75: '{image_filename}'")
-            logger.info(f"Updated StringFunction node 60 with prompt: {prompt}")
+            workflow = await asyncio.to_thread(_prepare_workflow)
 
             # 5) Gửi workflow và đợi kết quả với progress tracking
             # Use ComfyUIClient.queue_prompt_with_progress in a thread so that
@@ -443,9 +579,12 @@ Sẵn sàng xử lý ảnh! 🚀
                 # Adapt sync callback called from background thread to async callback
                 if progress_callback:
                     try:
+                        if not asyncio.iscoroutinefunction(progress_callback):
+                            progress_callback(data)
+                            return
                         asyncio.run_coroutine_threadsafe(progress_callback(data), loop)
                     except Exception as e:
-                        logger.warning(f"Failed to schedule progress callback: {e}")
+                        logger.warning("Failed to schedule progress callback: %s", e, extra=HOT_PATH)
 
             logger.info("Queueing prompt and listening for progress (WS preferred)")
             # This will run the WS listening logic in a background thread and return final history
@@ -453,51 +592,18 @@ Sẵn sàng xử lý ảnh! 🚀
                 client.queue_prompt_with_progress,
                 workflow,
                 _thread_progress_cb,
-                600  # timeout 600 giây (10 phút)
+                600,  # timeout 600 giây (10 phút)
+                job=job,
+                preview_callback=preview_callback,
             )
             
             logger.info(f"Workflow completed successfully")
 
             # 6) Lấy ảnh kết quả
-            outputs = result.get("outputs", {}) or {}
-            preferred = None
-            fallback = None
-            any_image = None
-            
-            for node_id, out in outputs.items():
-                if not isinstance(out, dict):
-                    continue
-                images = out.get("images") or []
-                if not images:
-                    continue
-                filename = images[0].get("filename")
-                if not filename:
-                    continue
-                
-                # Lưu ảnh đầu tiên làm fallback
-                if any_image is None:
-                    any_image = (node_id, filename)
-                
-                # Ưu tiên node 18 (RESULT)
-                if str(node_id) == "18":
-                    preferred = (node_id, filename)
-                
-                # Fallback không phải node 19 (ORIGINAL)
-                if str(node_id) != "19" and fallback is None:
-                    fallback = (node_id, filename)
-
-            if preferred:
-                logger.info(f"Using RESULT from node {preferred[0]}: {preferred[1]}")
-                return preferred[1]
-            if fallback:
-                logger.info(f"Using non-ORIGINAL image from node {fallback[0]}: {fallback[1]}")
-                return fallback[1]
-            if any_image:
-                logger.info(f"Using first available image from node {any_image[0]}: {any_image[1]}")
-                return any_image[1]
-            
-            raise Exception("Không tìm thấy ảnh output trong kết quả.")
+            return pick_result_filename("restore", result)
 
+        except (JobCancelled, DeadlineExceeded):
+            raise
         except Exception as e:
             logger.error(f"Error processing image recovery: {str(e)}")
             raise
@@ -510,14 +616,14 @@ Sẵn sàng xử lý ảnh! 🚀
         while time.time() - start_time < timeout:
             try:
                 # Lấy thông tin progress
-                progress_info = client.get_progress()
+                progress_info = await asyncio.to_thread(client.get_progress)
                 
                 # Gọi callback nếu có
                 if progress_callback:
                     await progress_callback(progress_info)
                 
                 # Kiểm tra history
-                history = client.get_history(prompt_id)
+                history = await asyncio.to_thread(client.get_history, prompt_id)
                 
                 if prompt_id in history:
                     prompt_data = history[prompt_id]
@@ -554,6 +660,14 @@ Sẵn sàng xử lý ảnh! 🚀
             await self.status_command(update, context)
         elif query.data == "close_settings":
             await query.edit_message_text("✅ Cài đặt đã được lưu!")
+        elif query.data in ("preset_draft", "preset_full"):
+            preset = query.data[len("preset_"):]
+            self.user_sessions.setdefault(user_id, {}).setdefault('settings', {})['preset'] = preset
+            await query.edit_message_text(f"✅ Chất lượng xử lý: {self._PRESET_LABELS[preset]}")
+        elif query.data in ("format_jpeg", "format_webp", "format_png"):
+            fmt = query.data[len("format_"):]
+            self.user_sessions.setdefault(user_id, {}).setdefault('settings', {})['output_format'] = fmt
+            await query.edit_message_text(f"✅ Định dạng ảnh gốc: {self._FORMAT_LABELS[fmt]}")
         elif query.data == "inpaint_no_ref":
             # Bắt đầu inpainting không có ref
             sess = self.user_sessions.get(user_id, {})
@@ -583,6 +697,7 @@ Sẵn sàng xử lý ảnh! 🚀
         self.application.add_handler(CommandHandler("help", self.help_command))
         self.application.add_handler(CommandHandler("settings", self.settings_command))
         self.application.add_handler(CommandHandler("status", self.status_command))
+        self.application.add_handler(CommandHandler("cancel", self.cancel_command))
         
         # Message handlers
         self.application.add_handler(MessageHandler(filters.PHOTO, self.handle_photo_or_ref))
@@ -610,56 +725,39 @@ Sẵn sàng xử lý ảnh! 🚀
         await self.application.initialize()
         await self.application.start()
         await self.application.updater.start_polling()
+        self.loop_monitor.start()
+        self.health.start()
+        # Gửi nốt kết quả của các job đang chạy dở khi bot restart (không submit lại prompt)
+        await asyncio.to_thread(recover_unfinished_jobs, "bot", self._recovered_job_sender())
         
         logger.info("Telegram bot is running...")
         
         # Giữ bot chạy
-        await asyncio.Event().wait()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            shutdown_transcode_pool()
 
-    # ====== Phân loại workflow (LLM local + heuristic) ======
-    def _classify_by_keywords(self, text: str) -> str:
-        t = (text or "").lower()
-        inpaint_keys = [
-            "inpaint", "change", "replace", "switch", "background", "remove object", "add object",
-            "đổi", "thay", "thêm", "xóa", "đổi nền", "bãi biển", "beach", "blend", "áo", "quần", "tóc", "ghép", "edit"
-        ]
-        restore_keys = [
-            "restore", "recover", "enhance", "old photo", "fix scratch", "scratch", "stain",
-            "remove noise", "grain", "sharpen", "color", "exposure", "discolor", "blur",
-            "phục hồi", "phục chế", "khử nhiễu", "vết xước", "vết bẩn", "tăng chi tiết", "cân bằng màu"
-        ]
-        inpaint_score = sum(k in t for k in inpaint_keys)
-        restore_score = sum(k in t for k in restore_keys)
-        return 'inpaint' if inpaint_score > restore_score else 'restore'
+    def _recovered_job_sender(self):
+        """Callback (chạy trong thread khôi phục) gửi ảnh của job khôi phục cho user sở hữu."""
+        loop = asyncio.get_running_loop()
+        bot = self.application.bot
 
-    def _classify_with_local_llm(self, text: str) -> str:
-        try:
-            ollama_model = os.getenv('OLLAMA_MODEL')
-            if not ollama_model:
-                return self._classify_by_keywords(text)
-            ollama_url = os.getenv('OLLAMA_URL', 'http://localhost:11434').rstrip('/')
-            url = f"{ollama_url}/api/generate"
-            instruction = (
-                "You are a classifier. Decide the best workflow for an image request. "
-                "Return exactly one token: 'restore' or 'inpaint'.\n\n"
-                "If the user asks to change content (background, clothes, remove/add objects), answer 'inpaint'. "
-                "If the user asks to restore/enhance/fix quality (scratches, noise, colors), answer 'restore'.\n\n"
-                f"User request: {text}\nAnswer:"
+        def _deliver(entry, image_bytes: bytes, public_url: Optional[str]) -> None:
+            caption = "🎨 Kết quả của yêu cầu trước đó (bot vừa khởi động lại)."
+            if public_url:
+                caption += f"\n\n🔗 {public_url}"
+            future = asyncio.run_coroutine_threadsafe(
+                bot.send_photo(chat_id=int(entry["owner"]), photo=BytesIO(image_bytes), caption=caption),
+                loop,
             )
-            payload = {"model": ollama_model, "prompt": instruction, "stream": False}
-            r = requests.post(url, json=payload, timeout=10)
-            r.raise_for_status()
-            resp = (r.json().get('response') or '').strip().lower()
-            if 'inpaint' in resp:
-                return 'inpaint'
-            if 'restore' in resp:
-                return 'restore'
-            return self._classify_by_keywords(text)
-        except Exception:
-            return self._classify_by_keywords(text)
+            future.result(timeout=120)
+
+        return _deliver
 
+    # ====== Phân loại workflow (LLM local + heuristic) ======
     def classify_workflow(self, text: str) -> str:
-        return self._classify_with_local_llm(text)
+        return classify_workflow(text)
 
     # ====== Nhận ảnh: ảnh chính hoặc ảnh tham chiếu ======
     async def handle_photo_or_ref(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -717,244 +815,155 @@ Sẵn sàng xử lý ảnh! 🚀
                     pass
                 return
         
+        job = None
+        live_preview = None
+        result = None
+        log_token = None
         try:
-            comfy = ComfyUIClient()
-            if not comfy.health_check():
+            if self.health.pick_backend("inpaint") is None:
                 await message.reply_text(
                     "❌ Không thể kết nối ComfyUI. Hãy kiểm tra cấu hình COMFYUI_SERVER_URL, port 8188, và firewall rồi thử lại.")
                 return
 
+            # Đăng ký job để user có thể /cancel
+            job = get_job_registry().create("inpaint", owner=user_id, deadline=deadline_for("inpaint"),
+                                              priority=config.BOT_PRIORITY, source="bot")
+            log_token = bind_log_context(job_id=job.job_id)
+
             processing_msg = await message.reply_text(
                 "🔄 Đang xử lý inpainting... Vui lòng chờ trong giây lát...",
                 parse_mode=ParseMode.MARKDOWN
             )
 
-            logger.info("Downloading main image from Telegram...")
-            photo_file_id = self.user_sessions[user_id]['photo_file_id']
-            
-            # Retry download với timeout dài hơn
-            max_retries = 3
-            main_file = None
-            for attempt in range(max_retries):
-                try:
-                    logger.info(f"Getting file info (attempt {attempt + 1}/{max_retries})...")
-                    main_file = await context.bot.get_file(photo_file_id)
-                    logger.info(f"Main file info: {main_file.file_id}, size: {main_file.file_size}")
-                    break
-                except Exception as e:
-                    if attempt == max_retries - 1:
-                        raise
-                    logger.warning(f"Failed to get file info (attempt {attempt + 1}): {e}, retrying...")
-                    await asyncio.sleep(2)
-
-            with tempfile.TemporaryDirectory() as tmpdir:
-                main_path = os.path.join(tmpdir, "input.jpg")
-                logger.info(f"Downloading main image to: {main_path}")
-                
-                # Retry download với timeout dài hơn
-                for attempt in range(max_retries):
-                    try:
-                        await main_file.download_to_drive(main_path)
-                        file_size = os.path.getsize(main_path)
-                        logger.info(f"✅ Main image downloaded: {file_size} bytes")
-                        break
-                    except Exception as e:
-                        if attempt == max_retries - 1:
-                            raise
-                        logger.warning(f"Download failed (attempt {attempt + 1}): {e}, retrying...")
-                        await asyncio.sleep(2)
-                        # Lấy lại file object nếu cần
-                        if attempt < max_retries - 1:
-                            try:
-                                main_file = await context.bot.get_file(photo_file_id)
-                            except:
-                                pass
-
-                ref_paths = []
-                for idx, fid in enumerate(ref_file_ids[:2]):
-                    try:
-                        logger.info(f"Downloading ref image {idx+1} from Telegram...")
-                        
-                        # Retry download ref image
-                        ref_file = None
-                        for attempt in range(max_retries):
-                            try:
-                                ref_file = await context.bot.get_file(fid)
-                                logger.info(f"Ref image {idx+1} file info: {ref_file.file_id}, size: {ref_file.file_size}")
-                                break
-                            except Exception as e:
-                                if attempt == max_retries - 1:
-                                    raise
-                                logger.warning(f"Failed to get ref file info (attempt {attempt + 1}): {e}, retrying...")
-                                await asyncio.sleep(2)
-                        
-                        ref_path = os.path.join(tmpdir, f"ref_{idx+1}.jpg")
-                        logger.info(f"Downloading ref image {idx+1} to: {ref_path}")
-                        
-                        # Retry download
-                        for attempt in range(max_retries):
-                            try:
-                                await ref_file.download_to_drive(ref_path)
-                                file_size = os.path.getsize(ref_path)
-                                logger.info(f"✅ Ref image {idx+1} downloaded: {file_size} bytes")
-                                ref_paths.append(ref_path)
-                                break
-                            except Exception as e:
-                                if attempt == max_retries - 1:
-                                    raise
-                                logger.warning(f"Ref download failed (attempt {attempt + 1}): {e}, retrying...")
-                                await asyncio.sleep(2)
-                                # Lấy lại file object nếu cần
-                                if attempt < max_retries - 1:
-                                    try:
-                                        ref_file = await context.bot.get_file(fid)
-                                    except:
-                                        pass
-                    except Exception as e:
-                        logger.error(f"❌ Failed to download ref image {fid}: {e}")
-                        import traceback
-                        logger.error(traceback.format_exc())
-                        # Tiếp tục với các ref image khác nếu có
+            # Ảnh chính đã được tải + upload khi phân loại prompt; chỉ còn tải
+            # các ảnh tham chiếu (song song, thẳng vào bộ nhớ)
+            ref_ids = list(ref_file_ids[:2])
+            logger.info(f"Downloading {len(ref_ids)} ref image(s) from Telegram...")
+            (backend, main_upload, main_digest), fetched = await asyncio.gather(
+                self._get_main_upload(context, user_id),
+                TelegramMediaFetcher(context.bot).fetch_many(ref_ids),
+            )
+
+            ref_bytes = []
+            for idx, (fid, data) in enumerate(zip(ref_ids, fetched)):
+                if isinstance(data, Exception):
+                    # Tiếp tục với các ref image khác nếu có
+                    logger.error(f"❌ Failed to download ref image {idx+1} ({fid}): {data}")
+                    continue
+                ref_bytes.append(data)
+            job.check_cancelled()
+            if not self.health.validator.supports(backend, "inpaint"):
+                raise Exception(f"ComfyUI backend {backend} cannot run the inpaint workflow")
+            job.check_deadline("download")
+
+            client = ComfyUIClient(backend)
 
-                client = ComfyUIClient()
+            # Hiển thị queue nếu có
+            try:
+                queue_info = await asyncio.to_thread(client.get_queue_status)
+                qp = queue_info.get('queue_pending', [])
+                qr = queue_info.get('queue_running', [])
+                if qp or qr:
+                    queue_text = "📊 **Queue Status:**\n"
+                    if qr:
+                        queue_text += f"🔄 Đang chạy: {len(qr)} task(s)\n"
+                    if qp:
+                        queue_text += f"⏳ Đang chờ: {len(qp)} task(s)\n"
+                    await processing_msg.edit_text(
+                        f"🔄 Đang xử lý inpainting...\n\n{queue_text}\n⏱️ Vui lòng chờ...",
+                        parse_mode=ParseMode.MARKDOWN
+                    )
+            except Exception as e:
+                logger.warning(f"Could not get queue info: {e}")
 
-                # Hiển thị queue nếu có
+            async def progress_callback(progress_info):
                 try:
-                    queue_info = client.get_queue_status()
-                    qp = queue_info.get('queue_pending', [])
-                    qr = queue_info.get('queue_running', [])
-                    if qp or qr:
-                        queue_text = "📊 **Queue Status:**\n"
-                        if qr:
-                            queue_text += f"🔄 Đang chạy: {len(qr)} task(s)\n"
-                        if qp:
-                            queue_text += f"⏳ Đang chờ: {len(qp)} task(s)\n"
-                        await processing_msg.edit_text(
-                            f"🔄 Đang xử lý inpainting...\n\n{queue_text}\n⏱️ Vui lòng chờ...",
-                            parse_mode=ParseMode.MARKDOWN
-                        )
+                    if not processing_msg:
+                        return
+                    current_step = progress_info.get('value', 0)
+                    max_steps = progress_info.get('max', 1)
+                    node_name = progress_info.get('node', 'Unknown')
+                    percentage = int((current_step / max_steps) * 100) if max_steps > 0 else 0
+                    progress_bar = "█" * (percentage // 10) + "░" * (10 - percentage // 10)
+                    progress_text = (
+                        f"🔄 **Đang xử lý inpainting...**\n\n"
+                        f"📊 **Progress:** {progress_bar} {percentage}%\n"
+                        f"🎯 **Node:** {node_name}\n"
+                        f"⏱️ **Step:** {current_step}/{max_steps}\n\n"
+                        f"⏳ Vui lòng chờ..."
+                    )
+                    await processing_msg.edit_text(progress_text, parse_mode=ParseMode.MARKDOWN)
                 except Exception as e:
-                    logger.warning(f"Could not get queue info: {e}")
+                    logger.warning("Could not update progress: %s", e, extra=HOT_PATH)
 
-                async def progress_callback(progress_info):
-                    try:
-                        if not processing_msg:
-                            return
-                        current_step = progress_info.get('value', 0)
-                        max_steps = progress_info.get('max', 1)
-                        node_name = progress_info.get('node', 'Unknown')
-                        percentage = int((current_step / max_steps) * 100) if max_steps > 0 else 0
-                        progress_bar = "█" * (percentage // 10) + "░" * (10 - percentage // 10)
-                        progress_text = (
-                            f"🔄 **Đang xử lý inpainting...**\n\n"
-                            f"📊 **Progress:** {progress_bar} {percentage}%\n"
-                            f"🎯 **Node:** {node_name}\n"
-                            f"⏱️ **Step:** {current_step}/{max_steps}\n\n"
-                            f"⏳ Vui lòng chờ..."
-                        )
-                        await processing_msg.edit_text(progress_text, parse_mode=ParseMode.MARKDOWN)
-                    except Exception as e:
-                        logger.warning(f"Could not update progress: {e}")
+            loop = asyncio.get_running_loop()
+            if config.TELEGRAM_LIVE_PREVIEW:
+                live_preview = TelegramLivePreview(message, loop)
+
+            preset = self._user_preset(user_id)
 
+            async def _work(worker, flight):
                 # Chạy process_inpainting trong thread, có progress
                 logger.info("Building inpainting workflow...")
                 try:
-                    # Build workflow trong thread để tránh block event loop
+                    # Upload song song các ảnh tham chiếu lên ComfyUI rồi dựng workflow
+                    ref_uploaded = await asyncio.gather(
+                        *(asyncio.to_thread(client.upload_image_bytes, data, f"ref_{idx+1}.jpg",
+                                            worker.timeout_for(None, "upload"))
+                          for idx, data in enumerate(ref_bytes))
+                    )
                     workflow = await asyncio.to_thread(
-                        self._build_inpainting_workflow,
-                        main_path,
+                        build_inpainting_workflow,
+                        main_upload,
                         prompt,
-                        ref_paths
+                        ref_uploaded[0] if len(ref_uploaded) > 0 else None,
+                        ref_uploaded[1] if len(ref_uploaded) > 1 else None,
+                        preset=preset,
                     )
                     logger.info(f"✅ Workflow built successfully with {len(workflow)} nodes")
                 except Exception as e:
-                    logger.error(f"❌ Failed to build inpainting workflow: {e}")
-                    import traceback
-                    logger.error(traceback.format_exc())
+                    logger.error(f"❌ Failed to build inpainting workflow: {e}", exc_info=True)
                     raise
-                
-                loop = asyncio.get_running_loop()
-
-                def _thread_progress_cb(data):
-                    try:
-                        asyncio.run_coroutine_threadsafe(progress_callback(data), loop)
-                    except Exception as e:
-                        logger.warning(f"Failed to schedule progress callback: {e}")
-
+            
                 logger.info("Queueing inpainting workflow to ComfyUI...")
                 try:
                     result = await asyncio.to_thread(
                         client.queue_prompt_with_progress,
                         workflow,
-                        _thread_progress_cb,
-                        600  # timeout 600 giây (10 phút)
+                        flight.publish_progress,
+                        600,  # timeout 600 giây (10 phút)
+                        job=worker,
+                        preview_callback=flight.publish_preview,
                     )
                     logger.info("✅ Inpainting workflow completed successfully")
+                except (JobCancelled, DeadlineExceeded):
+                    raise
                 except Exception as e:
-                    logger.error(f"❌ Failed to queue/execute inpainting workflow: {e}")
-                    import traceback
-                    logger.error(traceback.format_exc())
+                    logger.error(f"❌ Failed to queue/execute inpainting workflow: {e}", exc_info=True)
                     raise
 
                 # Lấy ảnh kết quả
-                outputs = result.get("outputs", {}) or {}
-                pref = None
-                fb = None
-                any_img = None
-                for node_id, out in outputs.items():
-                    if not isinstance(out, dict):
-                        continue
-                    images = out.get("images") or []
-                    if not images:
-                        continue
-                    filename = images[0].get("filename")
-                    if not filename:
-                        continue
-                    if str(node_id) == "8" and pref is None:
-                        pref = (node_id, filename)
-                    if str(node_id) == "116" and not pref:
-                        pref = (node_id, filename)
-                    if fb is None:
-                        fb = (node_id, filename)
-                    if any_img is None:
-                        any_img = (node_id, filename)
-
-                chosen = pref[1] if pref else (fb[1] if fb else (any_img[1] if any_img else None))
-                if not chosen:
-                    raise Exception("Không tìm thấy ảnh output trong kết quả.")
-
-                img_bytes = client.get_image(chosen)
+                chosen = pick_result_filename("inpaint", result)
 
-            if processing_msg:
-                await processing_msg.delete()
+                return await stream_result(client, chosen, self.storage, timeout=worker.timeout_for(None, "download"))
 
-            # Upload ảnh kết quả
-            public_url = None
-            try:
-                public_url = await self.storage.upload_image(
-                    img_bytes,
-                    chosen,
-                    content_type="image/png"
-                )
-            except Exception as upload_err:
-                logger.warning(f"Failed to upload image to storage, sending bytes directly: {upload_err}")
+            # Cùng ảnh chính + ảnh tham chiếu + prompt + preset đang chạy → dùng chung kết quả
+            key = coalescing_key("inpaint", prompt, [main_digest] + [input_digest(data) for data in ref_bytes],
+                                 {"preset": preset})
+            result = await get_single_flight().run(
+                key, job, _work,
+                on_progress=lambda data: asyncio.run_coroutine_threadsafe(progress_callback(data), loop),
+                on_preview=live_preview.on_frame if live_preview else None,
+            )
 
-            caption = "🎨 Ảnh đã được chỉnh!"
-            if public_url:
-                caption += f"\n\n🔗 Xem trực tuyến: {public_url}"
+            if processing_msg:
+                await processing_msg.delete()
+            if live_preview:
+                await live_preview.close()
 
-            try:
-                await message.reply_photo(photo=BytesIO(img_bytes), caption=caption)
-            except BadRequest as send_err:
-                logger.warning(f"Telegram refused photo upload, falling back to raw URL: {send_err}")
-                if public_url:
-                    await message.reply_text(
-                        "⚠️ Telegram không thể tải ảnh do dung lượng lớn.\n"
-                        "Bạn có thể tải trực tiếp bằng liên kết sau:\n"
-                        f"{public_url}"
-                    )
-                else:
-                    raise
+            # Gửi ngay preview nhỏ; ảnh full-res được upload + gửi ở nền
+            await self._send_preview_then_full(message, result, "🎨 Ảnh đã được chỉnh!", job, user_id)
+            result = None  # _deliver_full_result release file khi gửi xong
 
             # Reset session flags
             self.user_sessions[user_id]['waiting_for_prompt'] = False
@@ -962,11 +971,26 @@ Sẵn sàng xử lý ảnh! 🚀
             self.user_sessions[user_id]['waiting_for_ref_images'] = False
             self.user_sessions[user_id].pop('ref_file_ids', None)
             self.user_sessions[user_id].pop('workflow_prompt', None)
+            self.user_sessions[user_id].pop('main_upload_task', None)
 
+        except JobCancelled:
+            logger.info(f"Inpainting job cancelled by user {user_id}")
+            if processing_msg:
+                try:
+                    await processing_msg.delete()
+                except:
+                    pass
+            await message.reply_text("🛑 Đã hủy yêu cầu inpainting.")
+        except DeadlineExceeded as e:
+            logger.warning(f"Inpainting job for user {user_id} shed: {e}")
+            if processing_msg:
+                try:
+                    await processing_msg.delete()
+                except:
+                    pass
+            await message.reply_text("⏱️ Hệ thống đang quá tải, không kịp xử lý inpainting trong thời gian cho phép. Vui lòng thử lại sau.")
         except asyncio.TimeoutError as e:
-            logger.error(f"Timeout error in inpainting flow: {str(e)}")
-            import traceback
-            logger.error(traceback.format_exc())
+            logger.error(f"Timeout error in inpainting flow: {str(e)}", exc_info=True)
             if processing_msg:
                 try:
                     await processing_msg.delete()
@@ -987,16 +1011,15 @@ Sẵn sàng xử lý ảnh! 🚀
                     text="⏱️ Đã hết thời gian chờ khi xử lý inpainting."
                 )
         except Exception as e:
-            logger.error(f"Error processing inpainting: {str(e)}")
-            import traceback
-            logger.error(traceback.format_exc())
+            logger.error(f"Error processing inpainting: {str(e)}", exc_info=True)
             if processing_msg:
                 try:
                     await processing_msg.delete()
                 except:
                     pass
             msg = str(e)
-            if "Failed to queue prompt" in msg or "Network error queueing prompt" in msg or "Timeout" in msg or "Timed out" in msg:
+            if ("Failed to queue prompt" in msg or "Network error queueing prompt" in msg or "Timeout" in msg
+                    or "Timed out" in msg or "circuit open" in msg):
                 friendly = (
                     "❌ Không thể kết nối ComfyUI hoặc đã hết thời gian chờ.\n\n"
                     "- Kiểm tra COMFYUI_SERVER_URL (không dùng localhost nếu bot chạy khác máy).\n"
@@ -1010,99 +1033,134 @@ Sẵn sàng xử lý ảnh! 🚀
                 await message.reply_text(friendly)
             else:
                 await context.bot.send_message(chat_id=user_id, text=friendly)
+        finally:
+            if live_preview:
+                await live_preview.close()
+            if result is not None:
+                result.release()
+            if job is not None:
+                # Quá hạn mà prompt vẫn còn trên ComfyUI → gỡ ra để không chiếm GPU (request gộp chung:
+                # prompt chỉ bị hủy khi không còn thành viên nào chờ, xem SingleFlight.run)
+                if job.deadline.expired and job.prompt_id and not job.cancelled:
+                    await asyncio.to_thread(job.cancel)
+                get_job_registry().finish(job)
+            if log_token is not None:
+                reset_log_context(log_token)
+
+    # ====== Gửi kết quả: preview trước, full-res sau ======
+    async def _send_preview_then_full(self, message, result: ResultFile, caption: str, job: Job, user_id: int):
+        """Gửi ngay ảnh preview JPEG/WebP nhỏ (nhanh trên mạng di động), rồi gửi ảnh full-res
+        dạng document + link ở nền. Ảnh gốc đã được upload storage trong lúc tải (stream_result).
+
+        `user_id`: user yêu cầu (định dạng ảnh theo /settings của họ). Không lấy từ `message`:
+        ở luồng nút inline, `message` là tin nhắn của chính bot.
+        """
+        try:
+            preview, _ = await asyncio.to_thread(make_preview, result.path)
+            await message.reply_photo(
+                photo=BytesIO(preview),
+                caption=f"{caption}\n\n⏳ Đang gửi ảnh gốc độ phân giải đầy đủ...",
+            )
+            # User đã thấy kết quả; URL ảnh gốc được ghi bổ sung khi gửi xong
+            job.record("delivered", result=result.filename)
+        except Exception as e:
+            logger.warning(f"Could not send preview, sending full-resolution image only: {e}")
 
-    def _build_inpainting_workflow(self, main_path: str, prompt: str, ref_paths: list) -> dict:
-        """Xây dựng dict workflow Inpainting.json với ảnh đã upload vào ComfyUI."""
-        import time
-        import uuid
-        import os
-        
-        logger.info("=== BUILDING INPAINTING WORKFLOW ===")
-        logger.info(f"Main image path: {main_path}")
-        logger.info(f"Prompt: {prompt}")
-        logger.info(f"Ref paths count: {len(ref_paths)}")
-        
-        client = ComfyUIClient()
-        
-        # Upload ảnh
-        def _upload(local_path: str) -> str:
-            timestamp = int(time.time())
-            uid = uuid.uuid4().hex[:8]
-            base, ext = os.path.splitext(os.path.basename(local_path))
-            unique = f"{base}_{timestamp}_{uid}{ext}"
-            url = f"{client.server_url.rstrip('/')}/upload/image"
-            with open(local_path, 'rb') as f:
-                files = {"image": (unique, f, "application/octet-stream")}
-                r = requests.post(url, files=files)
-                r.raise_for_status()
-            logger.info(f"Uploaded image to ComfyUI: {unique}")
-            return unique
-
-        # Upload ảnh chính và refs
-        img1 = _upload(main_path)
-        img2 = _upload(ref_paths[0]) if len(ref_paths) > 0 else None
-        img3 = _upload(ref_paths[1]) if len(ref_paths) > 1 else None
-
-        logger.info(f"Uploaded images: img1={img1}, img2={img2}, img3={img3}")
-
-        # Đọc workflow template
-        workflow_path = "workflows/Inpainting.json"
-        logger.info(f"Reading workflow from: {workflow_path}")
-        with open(workflow_path, "r", encoding="utf-8") as f:
-            wf = json.loads(f.read())
-        
-        logger.info(f"Loaded Inpainting.json with {len(wf)} nodes")
-        
-        # Node 78: ảnh chính (bắt buộc)
-        if "78" in wf and "inputs" in wf["78"]:
-            wf["78"]["inputs"]["image"] = img1
-            logger.info(f"Set node 78 (main image) to: {img1}")
-        else:
-            logger.warning("Node 78 not found in workflow!")
-    
-        # Node 106: ref image 2 (tùy chọn)
-        if img2 and "106" in wf and "inputs" in wf["106"]:
-            wf["106"]["inputs"]["image"] = img2
-            logger.info(f"Set node 106 (ref image 2) to: {img2}")
-        elif img2:
-            logger.warning("Node 106 not found in workflow but ref_image2 provided!")
-    
-        # Node 108: ref image 3 (tùy chọn)
-        if img3 and "108" in wf and "inputs" in wf["108"]:
-            wf["108"]["inputs"]["image"] = img3
-            logger.info(f"Set node 108 (ref image 3) to: {img3}")
-        elif img3:
-            logger.warning("Node 108 not found in workflow but ref_image3 provided!")
-    
-        # Node 111: TextEncodeQwenImageEditPlus (positive prompt)
-        if "111" in wf and "inputs" in wf["111"]:
-            wf["111"]["inputs"]["prompt"] = prompt
-            logger.info(f"Set node 111 (prompt) to: {prompt}")
-            
-            # QUAN TRỌNG: Xóa image2/image3 nếu không có
-            if not img2 and "image2" in wf["111"]["inputs"]:
-                del wf["111"]["inputs"]["image2"]
-                logger.info("Removed image2 from node 111 (no ref image 2)")
-            
-            if not img3 and "image3" in wf["111"]["inputs"]:
-                del wf["111"]["inputs"]["image3"]
-                logger.info("Removed image3 from node 111 (no ref image 3)")
-        else:
-            logger.warning("Node 111 not found in workflow!")
-    
-        # Node 110: negative prompt (cũng cần xóa nếu không có refs)
-        if "110" in wf and "inputs" in wf["110"]:
-            if not img2 and "image2" in wf["110"]["inputs"]:
-                del wf["110"]["inputs"]["image2"]
-                logger.info("Removed image2 from node 110 (no ref image 2)")
-            if not img3 and "image3" in wf["110"]["inputs"]:
-                del wf["110"]["inputs"]["image3"]
-                logger.info("Removed image3 from node 110 (no ref image 3)")
-        else:
-            logger.warning("Node 110 not found in workflow!")
-    
-        logger.info(f"✅ Built inpainting workflow with {len(wf)} nodes")
-        return wf
+        task = asyncio.create_task(self._deliver_full_result(
+            message, result, job, self._user_output_format(user_id)))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _deliver_full_result(self, message, result: ResultFile, job: Job, fmt: str = "png"):
+        """Gửi document full-res rồi release file kết quả."""
+        try:
+            await self._send_full_document(message, result, job, fmt)
+        finally:
+            result.release()
+
+    async def _send_full_document(self, message, result: ResultFile, job: Job, fmt: str):
+        filename = result.filename
+
+        async def _variant():
+            # Ảnh gốc PNG 5–15 MB gửi qua Telegram rất chậm → nén sang định dạng user chọn (process pool)
+            if fmt != "png":
+                try:
+                    data, _ = await transcode_async(result.path, fmt, config.OUTPUT_QUALITY, digest=result.digest)
+                    return data, variant_filename(filename, fmt)
+                except Exception as e:
+                    logger.warning(f"Failed to transcode result to {fmt}, sending PNG: {e}")
+            return None, filename
+
+        async def _upload_original():
+            # Link storage luôn trỏ tới ảnh PNG gốc (lossless); thường đã upload khi stream
+            if result.info.get("public_url"):
+                return result.info["public_url"]
+            try:
+                with open(result.path, "rb") as f:
+                    return await self.storage.upload_stream(f, filename, content_type="image/png")
+            except Exception as upload_err:
+                logger.warning(f"Failed to upload image to storage, sending bytes directly: {upload_err}")
+                return None
+
+        (send_bytes, send_name), public_url = await asyncio.gather(_variant(), _upload_original())
+
+        doc_caption = f"📎 Ảnh gốc (độ phân giải đầy đủ, {os.path.splitext(send_name)[1][1:].upper()})"
+        if public_url:
+            doc_caption += f"\n\n🔗 Xem trực tuyến (PNG): {public_url}"
+        try:
+            # PNG gốc: đưa file trên đĩa cho thư viện Telegram thay vì bản copy trong RAM
+            with (BytesIO(send_bytes) if send_bytes is not None else open(result.path, "rb")) as document:
+                await message.reply_document(document=document, filename=os.path.basename(send_name),
+                                             caption=doc_caption)
+        except Exception as send_err:
+            logger.warning(f"Telegram refused full-resolution upload: {send_err}")
+            try:
+                if public_url:
+                    await message.reply_text(
+                        "⚠️ Telegram không thể tải ảnh do dung lượng lớn.\n"
+                        "Bạn có thể tải trực tiếp bằng liên kết sau:\n"
+                        f"{public_url}"
+                    )
+                else:
+                    await message.reply_text("❌ Không thể gửi ảnh gốc. Vui lòng thử lại.")
+                    return
+            except Exception as e:
+                logger.error(f"Could not deliver full-resolution result: {e}")
+                return
+        job.record("delivered", result=public_url or filename)
+
+    # ====== Upload ảnh chính song song với phân loại ======
+    def _start_main_upload(self, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> asyncio.Task:
+        """Bắt đầu (nếu chưa có) task tải ảnh chính từ Telegram và upload lên ComfyUI."""
+        sess = self.user_sessions[user_id]
+        task = sess.get('main_upload_task')
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            task = asyncio.create_task(self._fetch_and_upload(context.bot, sess['photo_file_id']))
+            # Tránh cảnh báo "exception was never retrieved" nếu user bỏ dở luồng
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            sess['main_upload_task'] = task
+        return task
+
+    async def _get_main_upload(self, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> Tuple[str, str, str]:
+        """Đợi task upload ảnh chính; trả về (backend ComfyUI, tên file trên backend đó, sha256 ảnh)."""
+        return await self._start_main_upload(context, user_id)
+
+    async def _fetch_and_upload(self, bot, file_id: str) -> Tuple[str, str, str]:
+        # Chọn backend ngay từ đầu: job phải chạy trên đúng backend đã nhận ảnh.
+        # Workflow chưa biết (đang phân loại) → ưu tiên backend chạy được cả hai.
+        backend = self.health.pick_backend(("restore", "inpaint")) or self.health.pick_backend()
+        if backend is None:
+            raise Exception("ComfyUI backend is currently unavailable")
+        image_bytes = await TelegramMediaFetcher(bot).fetch(file_id)
+        client = ComfyUIClient(backend)
+
+        def _upload() -> Tuple[str, str]:
+            # Chưa có job (và deadline) lúc upload sớm → giới hạn bằng timeout của client (COMFYUI_TIMEOUT)
+            # để ComfyUI treo không giữ handler mãi; hash ảnh cũng chạy trong thread, không trên event loop
+            return client.upload_image_bytes(image_bytes, "input.jpg", client.timeout), input_digest(image_bytes)
+
+        filename, digest = await asyncio.to_thread(_upload)
+        return backend, filename, digest
 
 async def main():
     """Main function"""
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+# Module của project nằm ở thư mục gốc repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import config  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def no_journal(monkeypatch):
+    """Test không ghi job journal ra jobs.db."""
+    monkeypatch.setattr(config, "JOB_JOURNAL_PATH", "")
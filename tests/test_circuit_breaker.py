@@ -0,0 +1,190 @@
+import threading
+import time
+
+import pytest
+
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, hedged_call
+from config import config
+
+
+@pytest.fixture(autouse=True)
+def breaker_config(monkeypatch):
+    monkeypatch.setattr(config, "CIRCUIT_BREAKER_ENABLED", True)
+    monkeypatch.setattr(config, "CIRCUIT_WINDOW_SECONDS", 30.0)
+    monkeypatch.setattr(config, "CIRCUIT_MIN_CALLS", 4)
+    monkeypatch.setattr(config, "CIRCUIT_FAILURE_RATE", 0.5)
+    monkeypatch.setattr(config, "CIRCUIT_SLOW_CALL_SECONDS", 1.0)
+    monkeypatch.setattr(config, "CIRCUIT_SLOW_CALL_RATE", 0.75)
+    monkeypatch.setattr(config, "CIRCUIT_OPEN_SECONDS", 20.0)
+
+
+def _open_breaker() -> CircuitBreaker:
+    breaker = CircuitBreaker("http://comfy")
+    for _ in range(config.CIRCUIT_MIN_CALLS):
+        breaker.record(False, 0.1)
+    assert breaker.state == OPEN
+    return breaker
+
+
+def _half_open(monkeypatch) -> CircuitBreaker:
+    breaker = _open_breaker()
+    monkeypatch.setattr(config, "CIRCUIT_OPEN_SECONDS", 0.0)
+    return breaker
+
+
+def test_trips_on_failure_rate():
+    breaker = CircuitBreaker("http://comfy")
+    breaker.record(True, 0.1)
+    breaker.record(False, 0.1)
+    breaker.record(True, 0.1)
+    assert breaker.state == CLOSED
+    breaker.record(False, 0.1)
+    assert breaker.state == OPEN
+    assert breaker.trips == 1
+    with pytest.raises(CircuitOpen) as exc_info:
+        breaker.before_call()
+    assert exc_info.value.retry_after > 0
+
+
+def test_does_not_trip_below_min_calls():
+    breaker = CircuitBreaker("http://comfy")
+    for _ in range(config.CIRCUIT_MIN_CALLS - 1):
+        breaker.record(False, 0.1)
+    assert breaker.state == CLOSED
+    assert breaker.before_call() is None
+
+
+def test_trips_on_slow_call_rate():
+    breaker = CircuitBreaker("http://comfy")
+    breaker.record(True, 0.1)
+    for _ in range(2):
+        breaker.record(True, 2.0)
+    assert breaker.state == CLOSED
+    breaker.record(True, 2.0)
+    assert breaker.state == OPEN
+
+
+def test_slow_upload_is_not_a_slow_call():
+    breaker = CircuitBreaker("http://comfy")
+    for _ in range(config.CIRCUIT_MIN_CALLS):
+        breaker.record(True, 2.0, slow_call=False)
+    assert breaker.state == CLOSED
+
+
+def test_open_circuit_is_not_available_after_cooldown(monkeypatch):
+    breaker = _half_open(monkeypatch)
+    # Router không gửi job mới tới backend chưa được call thử đóng mạch lại
+    assert breaker.available() is False
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+
+
+def test_single_half_open_probe(monkeypatch):
+    breaker = _half_open(monkeypatch)
+    token = breaker.before_call()
+    assert token is not None
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    assert breaker.try_probe() is None
+
+
+def test_only_probe_call_closes_half_open_circuit(monkeypatch):
+    breaker = _half_open(monkeypatch)
+    token = breaker.try_probe()
+    # Call bắt đầu trước khi mạch mở, kết thúc lúc half-open: không được quyết định
+    breaker.record(True, 0.1)
+    assert breaker.state == HALF_OPEN
+    breaker.record(True, 0.1, token=object())
+    assert breaker.state == HALF_OPEN
+    breaker.record(True, 0.1, token=token)
+    assert breaker.state == CLOSED
+    assert breaker.available() is True
+    assert breaker.before_call() is None
+
+
+def test_failed_probe_reopens_circuit(monkeypatch):
+    breaker = _half_open(monkeypatch)
+    token = breaker.before_call()
+    monkeypatch.setattr(config, "CIRCUIT_OPEN_SECONDS", 20.0)
+    breaker.record(False, 0.1, token=token)
+    assert breaker.state == OPEN
+    assert breaker.trips == 2
+    # Token đã dùng không thể đóng mạch lần nữa
+    breaker.record(True, 0.1, token=token)
+    assert breaker.state == OPEN
+
+
+def test_slow_probe_reopens_circuit(monkeypatch):
+    breaker = _half_open(monkeypatch)
+    token = breaker.before_call()
+    breaker.record(True, 2.0, token=token)
+    assert breaker.state == OPEN
+
+
+class _Response:
+    def __init__(self, name: str):
+        self.name = name
+        self.closed = threading.Event()
+
+    def close(self) -> None:
+        self.closed.set()
+
+
+@pytest.fixture
+def hedge_config(monkeypatch):
+    monkeypatch.setattr(config, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(config, "HEDGE_MIN_SAMPLES", 1000)
+    monkeypatch.setattr(config, "HEDGE_MAX_DELAY", 0.05)
+
+
+def test_hedge_returns_first_response_and_closes_loser(hedge_config):
+    breaker = CircuitBreaker("http://comfy")
+    release_slow = threading.Event()
+    responses = []
+    lock = threading.Lock()
+
+    def read():
+        with lock:
+            response = _Response("slow" if not responses else "fast")
+            responses.append(response)
+        if response.name == "slow":
+            release_slow.wait(5)
+        return response
+
+    result = hedged_call(breaker, "view", read)
+    assert result.name == "fast"
+    assert len(responses) == 2
+
+    release_slow.set()
+    slow = responses[0]
+    assert slow.closed.wait(5), "response của request thua cuộc phải được đóng"
+    assert not result.closed.is_set()
+
+
+def test_no_hedge_for_fast_read(hedge_config):
+    breaker = CircuitBreaker("http://comfy")
+    calls = []
+
+    def read():
+        calls.append(1)
+        return _Response("only")
+
+    assert hedged_call(breaker, "view", read).name == "only"
+    assert len(calls) == 1
+
+
+def test_hedge_raises_when_all_requests_fail(hedge_config):
+    breaker = CircuitBreaker("http://comfy")
+
+    def read():
+        time.sleep(0.1)
+        raise ConnectionError("backend down")
+
+    with pytest.raises(ConnectionError):
+        hedged_call(breaker, "view", read)
+
+
+def test_no_hedge_while_circuit_not_closed(hedge_config):
+    breaker = _open_breaker()
+    assert breaker.hedge_delay("view") is None
@@ -0,0 +1,98 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from completion_tracker import CompletionTracker
+from job_registry import JobCancelled
+
+
+class _Response:
+    def __init__(self, data, status_code=200):
+        self._data = data
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._data
+
+
+class _FakeComfyUI:
+    """Thay cho requests.Session: /queue và /history của một backend giả."""
+
+    def __init__(self):
+        self.queued = set()
+        self.history = {}
+        self.lock = threading.Lock()
+
+    def finish(self, prompt_id, status_str="success"):
+        with self.lock:
+            self.queued.discard(prompt_id)
+            self.history[prompt_id] = {"status": {"status_str": status_str, "completed": status_str == "success"},
+                                       "outputs": {}}
+
+    def get(self, url, params=None, timeout=None):
+        with self.lock:
+            if url.endswith("/queue"):
+                return _Response({"queue_running": [[0, pid] for pid in self.queued], "queue_pending": []})
+            if url.endswith("/history"):
+                return _Response(dict(self.history))
+            pid = url.rsplit("/", 1)[1]
+            return _Response({pid: self.history[pid]} if pid in self.history else {}, 200)
+
+
+def _wait_for_waiters(tracker, count):
+    deadline = time.monotonic() + 5
+    while tracker.pending_count() < count:
+        assert time.monotonic() < deadline, f"{tracker.pending_count()}/{count} waiters registered"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def tracker():
+    tracker = CompletionTracker("http://comfy", min_interval=0.01, max_interval=0.05)
+    tracker._session = _FakeComfyUI()
+    return tracker
+
+
+def test_all_waiters_of_a_prompt_are_woken(tracker):
+    comfy = tracker._session
+    comfy.queued.add("P1")
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        waits = [pool.submit(tracker.wait, "P1", 5) for _ in range(2)]
+        _wait_for_waiters(tracker, 2)
+        comfy.finish("P1")
+        results = [w.result(timeout=5) for w in waits]
+    assert all(r["status"]["status_str"] == "success" for r in results)
+    assert tracker.pending_count() == 0
+
+
+def test_error_is_raised_for_every_waiter(tracker):
+    comfy = tracker._session
+    comfy.queued.add("P1")
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        waits = [pool.submit(tracker.wait, "P1", 5) for _ in range(2)]
+        _wait_for_waiters(tracker, 2)
+        comfy.finish("P1", "error")
+        for w in waits:
+            with pytest.raises(Exception, match="ComfyUI processing failed"):
+                w.result(timeout=5)
+
+
+def test_cancelled_waiter_does_not_unregister_others(tracker):
+    comfy = tracker._session
+    comfy.queued.add("P1")
+    cancel = threading.Event()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        cancelled = pool.submit(tracker.wait, "P1", 5, cancel_event=cancel)
+        other = pool.submit(tracker.wait, "P1", 5)
+        _wait_for_waiters(tracker, 2)
+        cancel.set()
+        with pytest.raises(JobCancelled):
+            cancelled.result(timeout=5)
+        assert tracker.pending_count() == 1
+        comfy.finish("P1")
+        assert other.result(timeout=5)["status"]["status_str"] == "success"
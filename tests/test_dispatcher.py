@@ -0,0 +1,57 @@
+import threading
+
+from dispatcher import PromptDispatcher
+from job_registry import Job
+
+
+def test_nested_slot_without_job_does_not_take_another_slot():
+    dispatcher = PromptDispatcher("http://comfy", max_inflight=1)
+    done = threading.Event()
+
+    def run():
+        # run_workflow → queue_prompt_with_progress, cả hai không có job
+        with dispatcher.slot():
+            with dispatcher.slot():
+                assert sum(dispatcher.stats()["inflight"].values()) == 1
+        done.set()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert done.wait(5), "slot lồng nhau không có job bị deadlock"
+    assert sum(dispatcher.stats()["inflight"].values()) == 0
+
+
+def test_nested_slot_for_same_job():
+    dispatcher = PromptDispatcher("http://comfy", max_inflight=1)
+    job = Job("j1", "test", priority="interactive")
+    with dispatcher.slot(job):
+        with dispatcher.slot(job):
+            assert dispatcher.stats()["inflight"]["interactive"] == 1
+    assert dispatcher.stats()["inflight"]["interactive"] == 0
+
+
+def test_slot_in_other_thread_waits_for_holder():
+    dispatcher = PromptDispatcher("http://comfy", max_inflight=1)
+    acquired = threading.Event()
+
+    def other():
+        with dispatcher.slot():
+            acquired.set()
+
+    with dispatcher.slot():
+        thread = threading.Thread(target=other, daemon=True)
+        thread.start()
+        # Slot của thread khác không được coi là lồng nhau
+        assert not acquired.wait(0.3)
+        assert sum(dispatcher.stats()["queue_depth"].values()) == 1
+    assert acquired.wait(5)
+    thread.join(5)
+
+
+def test_slots_on_other_backend_are_independent():
+    first = PromptDispatcher("http://comfy-1", max_inflight=1)
+    second = PromptDispatcher("http://comfy-2", max_inflight=1)
+    with first.slot():
+        with second.slot():
+            assert sum(first.stats()["inflight"].values()) == 1
+            assert sum(second.stats()["inflight"].values()) == 1
@@ -0,0 +1,54 @@
+import threading
+
+from job_journal import JobJournal
+
+
+def test_reads_see_queued_writes(tmp_path):
+    journal = JobJournal(str(tmp_path / "jobs.db"))
+    try:
+        journal.append("j1", "created", source="api", kind="test")
+        journal.append("j1", "queued", source="api", kind="test", backend="http://comfy", prompt_id="P1")
+        journal.append("j2", "created", source="api", kind="test")
+        journal.append("j2", "stored", source="api", kind="test", result="url")
+
+        latest = journal.latest("j1")
+        assert latest["state"] == "queued" and latest["prompt_id"] == "P1"
+        assert [e["state"] for e in journal.history("j2")] == ["created", "stored"]
+        assert [e["job_id"] for e in journal.unfinished("api", 60)] == ["j1"]
+    finally:
+        journal.close()
+
+
+def test_append_does_not_write_on_calling_thread(tmp_path, monkeypatch):
+    journal = JobJournal(str(tmp_path / "jobs.db"))
+    writers = set()
+    write = journal._write
+
+    def tracking_write(rows):
+        writers.add(threading.current_thread().name)
+        write(rows)
+
+    monkeypatch.setattr(journal, "_write", tracking_write)
+    try:
+        for i in range(100):
+            journal.append(f"j{i}", "created", source="api")
+        journal.flush()
+        assert writers == {"job-journal"}
+        assert journal.latest("j99")["state"] == "created"
+    finally:
+        journal.close()
+
+
+def test_close_writes_pending_rows(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    journal = JobJournal(path)
+    journal.append("j1", "queued", source="bot", prompt_id="P1")
+    journal.close()
+    # Sau khi writer dừng, append ghi đồng bộ
+    journal.append("j1", "delivered", source="bot", prompt_id="P1")
+
+    reopened = JobJournal(path)
+    try:
+        assert [e["state"] for e in reopened.history("j1")] == ["queued", "delivered"]
+    finally:
+        reopened.close()
@@ -0,0 +1,43 @@
+import time
+import logging
+
+from log_setup import HOT_PATH, RateLimitFilter
+
+
+def _record(level=logging.INFO, lineno=10, **extra):
+    record = logging.LogRecord("test", level, "/app/module.py", lineno, "message %s", ("arg",), None)
+    for name, value in extra.items():
+        setattr(record, name, value)
+    return record
+
+
+def test_unmarked_call_sites_are_never_limited():
+    limiter = RateLimitFilter(rate=2, window=60)
+    assert all(limiter.filter(_record()) for _ in range(10))
+    assert all(limiter.filter(_record(logging.WARNING, lineno=11)) for _ in range(10))
+    assert limiter.suppressed == 0
+
+
+def test_hot_path_call_site_is_limited_and_reports_suppressed_lines():
+    limiter = RateLimitFilter(rate=2, window=0.05)
+    results = [limiter.filter(_record(**HOT_PATH)) for _ in range(5)]
+    assert results == [True, True, False, False, False]
+    assert limiter.suppressed == 3
+
+    # Cửa sổ mới: dòng đầu tiên báo số dòng đã bị bỏ
+    time.sleep(0.06)
+    record = _record(**HOT_PATH)
+    assert limiter.filter(record)
+    assert record.suppressed == 3
+
+
+def test_hot_path_call_sites_are_limited_separately():
+    limiter = RateLimitFilter(rate=1, window=60)
+    assert limiter.filter(_record(lineno=1, **HOT_PATH))
+    assert limiter.filter(_record(lineno=2, **HOT_PATH))
+    assert not limiter.filter(_record(lineno=1, **HOT_PATH))
+
+
+def test_errors_always_pass():
+    limiter = RateLimitFilter(rate=1, window=60)
+    assert all(limiter.filter(_record(logging.ERROR, **HOT_PATH)) for _ in range(5))
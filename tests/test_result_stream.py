@@ -0,0 +1,88 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from config import config
+from result_stream import SinkAbandoned, StreamTee
+
+
+def _drain(reader):
+    chunks = []
+    while True:
+        chunk = reader.next_chunk()
+        if chunk is None:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def test_every_reader_gets_the_whole_stream():
+    tee = StreamTee(queue_size=2)
+    readers = [tee.reader("a"), tee.reader("b")]
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        first = pool.submit(_drain, readers[0])
+        second = pool.submit(readers[1].read)
+        assert pool.submit(tee.pump, [b"ab", b"", b"cd", b"e"]).result(timeout=5) == 5
+        assert first.result(timeout=5) == b"abcde"
+        assert second.result(timeout=5) == b"abcde"
+
+
+@pytest.mark.parametrize("method", ["next_chunk", "read"])
+def test_abandon_wakes_blocked_consumer(method):
+    tee = StreamTee(queue_size=2)
+    reader = tee.reader("http")
+    started = threading.Event()
+
+    def consume():
+        started.set()
+        return getattr(reader, method)()
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(consume)
+        started.wait(5)
+        reader.abandon()
+        with pytest.raises(SinkAbandoned):
+            future.result(timeout=5)
+
+
+def test_abandoned_reader_does_not_block_pump_or_other_readers():
+    tee = StreamTee(queue_size=1)
+    gone, live = tee.reader("gone"), tee.reader("live")
+    gone.abandon()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        data = pool.submit(_drain, live)
+        tee.pump([b"x"] * 10)
+        assert data.result(timeout=5) == b"x" * 10
+    with pytest.raises(SinkAbandoned):
+        gone.next_chunk()
+
+
+def test_stalled_reader_is_detached_and_its_consumer_wakes(monkeypatch):
+    monkeypatch.setattr(config, "RESULT_STREAM_STALL_TIMEOUT", 0.2)
+    tee = StreamTee(queue_size=1)
+    stalled, live = tee.reader("stalled"), tee.reader("live")
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        data = pool.submit(_drain, live)
+        tee.pump([b"x"] * 5)
+        assert data.result(timeout=5) == b"x" * 5
+    assert stalled.abandoned
+    # Consumer chậm quay lại: đọc nốt chunk còn trong hàng đợi hoặc nhận lỗi, không treo
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        with pytest.raises(SinkAbandoned):
+            pool.submit(_drain, stalled).result(timeout=5)
+
+
+def test_source_error_reaches_blocked_consumer():
+    tee = StreamTee(queue_size=2)
+    reader = tee.reader("file", required=True)
+
+    def chunks():
+        yield b"a"
+        raise ConnectionError("backend went away")
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        data = pool.submit(_drain, reader)
+        with pytest.raises(ConnectionError):
+            tee.pump(chunks())
+        with pytest.raises(ConnectionError):
+            data.result(timeout=5)
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from config import config
+from job_registry import JobCancelled, get_job_registry
+from single_flight import SingleFlight
+
+
+@pytest.fixture(autouse=True)
+def single_flight_enabled(monkeypatch):
+    monkeypatch.setattr(config, "SINGLE_FLIGHT_ENABLED", True)
+
+
+def _member():
+    return get_job_registry().create("test", source="test")
+
+
+def test_identical_requests_share_one_run():
+    async def scenario():
+        single_flight = SingleFlight()
+        started = asyncio.Event()
+        release = asyncio.Event()
+        runs = []
+
+        async def work(worker, flight):
+            runs.append(worker.job_id)
+            worker.attach_prompt("http://comfy", "P1", "wf")
+            started.set()
+            await release.wait()
+            return "result"
+
+        first, second = _member(), _member()
+        task1 = asyncio.create_task(single_flight.run("k", first, work))
+        await started.wait()
+        task2 = asyncio.create_task(single_flight.run("k", second, work))
+        await asyncio.sleep(0.05)
+
+        assert single_flight.stats() == {"inflight": 1, "coalesced": 1}
+        worker = get_job_registry().get(runs[0])
+        assert worker is not None and worker.journaled is False
+        # Thành viên mang prompt của worker (journal, GET /jobs/{id}, khôi phục)
+        assert first.prompt_id == second.prompt_id == "P1"
+        assert first.state == second.state == "queued"
+        assert first.coalesced_into == second.coalesced_into == worker.job_id
+
+        release.set()
+        assert await asyncio.gather(task1, task2) == ["result", "result"]
+        assert len(runs) == 1
+        assert single_flight.stats()["inflight"] == 0
+        assert get_job_registry().get(worker.job_id) is None
+        assert worker.state == "delivered"
+
+    asyncio.run(scenario())
+
+
+def test_different_keys_run_separately():
+    async def scenario():
+        single_flight = SingleFlight()
+        runs = []
+
+        async def work(worker, flight):
+            runs.append(worker.job_id)
+            await asyncio.sleep(0.05)
+            return worker.job_id
+
+        results = await asyncio.gather(single_flight.run("a", _member(), work),
+                                       single_flight.run("b", _member(), work))
+        assert sorted(results) == sorted(runs)
+        assert len(set(runs)) == 2
+
+    asyncio.run(scenario())
+
+
+def test_worker_cancelled_only_when_last_member_leaves():
+    async def scenario():
+        single_flight = SingleFlight()
+        started = asyncio.Event()
+        workers = []
+
+        async def work(worker, flight):
+            workers.append(worker)
+            started.set()
+            while True:
+                worker.check_cancelled()
+                await asyncio.sleep(0.01)
+
+        first, second = _member(), _member()
+        task1 = asyncio.create_task(single_flight.run("k", first, work))
+        await started.wait()
+        task2 = asyncio.create_task(single_flight.run("k", second, work))
+        await asyncio.sleep(0.05)
+        worker = workers[0]
+
+        assert first.cancel() == "local"
+        with pytest.raises(JobCancelled):
+            await task1
+        assert not worker.cancelled
+
+        second.cancel()
+        with pytest.raises(JobCancelled):
+            await task2
+        await asyncio.sleep(0.05)
+        assert worker.cancelled
+        assert worker.state == "cancelled"
+        assert single_flight.stats()["inflight"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,25 @@
+import pytest
+
+from config import config
+from warmup import WarmupManager, fcntl
+
+
+@pytest.mark.skipif(fcntl is None, reason="flock không có trên nền tảng này")
+def test_only_one_manager_runs_warmups(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "WARMUP_LOCK_PATH", str(tmp_path / "warmup.lock"))
+    first, second = WarmupManager(), WarmupManager()
+    try:
+        assert first.is_runner()
+        assert first.is_runner()
+        assert not second.is_runner()
+    finally:
+        first._lock_file.close()
+    # Process giữ lock thoát → process khác thay chỗ
+    assert second.is_runner()
+    second._lock_file.close()
+
+
+def test_every_process_warms_up_without_lock_path(monkeypatch):
+    monkeypatch.setattr(config, "WARMUP_LOCK_PATH", "")
+    assert WarmupManager().is_runner()
+    assert WarmupManager().is_runner()
@@ -0,0 +1,36 @@
+import unicodedata
+
+import pytest
+
+from workflow_classifier import classify_by_keywords
+
+
+@pytest.mark.parametrize("prompt", [
+    "làm rõ đôi mắt",
+    "tăng tốc xử lý ảnh cũ này",
+    "làm nét ảnh chụp ao làng",
+    "ảnh đời ông bà, làm rõ nét",
+    "tôi thấy ảnh bị mờ, phục hồi giúp",
+    "make them sharper",
+    "restore this old photo",
+])
+def test_restore_prompts(prompt):
+    assert classify_by_keywords(prompt) == "restore"
+
+
+@pytest.mark.parametrize("prompt", [
+    "đổi áo thành màu đỏ",
+    "đổi nền sang bãi biển",
+    "thêm mũ cho ông",
+    "xoá người phía sau",
+    "xóa người phía sau",
+    "cắt tóc ngắn hơn",
+    "doi ao mau do",
+    "replace the background",
+])
+def test_inpaint_prompts(prompt):
+    assert classify_by_keywords(prompt) == "inpaint"
+
+
+def test_decomposed_diacritics_match():
+    assert classify_by_keywords(unicodedata.normalize("NFD", "đổi áo thành màu đỏ")) == "inpaint"
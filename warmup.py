@@ -0,0 +1,184 @@
+import time
+import random
+import logging
+import threading
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Sequence
+
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có flock, mỗi process tự warm-up
+    fcntl = None
+
+from config import config
+from dispatcher import get_dispatcher
+from job_registry import Job
+from workflow_templates import PARAM_SPECS, build_restore_workflow, build_inpainting_workflow
+
+logger = logging.getLogger(__name__)
+
+# Workflow nào dựng bằng builder nào (ảnh tổng hợp thay cho ảnh của user)
+_BUILDERS = {
+    "restore": lambda image, prompt, params: build_restore_workflow(image, prompt, params=params),
+    "inpaint": lambda image, prompt, params: build_inpainting_workflow(image, prompt, params=params),
+}
+
+
+def _synthetic_image(size: int) -> bytes:
+    img = Image.new("RGB", (size, size), (128, 128, 128))
+    out = BytesIO()
+    img.save(out, "PNG")
+    return out.getvalue()
+
+
+class WarmupManager:
+    """Giữ trạng thái warm/cold của từng workflow trên từng backend ComfyUI.
+
+    Warm-up = chạy một prompt tổng hợp rất nhỏ (ít step, ảnh nhỏ) để ComfyUI nạp sẵn
+    UNET/ControlNet/text encoder/upscaler vào VRAM, nhờ vậy request thật đầu tiên
+    không phải chờ load model từ đĩa. Được kích hoạt khi khởi động, khi backend vừa
+    hồi phục và sau khi backend rảnh quá WARMUP_IDLE_SECONDS. Job thật chạy xong
+    cũng đánh dấu workflow là warm. Router ưu tiên backend đã warm.
+
+    Mỗi worker API (và bot) có prober riêng; chỉ process giữ file lock WARMUP_LOCK_PATH
+    chạy warm-up để backend không nhận N bộ prompt tổng hợp. Process khác chỉ biết warm/cold
+    qua job thật của chính nó, và thay chỗ khi process giữ lock thoát.
+    """
+
+    def __init__(self, workflows: Optional[List[str]] = None, idle_seconds: float = None):
+        self.workflows = [w for w in (workflows or config.WARMUP_WORKFLOWS) if w in _BUILDERS]
+        self.idle_seconds = idle_seconds if idle_seconds is not None else config.WARMUP_IDLE_SECONDS
+        self._state: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._running: set = set()
+        self._lock = threading.Lock()
+        self._lock_file = None
+
+    def _entry(self, url: str, workflow: str) -> Dict[str, Any]:
+        return self._state.setdefault(url.rstrip("/"), {}).setdefault(
+            workflow, {"warm": False, "warmed_at": None, "last_used": None, "attempted_at": None,
+                       "duration": None, "error": None})
+
+    # ---------- cập nhật trạng thái ----------
+    def mark_used(self, url: str, workflow: str) -> None:
+        """Job thật vừa chạy xong workflow trên backend → model đang nằm trong VRAM."""
+        with self._lock:
+            entry = self._entry(url, workflow)
+            entry["warm"] = True
+            entry["last_used"] = time.time()
+
+    def mark_cold(self, url: str, restarted: bool = False) -> None:
+        """Backend vừa giải phóng VRAM (clear_cache) hoặc vừa restart (`restarted`: warm-up lại ngay)."""
+        with self._lock:
+            for entry in self._state.get(url.rstrip("/"), {}).values():
+                entry["warm"] = False
+                if restarted:
+                    entry["attempted_at"] = None
+                    entry["last_used"] = None
+
+    # ---------- đọc trạng thái ----------
+    def is_warm(self, url: str, workflows: Sequence[Optional[str]]) -> bool:
+        entries = self._state.get(url.rstrip("/"), {})
+        return all((entries.get(name) or {}).get("warm", False) for name in workflows if name is not None)
+
+    def needs_warmup(self, url: str, workflow: str) -> bool:
+        entry = self._state.get(url.rstrip("/"), {}).get(workflow)
+        if entry is None:
+            return True
+        now = time.time()
+        if entry["warm"]:
+            last = max(entry["last_used"] or 0, entry["warmed_at"] or 0)
+            return now - last > self.idle_seconds
+        # Lần thử trước lỗi → chờ WARMUP_RETRY_INTERVAL rồi mới thử lại
+        if entry["attempted_at"] is not None and now - entry["attempted_at"] < config.WARMUP_RETRY_INTERVAL:
+            return False
+        # Cold do clear_cache sau một job vừa chạy: cố ý giải phóng VRAM, chỉ warm lại khi đã rảnh lâu
+        return entry["last_used"] is None or now - entry["last_used"] > self.idle_seconds
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        with self._lock:
+            return {url: {name: dict(e) for name, e in entries.items()} for url, entries in self._state.items()}
+
+    # ---------- chạy warm-up ----------
+    def is_runner(self) -> bool:
+        """Process này có chạy warm-up không: lấy (không chờ) file lock WARMUP_LOCK_PATH và giữ
+        suốt đời process; lock được nhả khi process thoát nên process khác sẽ thay chỗ."""
+        path = config.WARMUP_LOCK_PATH
+        if not path or fcntl is None:
+            return True
+        with self._lock:
+            if self._lock_file is not None:
+                return True
+            try:
+                lock_file = open(path, "a")
+            except OSError as e:
+                logger.warning(f"Could not open warm-up lock {path}, warming up from this process: {e}")
+                return True
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+        logger.info(f"This process runs backend warm-ups (holding {path})")
+        return True
+
+    def try_begin(self, url: str, workflow: str) -> bool:
+        """Đánh dấu warm-up đang chạy; False nếu đã có warm-up cho (url, workflow)."""
+        with self._lock:
+            if (url, workflow) in self._running:
+                return False
+            self._running.add((url, workflow))
+            self._entry(url, workflow)["attempted_at"] = time.time()
+            return True
+
+    def warm(self, url: str, workflow: str) -> Optional[float]:
+        """Chạy prompt warm-up (I/O đồng bộ → gọi qua asyncio.to_thread); trả về thời gian (giây).
+
+        Gọi sau try_begin(). Prompt lấy slot dispatcher ở lớp `bulk` nên không chen
+        trước job thật; seed ngẫu nhiên để ComfyUI không trả kết quả cache.
+        """
+        from comfyui_client import ComfyUIClient
+        client = ComfyUIClient(url)
+        job = Job(f"warmup-{workflow}-{int(time.time())}", "warmup", backend=url, priority="bulk",
+                  source="warmup")
+        started = time.monotonic()
+        try:
+            image = client.upload_image_bytes(_synthetic_image(config.WARMUP_IMAGE_SIZE), "warmup.png",
+                                              timeout=config.WARMUP_TIMEOUT)
+            params = {"steps": config.WARMUP_STEPS, "megapixels": PARAM_SPECS["megapixels"][1],
+                      "seed": random.randint(0, 2 ** 32)}
+            workflow_json = _BUILDERS[workflow](image, "warm up", params)
+            with get_dispatcher(url).slot(job):
+                prompt_id = client.queue_prompt(workflow_json, timeout=config.WARMUP_TIMEOUT)
+                client.wait_for_completion(prompt_id, timeout=config.WARMUP_TIMEOUT,
+                                           expected_key=f"warmup:{workflow}", job=job)
+        except Exception as e:
+            logger.warning(f"Warm-up of '{workflow}' on {url} failed: {e}")
+            with self._lock:
+                self._entry(url, workflow)["error"] = str(e)
+            return None
+        finally:
+            with self._lock:
+                self._running.discard((url, workflow))
+
+        duration = time.monotonic() - started
+        with self._lock:
+            entry = self._entry(url, workflow)
+            entry.update(warm=True, warmed_at=time.time(), duration=round(duration, 2), error=None)
+        logger.info(f"Warmed up '{workflow}' on {url} in {duration:.1f}s")
+        return duration
+
+
+_manager: Optional[WarmupManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_warmup_manager() -> WarmupManager:
+    """Trạng thái warm-up dùng chung trong một process."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = WarmupManager()
+        return _manager
@@ -0,0 +1,194 @@
+import re
+import time
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import requests
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Từ khóa cho từng workflow. Viết có dấu hay không dấu đều được vì cả từ khóa
+# lẫn prompt đều được bỏ dấu trước khi so khớp (trừ các từ ngắn bên dưới).
+INPAINT_KEYWORDS = [
+    "inpaint", "change", "replace", "switch", "background", "remove object", "add object",
+    "đổi", "thay", "thêm", "xóa", "xoá", "đổi nền", "bãi biển", "beach", "blend",
+    "áo", "quần", "tóc", "ghép", "edit",
+]
+RESTORE_KEYWORDS = [
+    "restore", "recover", "enhance", "old photo", "fix scratch", "scratch", "stain",
+    "remove noise", "grain", "sharpen", "color", "exposure", "discolor", "blur",
+    "phục hồi", "phục chế", "khử nhiễu", "vết xước", "vết bẩn", "tăng chi tiết", "cân bằng màu",
+]
+
+# Từ tiếng Việt mà khi bỏ dấu sẽ trùng với từ tiếng Anh phổ biến
+# ("thêm" -> "them"): chỉ khớp khi người dùng gõ có dấu.
+_ACCENT_REQUIRED = {"thêm"}
+# Từ ngắn mà khi bỏ dấu sẽ trùng với từ tiếng Việt thông dụng khác (đổi/đôi/đời -> "doi",
+# tóc/tốc -> "toc", áo/ao/ảo -> "ao", quần/quan -> "quan", thay/thấy -> "thay"): prompt có dấu
+# thì phải khớp đúng dấu; chỉ so khớp không dấu khi cả prompt được gõ không dấu.
+_ACCENT_PREFERRED = {"đổi", "đổi nền", "thay", "xóa", "xoá", "áo", "quần", "tóc"}
+
+
+def fold_diacritics(text: str) -> str:
+    """Bỏ dấu tiếng Việt: 'Phục hồi ảnh' -> 'Phuc hoi anh'."""
+    text = text.replace("đ", "d").replace("Đ", "D")
+    decomposed = unicodedata.normalize("NFD", text)
+    return "".join(ch for ch in decomposed if unicodedata.category(ch) != "Mn")
+
+
+def normalize_prompt(text: str) -> str:
+    """Chuẩn hóa prompt: chữ thường, bỏ dấu, gộp khoảng trắng. Dùng làm cache key."""
+    return " ".join(fold_diacritics((text or "").lower()).split())
+
+
+def _keyword_regex(keyword: str, folded: bool) -> str:
+    kw = fold_diacritics(keyword) if folded else keyword
+    body = r"\s+".join(re.escape(part) for part in kw.split())
+    # Từ tiếng Việt khớp nguyên từ (tránh 'doi' trong 'doing');
+    # từ tiếng Anh chỉ chặn đầu để vẫn khớp 'scratches', 'colors'...
+    if not keyword.isascii():
+        return rf"\b{body}\b"
+    return rf"\b{body}"
+
+
+def _compile(keywords_by_label: Dict[str, list], folded: bool) -> re.Pattern:
+    groups = []
+    for label, keywords in keywords_by_label.items():
+        # Từ dài trước để "đổi nền" được ưu tiên hơn "đổi"
+        ordered = sorted(keywords, key=len, reverse=True)
+        alternation = "|".join(_keyword_regex(k, folded) for k in ordered)
+        if alternation:
+            groups.append(f"(?P<{label}>{alternation})")
+    return re.compile("|".join(groups) or r"(?!x)x")
+
+
+_ACCENT_SENSITIVE = _ACCENT_REQUIRED | _ACCENT_PREFERRED
+
+_FOLDED_PATTERN = _compile({
+    "inpaint": [k for k in INPAINT_KEYWORDS if k not in _ACCENT_SENSITIVE],
+    "restore": [k for k in RESTORE_KEYWORDS if k not in _ACCENT_SENSITIVE],
+}, folded=True)
+_ACCENTED_PATTERN = _compile({
+    "inpaint": [k for k in INPAINT_KEYWORDS if k in _ACCENT_SENSITIVE],
+    "restore": [k for k in RESTORE_KEYWORDS if k in _ACCENT_SENSITIVE],
+}, folded=False)
+# Prompt gõ không dấu: các từ _ACCENT_PREFERRED so khớp dạng không dấu
+_UNACCENTED_PATTERN = _compile({
+    "inpaint": [k for k in INPAINT_KEYWORDS if k in _ACCENT_PREFERRED],
+    "restore": [k for k in RESTORE_KEYWORDS if k in _ACCENT_PREFERRED],
+}, folded=True)
+
+
+def keyword_scores(text: str) -> Tuple[int, int]:
+    """Đếm số từ khóa (khác nhau) khớp cho (inpaint, restore) trong một lượt quét."""
+    # NFC: bàn phím/hệ điều hành gửi dấu tách rời (NFD) vẫn khớp từ khóa có dấu
+    lowered = unicodedata.normalize("NFC", (text or "").lower())
+    folded = normalize_prompt(lowered)
+    scans = [(_FOLDED_PATTERN, folded), (_ACCENTED_PATTERN, lowered)]
+    if folded == " ".join(lowered.split()):
+        scans.append((_UNACCENTED_PATTERN, folded))
+    hits = {"inpaint": set(), "restore": set()}
+    for pattern, haystack in scans:
+        for m in pattern.finditer(haystack):
+            hits[m.lastgroup].add(m.group(0))
+    return len(hits["inpaint"]), len(hits["restore"])
+
+
+def classify_by_keywords(text: str) -> str:
+    inpaint_score, restore_score = keyword_scores(text)
+    return "inpaint" if inpaint_score > restore_score else "restore"
+
+
+class TTLCache:
+    """LRU cache có giới hạn kích thước và thời gian sống, an toàn khi dùng từ nhiều thread."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: str, value: str) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+_llm_cache = TTLCache(config.CLASSIFIER_CACHE_SIZE, config.CLASSIFIER_CACHE_TTL)
+_session = requests.Session()
+
+
+def _ask_local_llm(text: str) -> Optional[str]:
+    """Hỏi Ollama. Trả về 'restore'/'inpaint' hoặc None nếu LLM không chắc."""
+    url = f"{config.OLLAMA_URL.rstrip('/')}/api/generate"
+    instruction = (
+        "You are a classifier. Decide the best workflow for an image request. "
+        "Return exactly one token: 'restore' or 'inpaint'.\n\n"
+        "If the user asks to change content (background, clothes, remove/add objects), answer 'inpaint'. "
+        "If the user asks to restore/enhance/fix quality (scratches, noise, colors), answer 'restore'.\n\n"
+        f"User request: {text}\nAnswer:"
+    )
+    payload = {"model": config.OLLAMA_MODEL, "prompt": instruction, "stream": False}
+    r = _session.post(url, json=payload, timeout=config.OLLAMA_TIMEOUT)
+    r.raise_for_status()
+    resp = ((r.json() or {}).get("response") or "").strip().lower()
+    if "inpaint" in resp:
+        return "inpaint"
+    if "restore" in resp:
+        return "restore"
+    return None
+
+
+def classify_workflow(text: str) -> str:
+    """Phân loại workflow: 'restore' hoặc 'inpaint'.
+
+    Thứ tự: cache quyết định của LLM (theo prompt đã chuẩn hóa) -> LLM local
+    (Ollama, nếu có OLLAMA_MODEL) -> heuristic từ khóa. Hàm này có thể block
+    tới OLLAMA_TIMEOUT giây khi cache miss, nên gọi trong thread từ code async.
+    """
+    if not config.OLLAMA_MODEL:
+        return classify_by_keywords(text)
+
+    key = normalize_prompt(text)
+    cached = _llm_cache.get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        decision = _ask_local_llm(text)
+    except Exception as e:
+        logger.warning(f"Local LLM classification failed, using keywords: {e}")
+        return classify_by_keywords(text)
+
+    if decision is None:
+        # Nếu không chắc, fallback keyword
+        return classify_by_keywords(text)
+    _llm_cache.set(key, decision)
+    return decision
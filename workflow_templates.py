@@ -0,0 +1,290 @@
+import copy
+import json
+import os
+import logging
+import threading
+from typing import Any, Dict, Optional, Set
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+WORKFLOWS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "workflows")
+
+# Tên workflow -> file template trong thư mục workflows/
+TEMPLATE_FILES = {
+    "restore": "Restore.json",
+    "inpaint": "Inpainting.json",
+}
+
+# Node output chứa ảnh kết quả: ưu tiên theo thứ tự `preferred`,
+# không bao giờ chọn các node trong `exclude` (ví dụ ảnh ORIGINAL)
+RESULT_NODES = {
+    "restore": {"preferred": ["18"], "exclude": ["19"]},
+    "inpaint": {"preferred": ["8", "116"], "exclude": []},
+}
+
+# Node + input mà builder ghi đè khi dựng workflow (validator kiểm tra chúng tồn tại)
+PATCH_SLOTS = {
+    "restore": {"75": ["image"], "60": ["text_b"]},
+    "inpaint": {"78": ["image"], "106": ["image"], "108": ["image"], "111": ["prompt"], "110": []},
+}
+
+# Tham số API -> các input node mà nó điều khiển (áp dụng cho mọi node trong danh sách)
+PARAM_BINDINGS = {
+    "restore": {
+        "steps": [("3", "steps"), ("72", "steps")],
+        "guidance_scale": [("80", "guidance")],
+        # LIKELINESS LEVEL: strength của ControlNet giữ bố cục ảnh gốc
+        "strength": [("61", "value")],
+        "megapixels": [("31", "megapixels"), ("70", "megapixels")],
+        "seed": [("3", "seed"), ("72", "seed")],
+    },
+    "inpaint": {
+        "steps": [("3", "steps")],
+        "guidance_scale": [("3", "cfg")],
+        "megapixels": [("93", "megapixels")],
+        "seed": [("3", "seed")],
+    },
+}
+
+# Kiểu và khoảng hợp lệ của từng tham số
+PARAM_SPECS = {
+    "steps": (int, 1, 100),
+    "guidance_scale": (float, 0.0, 30.0),
+    "strength": (float, 0.0, 1.0),
+    "megapixels": (float, 0.1, 8.0),
+    "seed": (int, 0, 2 ** 64 - 1),
+}
+
+# Preset theo workflow; "full" = giá trị gốc của template
+PRESETS = {
+    "restore": {
+        "draft": {"steps": 4, "megapixels": 0.5},
+        "full": {},
+    },
+    "inpaint": {
+        "draft": {"steps": 4, "megapixels": 0.5},
+        "full": {},
+    },
+}
+DEFAULT_PRESET = "full"
+
+# Các node output ghi ảnh ra đĩa (encode PNG + lưu file) trên host ComfyUI
+OUTPUT_NODE_TYPES = {"PreviewImage", "SaveImage"}
+
+_templates: Dict[Any, Dict[str, Any]] = {}
+_lock = threading.Lock()
+
+
+def _input_refs(node: Dict[str, Any]):
+    for value in (node.get("inputs") or {}).values():
+        if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+            yield value[0]
+
+
+def strip_unused_outputs(workflow: Dict[str, Any], workflow_name: str) -> Dict[str, Any]:
+    """Bỏ các node output mà client không dùng (vd PreviewImage "ORIGINAL" node 19)
+    và các node chỉ để cấp dữ liệu cho chúng. Sửa trực tiếp `workflow`.
+
+    Node được giữ: output chứa ảnh kết quả (RESULT_NODES) và mọi node không phải
+    output mà ban đầu không có ai dùng (có thể là node có side effect như cleanGpuUsed).
+    """
+    keep = {n for n in RESULT_NODES[workflow_name]["preferred"]
+            if n in workflow and workflow[n].get("class_type") in OUTPUT_NODE_TYPES}
+    if not keep:
+        # Không xác định được node kết quả → không đụng vào graph
+        return workflow
+
+    def _consumers() -> Dict[str, Set[str]]:
+        result = {node_id: set() for node_id in workflow}
+        for node_id, node in workflow.items():
+            for ref in _input_refs(node):
+                if ref in result:
+                    result[ref].add(node_id)
+        return result
+
+    sinks = {node_id for node_id, users in _consumers().items() if not users}
+    removed = [node_id for node_id in sinks
+               if workflow[node_id].get("class_type") in OUTPUT_NODE_TYPES and node_id not in keep]
+    for node_id in removed:
+        del workflow[node_id]
+
+    # Lặp: node trước đây có consumer nhưng giờ không còn → chỉ phục vụ node đã bỏ
+    while True:
+        orphans = [node_id for node_id, users in _consumers().items() if not users and node_id not in sinks]
+        if not orphans:
+            break
+        for node_id in orphans:
+            del workflow[node_id]
+        removed.extend(orphans)
+
+    if removed:
+        logger.info(f"Stripped {len(removed)} unused node(s) from '{workflow_name}': {sorted(removed, key=int)}")
+    return workflow
+
+
+def load_template(name: str, keep_previews: Optional[bool] = None) -> Dict[str, Any]:
+    """Trả về bản copy mới của template (file JSON chỉ được đọc và tối ưu một lần).
+
+    Mặc định các node preview không dùng tới đã được bỏ (xem strip_unused_outputs);
+    `keep_previews=True` (hoặc KEEP_PREVIEW_NODES) giữ nguyên graph để debug/so sánh.
+    """
+    if keep_previews is None:
+        keep_previews = config.KEEP_PREVIEW_NODES
+    with _lock:
+        template = _templates.get((name, keep_previews))
+        if template is None:
+            original = _templates.get((name, True))
+            if original is None:
+                path = os.path.join(WORKFLOWS_DIR, TEMPLATE_FILES[name])
+                with open(path, "r", encoding="utf-8") as f:
+                    original = json.load(f)
+                _templates[(name, True)] = original
+                logger.info(f"Loaded workflow template '{name}' from {path} ({len(original)} nodes)")
+            template = original if keep_previews else strip_unused_outputs(copy.deepcopy(original), name)
+            _templates[(name, keep_previews)] = template
+    return copy.deepcopy(template)
+
+
+def preload_templates() -> None:
+    for name in TEMPLATE_FILES:
+        load_template(name)
+
+
+def resolve_parameters(workflow_name: str, preset: Optional[str] = None,
+                       params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Gộp preset với tham số người dùng (tham số None bị bỏ qua), kiểm tra kiểu và khoảng.
+
+    Raise ValueError nếu preset/tham số không hợp lệ cho workflow.
+    """
+    presets = PRESETS[workflow_name]
+    preset = preset or DEFAULT_PRESET
+    if preset not in presets:
+        raise ValueError(f"Unknown preset '{preset}' for workflow '{workflow_name}' (available: {sorted(presets)})")
+    values = dict(presets[preset])
+    values.update({k: v for k, v in (params or {}).items() if v is not None})
+
+    resolved = {}
+    for key, value in values.items():
+        if key not in PARAM_BINDINGS[workflow_name]:
+            raise ValueError(f"Parameter '{key}' is not supported by workflow '{workflow_name}'")
+        cast, low, high = PARAM_SPECS[key]
+        try:
+            value = cast(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Parameter '{key}' must be {cast.__name__}, got {value!r}")
+        if not low <= value <= high:
+            raise ValueError(f"Parameter '{key}' must be between {low} and {high}, got {value}")
+        resolved[key] = value
+    return resolved
+
+
+def apply_parameters(workflow: Dict[str, Any], workflow_name: str, preset: Optional[str] = None,
+                     params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Ghi preset + tham số vào các input node theo PARAM_BINDINGS. Sửa trực tiếp `workflow`."""
+    resolved = resolve_parameters(workflow_name, preset, params)
+    for key, value in resolved.items():
+        for node_id, input_name in PARAM_BINDINGS[workflow_name][key]:
+            node = workflow.get(node_id)
+            if node is None:
+                logger.warning(f"Node {node_id} for parameter '{key}' not found in '{workflow_name}'")
+                continue
+            node["inputs"][input_name] = value
+    if resolved:
+        logger.info(f"Applied parameters to '{workflow_name}' (preset={preset or DEFAULT_PRESET}): {resolved}")
+    return workflow
+
+
+def build_restore_workflow(image_filename: str, prompt: str, keep_previews: Optional[bool] = None,
+                           preset: Optional[str] = None, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Restore.json: thay ảnh input (node 75), prompt (text_b của node 60) và tham số/preset (PARAM_BINDINGS)."""
+    workflow = load_template("restore", keep_previews)
+    apply_parameters(workflow, "restore", preset, params)
+    workflow["75"]["inputs"]["image"] = image_filename
+    workflow["60"]["inputs"]["text_b"] = prompt
+    logger.info(f"Prepared Restore workflow: image={image_filename}")
+    return workflow
+
+
+def build_inpainting_workflow(image1: str, prompt: str,
+                              image2: Optional[str] = None,
+                              image3: Optional[str] = None,
+                              keep_previews: Optional[bool] = None,
+                              preset: Optional[str] = None,
+                              params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Inpainting.json với ảnh đã upload vào ComfyUI.
+
+    - Node 78: ảnh chính, node 106/108: ảnh tham chiếu (tùy chọn)
+    - Node 111: prompt tích cực
+    - Bỏ image2/image3 khỏi node 110/111 khi không có ảnh tham chiếu tương ứng
+    - Tham số/preset theo PARAM_BINDINGS
+    """
+    wf = load_template("inpaint", keep_previews)
+    apply_parameters(wf, "inpaint", preset, params)
+
+    if "78" in wf and "inputs" in wf["78"]:
+        wf["78"]["inputs"]["image"] = image1
+    else:
+        logger.warning("Workflow Inpainting.json không có node '78' như kỳ vọng")
+
+    if image2:
+        if "106" in wf and "inputs" in wf["106"]:
+            wf["106"]["inputs"]["image"] = image2
+        else:
+            logger.warning("Node 106 not found in workflow but ref_image2 provided!")
+    if image3:
+        if "108" in wf and "inputs" in wf["108"]:
+            wf["108"]["inputs"]["image"] = image3
+        else:
+            logger.warning("Node 108 not found in workflow but ref_image3 provided!")
+
+    if "111" in wf and "inputs" in wf["111"]:
+        wf["111"]["inputs"]["prompt"] = prompt
+    else:
+        logger.warning("Workflow Inpainting.json không có node '111' như kỳ vọng để set prompt")
+
+    # QUAN TRỌNG: Xóa image2/image3 nếu không có, kể cả ở negative prompt (110)
+    for node_id in ("111", "110"):
+        inputs = wf.get(node_id, {}).get("inputs")
+        if inputs is None:
+            logger.warning(f"Node {node_id} not found in workflow!")
+            continue
+        if not image2:
+            inputs.pop("image2", None)
+        if not image3:
+            inputs.pop("image3", None)
+
+    logger.info(f"Prepared Inpainting workflow with {len(wf)} nodes: image1={image1}, image2={image2}, image3={image3}")
+    return wf
+
+
+def pick_result_filename(workflow_name: str, result: Dict[str, Any]) -> str:
+    """Chọn tên file ảnh kết quả từ history của prompt."""
+    rules = RESULT_NODES[workflow_name]
+    outputs = result.get("outputs", {}) or {}
+    candidates = {}
+    first = None
+    for node_id, out in outputs.items():
+        if not isinstance(out, dict):
+            continue
+        images = out.get("images") or []
+        if not images or not images[0].get("filename"):
+            continue
+        node_id = str(node_id)
+        candidates[node_id] = images[0]["filename"]
+        if first is None and node_id not in rules["exclude"]:
+            first = node_id
+
+    for node_id in rules["preferred"]:
+        if node_id in candidates:
+            logger.info(f"Using result from node {node_id}: {candidates[node_id]}")
+            return candidates[node_id]
+    if first is not None:
+        logger.info(f"Using image from node {first}: {candidates[first]}")
+        return candidates[first]
+    if candidates:
+        node_id, filename = next(iter(candidates.items()))
+        logger.info(f"Using first available image from node {node_id}: {filename}")
+        return filename
+    raise Exception("Không tìm thấy ảnh output trong kết quả.")
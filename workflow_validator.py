@@ -0,0 +1,88 @@
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from config import config
+from comfyui_client import ComfyUIClient
+from workflow_templates import PATCH_SLOTS, TEMPLATE_FILES, load_template
+
+logger = logging.getLogger(__name__)
+
+
+def validate_workflow(name: str, workflow: Dict[str, Any], object_info: Dict[str, Any]) -> List[str]:
+    """Đối chiếu workflow với /object_info của backend; trả về danh sách lỗi (rỗng = chạy được).
+
+    Kiểm tra: class_type có được cài trên backend, đủ required inputs, và các
+    node/input mà builder sẽ ghi đè (PATCH_SLOTS) có trong template.
+    """
+    problems = []
+    for node_id, node in workflow.items():
+        class_type = node.get("class_type")
+        info = object_info.get(class_type)
+        if info is None:
+            problems.append(f"node {node_id}: class '{class_type}' is not installed")
+            continue
+        inputs = node.get("inputs") or {}
+        required = ((info.get("input") or {}).get("required") or {})
+        missing = [key for key in required if key not in inputs]
+        if missing:
+            problems.append(f"node {node_id} ({class_type}): missing required input(s) {missing}")
+
+    for node_id, slots in PATCH_SLOTS.get(name, {}).items():
+        node = workflow.get(node_id)
+        if node is None:
+            problems.append(f"patch slot node {node_id} is missing from the template")
+            continue
+        for slot in slots:
+            if slot not in (node.get("inputs") or {}):
+                problems.append(f"patch slot {node_id}.{slot} is missing from the template")
+    return problems
+
+
+class WorkflowValidator:
+    """Cache kết quả kiểm tra template trên từng backend ComfyUI.
+
+    /object_info được tải một lần mỗi backend (và lại sau WORKFLOW_VALIDATION_INTERVAL
+    hoặc khi backend vừa hồi phục); backend không chạy được workflow nào đó bị loại
+    khỏi routing cho workflow đó, để request lỗi ngay thay vì sau khi đã upload ảnh.
+    """
+
+    def __init__(self, interval: float = None, timeout: float = None):
+        self.interval = interval if interval is not None else config.WORKFLOW_VALIDATION_INTERVAL
+        self.timeout = timeout if timeout is not None else config.WORKFLOW_VALIDATION_TIMEOUT
+        self._results: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def is_stale(self, url: str) -> bool:
+        entry = self._results.get(url)
+        return entry is None or time.time() - entry["checked_at"] > self.interval
+
+    def invalidate(self, url: str) -> None:
+        with self._lock:
+            self._results.pop(url, None)
+
+    def validate_backend(self, url: str) -> Dict[str, List[str]]:
+        """Tải /object_info và kiểm tra mọi template (I/O đồng bộ → chạy trong thread)."""
+        object_info = ComfyUIClient(url).get_object_info(timeout=self.timeout)
+        workflows = {name: validate_workflow(name, load_template(name), object_info) for name in TEMPLATE_FILES}
+        with self._lock:
+            self._results[url] = {"checked_at": time.time(), "workflows": workflows}
+        for name, problems in workflows.items():
+            if problems:
+                logger.warning(f"Backend {url} cannot run workflow '{name}': {'; '.join(problems)}")
+        return workflows
+
+    def supports(self, url: str, workflow: Optional[str]) -> bool:
+        """True nếu backend chạy được workflow (chưa kiểm tra → lạc quan)."""
+        if workflow is None:
+            return True
+        entry = self._results.get(url)
+        if entry is None:
+            return True
+        return not entry["workflows"].get(workflow)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {url: {"checked_at": e["checked_at"], "workflows": dict(e["workflows"])}
+                    for url, e in self._results.items()}